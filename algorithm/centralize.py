@@ -2,6 +2,7 @@ import time
 import torch
 from .fedbase import BasicServer
 from .fedavg import Client
+from benchmark.toolkits import UnionDataset
 import utils.fflow as flw
 import utils.logger.basic_logger as bl
 import ujson
@@ -13,13 +14,8 @@ class Server(BasicServer):
     def __init__(self, option, model, clients, test_data=None):
         super(Server, self).__init__(option, model, clients, test_data)
         self.data_loader = None
-        train_data = self.clients[0].train_data
-        valid_data = self.clients[0].valid_data
-        for i in range(1, self.num_clients):
-            train_data = train_data + self.clients[i].train_data
-            valid_data = valid_data + self.clients[i].valid_data
-        self.train_data = train_data
-        self.valid_data = valid_data
+        self.train_data = UnionDataset([c.train_data for c in self.clients])
+        self.valid_data = UnionDataset([c.valid_data for c in self.clients])
         self.batch_size = len(self.train_data) if option['batch_size'] == -1 else int(option['batch_size'])
         self.epochs = option['num_epochs']
         self.num_iters_per_epoch = math.ceil(len(self.train_data)/self.batch_size)
@@ -18,6 +18,7 @@ class Server(BasicServer):
             # using logger to evaluate the model if the model is updated
             if self.updated:
                 self.updated = False
+                if self.current_round > 1: self.log_traffic()
                 flw.logger.info("--------------Round {}--------------".format(self.current_round))
                 # check log interval
                 if flw.logger.check_if_log(self.current_round, self.eval_interval):
@@ -37,6 +38,7 @@ class Server(BasicServer):
         flw.logger.time_end('Eval Time Cost')
         flw.logger.info("=================End==================")
         flw.logger.time_end('Total Time Cost')
+        self.close_workers()
         # save results as .json file
         flw.logger.save_output_as_json()
         return
@@ -58,7 +60,8 @@ class Server(BasicServer):
             # averaging the simultaneously received models at the current moment
             taus = [self.client_taus[cid] for cid in received_client_ids]
             alpha_ts = [self.alpha * self.s(self.current_round - tau) for tau in taus]
-            currently_updated_models = [(1-alpha_t)*self.model+alpha_t*model_k for alpha_t, model_k in zip(alpha_ts, received_models) ]
+            # (1-alpha_t)*self.model+alpha_t*model_k is computed in place on the received model
+            currently_updated_models = [model_k.lerp_(self.model, 1-alpha_t) for alpha_t, model_k in zip(alpha_ts, received_models) ]
             self.model = self.aggregate(currently_updated_models)
             # update aggregation round and the flag `updated`
             self.current_round += 1
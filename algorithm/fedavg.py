@@ -29,6 +29,7 @@ class Server(BasicServer):
             if flw.logger.early_stop(): break
             # federated train
             self.iterate()
+            self.log_traffic()
             # decay learning rate
             self.global_lr_scheduler(round)
             flw.logger.time_end('Time Cost')
@@ -38,6 +39,7 @@ class Server(BasicServer):
         flw.logger.time_end('Eval Time Cost')
         flw.logger.info("=================End==================")
         flw.logger.time_end('Total Time Cost')
+        self.close_workers()
         # save results as .json file
         log_filepath = flw.logger.save_output_as_json(suffix_log_filename=suffix_log_filename)
         wandb.save(log_filepath)
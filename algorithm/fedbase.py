@@ -1,13 +1,17 @@
 import numpy as np
 import utils.fmodule
 from utils import fmodule
+from utils import codec
+from utils import batched_trainer
+from utils import seeding
+from utils import loader_pool
 import copy
 import os
 import utils.fflow as flw
 import utils.system_simulator as ss
 import math
 import collections
-import torch.multiprocessing as mp
+from utils.worker_pool import ClientWorkerPool
 
 class BasicServer:
     def __init__(self, option, model, clients, test_data=None):
@@ -42,6 +46,17 @@ class BasicServer:
         self.tolerance_for_latency = 1000
         self.tolerance_for_availability = 0
         self.asynchronous = False
+        # the streaming aggregator of the current round
+        self.aggregator = None
+        # the pool of the models that are sent to clients
+        self.model_pool = fmodule.ModelPool()
+        # the persistent processes that train the clients when num_threads > 1
+        self.worker_pool = None
+        # the codec of the models uploaded by clients and the reference models that they are encoded with
+        self.codec = codec.get_codec(option['codec'])
+        self._codec_refs = {}
+        # the numbers of bytes uploaded and downloaded since the last log
+        self.traffic = {'upload': 0, 'download': 0}
         # algorithm-dependent parameters
         self.algo_para = {}
         self.current_round = 1
@@ -66,6 +81,7 @@ class BasicServer:
             if flw.logger.early_stop(): break
             # federated train
             self.iterate()
+            self.log_traffic()
             # decay learning rate
             self.global_lr_scheduler(round)
             flw.logger.time_end('Time Cost')
@@ -75,6 +91,7 @@ class BasicServer:
         flw.logger.time_end('Eval Time Cost')
         flw.logger.info("=================End==================")
         flw.logger.time_end('Total Time Cost')
+        self.close_workers()
         # save results as .json file
         flw.logger.save_output_as_json()
         return
@@ -89,6 +106,14 @@ class BasicServer:
         """
         # sample clients: MD sampling as default
         self.selected_clients = self.sample()
+        if type(self).aggregate is BasicServer.aggregate:
+            # training and aggregating the models as soon as they arrive
+            self.aggregator = self.create_aggregator()
+            self.communicate(self.selected_clients)
+            model = self.aggregator.finalize()
+            self.aggregator = None
+            if model is not None: self.model = model
+            return
         # training
         models = self.communicate(self.selected_clients)['model']
         # aggregate: pk = 1/K as default where K=len(selected_clients)
@@ -110,25 +135,121 @@ class BasicServer:
         client_package_buffer = {}
         communicate_clients = list(set(selected_clients))
         for cid in communicate_clients:client_package_buffer[cid] = None
+        # the uploaded models are encoded with respect to a snapshot of the current global model, which is
+        # not changed by aggregating the models that arrive earlier
+        if self.codec.active:
+            ref = self.model_pool.acquire(self.model)
+            for cid in communicate_clients: self._release_codec_ref(self._codec_refs.pop(cid, None))
+            for cid in communicate_clients: self._codec_refs[cid] = ref
         if self.num_threads <= 1:
+            # training the clients together before they reply if possible
+            if self.can_train_in_batch(communicate_clients): self.train_in_batch(communicate_clients)
             # computing iteratively
             for client_id in communicate_clients:
-                response_from_client_id = self.communicate_with(client_id)
-                packages_received_from_clients.append(response_from_client_id)
+                response_from_client_id = self.receive_package(self.communicate_with(client_id))
+                packages_received_from_clients.append(self.aggregate_on_arrival(response_from_client_id, selected_clients.count(client_id), asynchronous))
         else:
-            # computing in parallel with torch.multiprocessing
-            pool = mp.Pool(self.num_threads)
+            # computing in parallel by the persistent worker processes
+            pool = self.get_worker_pool()
+            for client_id in communicate_clients:
+                svr_pkg = self.pack(client_id)
+                ss.state_updater.set_variable([client_id], '__download_size', [ss.package_size(svr_pkg)])
+                pool.submit(self.clients[client_id], svr_pkg, ss.clock.current_time)
             for client_id in communicate_clients:
-                self.clients[client_id].update_device(next(utils.fmodule.dev_manager))
-                packages_received_from_clients.append(pool.apply_async(self.communicate_with, args=(int(client_id),)))
-            pool.close()
-            pool.join()
-            packages_received_from_clients = list(map(lambda x: x.get(), packages_received_from_clients))
+                response_from_client_id = self.receive_package(self.communicate_with_worker(client_id))
+                packages_received_from_clients.append(self.aggregate_on_arrival(response_from_client_id, selected_clients.count(client_id), asynchronous))
         for i,cid in enumerate(communicate_clients): client_package_buffer[cid] = packages_received_from_clients[i]
         packages_received_from_clients = [client_package_buffer[cid] for cid in selected_clients if client_package_buffer[cid]]
         self.received_clients = selected_clients
         return self.unpack(packages_received_from_clients)
 
+    def can_train_in_batch(self, client_ids):
+        """
+        Check whether the local training of the clients can be done together by utils.batched_trainer,
+        which requires that the clients train the global model by the standard procedure of BasicClient.
+        """
+        if not self.option['vmap_clients'] or len(client_ids) < 2 or type(self).pack is not BasicServer.pack: return False
+        for cid in client_ids:
+            c = self.clients[cid]
+            if type(c).reply is not BasicClient.reply or type(c).unpack is not BasicClient.unpack or type(c).train is not BasicClient.train: return False
+            if c.device != self.device or type(c.calculator) is not type(self.clients[client_ids[0]].calculator): return False
+        c = self.clients[client_ids[0]]
+        return batched_trainer.supports(self.model, c.calculator, c.train_data[0])
+
+    def train_in_batch(self, client_ids):
+        """
+        Train the global model for each of the clients together and keep the results in the clients
+        until they reply. The batches of each client are drawn in the same order as training the
+        clients one by one.
+        :param
+            client_ids: the ids of the clients to be trained
+        """
+        clients = [self.clients[cid] for cid in client_ids]
+        batches = []
+        for c in clients:
+            with seeding.fixed_seed('train', ss.clock.current_time, c.id):
+                batches.append(c.draw_train_batches(self.model))
+        results = batched_trainer.train(self.model, clients[0].calculator, batches,
+                                        [c.learning_rate for c in clients], [c.weight_decay for c in clients], [c.momentum for c in clients])
+        for c, params in zip(clients, results): c._batched_params = params
+        return
+
+    def receive_package(self, package):
+        """
+        Count the traffic of the package and decode the encoded model in it (if any).
+        :param
+            package: the reply from a client
+        :return
+            the package with the decoded model
+        """
+        if package is None: return package
+        self.traffic['upload'] += package.get('__upload_size', 0)
+        self.traffic['download'] += package.get('__download_size', 0)
+        if isinstance(package.get('model'), codec.EncodedModel):
+            ref = self._codec_refs.pop(package['__cid'], None)
+            package['model'] = self.codec.decode(package['model'], self.model if ref is None else ref)
+            self._release_codec_ref(ref)
+        return package
+
+    def _release_codec_ref(self, ref):
+        """Put the snapshot of the global model back into the pool once no client refers to it"""
+        if ref is not None and all([r is not ref for r in self._codec_refs.values()]): self.model_pool.release(ref)
+
+    def log_traffic(self):
+        """
+        Log the numbers of bytes uploaded and downloaded since the last call.
+        :return
+            a dict of the numbers of uploaded and downloaded bytes
+        """
+        traffic = self.traffic
+        flw.logger.write_var_into_output('upload_bytes', traffic['upload'])
+        flw.logger.write_var_into_output('download_bytes', traffic['download'])
+        flw.logger.info('Upload: {} bytes, Download: {} bytes'.format(traffic['upload'], traffic['download']))
+        self.traffic = {'upload': 0, 'download': 0}
+        return traffic
+
+    def aggregate_on_arrival(self, package, multiplicity=1, asynchronous=False):
+        """
+        Add the model in the package into the running aggregation self.aggregator (if any) and release
+        it from the package. Only the packages that will be received within the tolerance for latency
+        are aggregated, and the others are left to the simulator.
+        :param
+            package: the reply from a client
+            multiplicity: the number of times that the client is selected
+            asynchronous: whether the communication is asynchronous
+        :return
+            the package whose model is set None if it has been aggregated
+        """
+        if getattr(self, 'aggregator', None) is None or not self.aggregator.active or asynchronous: return package
+        if package is None or package.get('model') is None: return package
+        if '__t' in package and package['__t'] - ss.clock.current_time > self.get_tolerance_for_latency(): return package
+        self.aggregator.add(package['model'], multiplicity * self.aggregation_weight(package.get('__cid')))
+        # the aggregated model can be sent to the next clients unless the client keeps it as its own model (e.g. FedBN)
+        cid = package.get('__cid')
+        if cid is None or package['model'] is not self.clients[cid].model: self.model_pool.release(package['model'])
+        package['model'] = None
+        return package
+
     @ss.with_latency
     def communicate_with(self, client_id):
         """
@@ -140,8 +261,36 @@ class BasicServer:
         """
         # package the necessary information
         svr_pkg = self.pack(client_id)
-        # listen for the client's response
-        return self.clients[client_id].reply(svr_pkg)
+        ss.state_updater.set_variable([client_id], '__download_size', [ss.package_size(svr_pkg)])
+        # listen for the client's response, which is computed with the random stream of the client at this time
+        with seeding.fixed_seed('train', ss.clock.current_time, self.clients[client_id].id):
+            return self.clients[client_id].reply(svr_pkg)
+
+    @ss.with_latency
+    def communicate_with_worker(self, client_id):
+        """
+        Receive the response of client_id from the worker processes, where the package from the server
+        has been sent by self.worker_pool.submit
+        :param
+            client_id: the id of the client to communicate with
+        :return
+            client_package: the reply from the client
+        """
+        return self.worker_pool.receive(self.clients[client_id], like=self.model)
+
+    def get_worker_pool(self):
+        """Start the worker processes at the first call and return them"""
+        if self.worker_pool is None: self.worker_pool = ClientWorkerPool(self.option, self.num_threads)
+        return self.worker_pool
+
+    def close_worker_pool(self):
+        if self.worker_pool is not None: self.worker_pool.close()
+        self.worker_pool = None
+
+    def close_workers(self):
+        """Stop the processes that train the clients and load their data, which should be called at the end of run()"""
+        self.close_worker_pool()
+        loader_pool.close()
 
     def pack(self, client_id):
         """
@@ -153,7 +302,7 @@ class BasicServer:
             a dict that only contains the global model as default.
         """
         return {
-            "model" : copy.deepcopy(self.model),
+            "model" : self.model_pool.acquire(self.model),
         }
 
     def unpack(self, packages_received_from_clients):
@@ -198,17 +347,18 @@ class BasicServer:
             a list of the ids of the selected clients
         """
         all_clients = [cid for cid in range(self.num_clients)]
+        random_module = seeding.random_state('sample', ss.clock.current_time)
         # full sampling with unlimited communication resources of the server
         if self.sample_option == 'full':
             return all_clients
         # sample clients
         elif self.sample_option == 'uniform':
             # original sample proposed by fedavg
-            selected_clients = list(np.random.choice(all_clients, self.clients_per_round, replace=False))
+            selected_clients = list(random_module.choice(all_clients, self.clients_per_round, replace=False))
         elif self.sample_option =='md':
             # the default setting that is introduced by FedProx, where the clients are sampled with the probability in proportion to their local data sizes
             p = np.array(self.local_data_vols)/self.total_data_vol
-            selected_clients = list(np.random.choice(all_clients, self.clients_per_round, replace=True, p=p))
+            selected_clients = list(random_module.choice(all_clients, self.clients_per_round, replace=True, p=p))
         return selected_clients
 
     def aggregate(self, models: list, *args, **kwargs):
@@ -235,23 +385,42 @@ class BasicServer:
             # print(np.array(p))
             # print(np.array(p) * N / K)
             # return fmodule._model_sum([model_k * pk for model_k, pk in zip(models, p)]) * N / K
-            
-            # New version:
+
+            # New version: pk = nk / Σnk over all the received clients
             p = np.array([self.local_data_vols[cid] for cid in self.received_clients])
             p = p / p.sum()
-            return fmodule._model_sum([model_k * pk for model_k, pk in zip(models, p)])
-        
+            return fmodule.lincomb(models, p)
         elif self.aggregation_option == 'uniform':
             return fmodule._model_average(models)
         elif self.aggregation_option == 'weighted_com':
             p = [1.0 * self.local_data_vols[cid] / self.total_data_vol for cid in self.received_clients]
-            w = fmodule._model_sum([model_k * pk for model_k, pk in zip(models, p)])
-            return (1.0-sum(p))*self.model + w
+            return (1.0-sum(p))*self.model + fmodule.lincomb(models, p)
         else:
             p = [1.0 * self.local_data_vols[cid] / self.total_data_vol for cid in self.received_clients]
             sump = sum(p)
             p = [pk/sump for pk in p]
-            return fmodule._model_sum([model_k * pk for model_k, pk in zip(models, p)])
+            return fmodule.lincomb(models, p)
+
+    def create_aggregator(self):
+        """
+        Create a streaming aggregator that computes the same result as self.aggregate with the
+        weights given by self.aggregation_weight, where all the models of the received clients are added
+        """
+        if self.aggregation_option == 'uniform':
+            return fmodule.StreamingAggregator(normalize=True, unit_tracked=True).begin()
+        elif self.aggregation_option == 'weighted_com':
+            return fmodule.StreamingAggregator().begin(base=self.model)
+        else:
+            return fmodule.StreamingAggregator(normalize=True).begin()
+
+    def aggregation_weight(self, client_id):
+        """The weight of the model of client_id in the streaming aggregator"""
+        if self.aggregation_option == 'uniform':
+            return 1.0
+        elif self.aggregation_option == 'weighted_com':
+            return 1.0 * self.local_data_vols[client_id] / self.total_data_vol
+        else:
+            return 1.0 * self.local_data_vols[client_id]
 
     def test_on_clients(self, dataflag='valid'):
         """
@@ -328,6 +497,10 @@ class BasicServer:
         return [cid for cid in range(self.num_clients) if self.clients[cid].is_available()]
 
 class BasicClient():
+    # whether the uploaded model is encoded with respect to the received model, which should be
+    # False if the client uploads the update (e.g. the delta of the model) instead of the model
+    relative_upload = True
+
     def __init__(self, option, name='', train_data=None, valid_data=None):
         self.name = name
         self.id = None
@@ -355,6 +528,11 @@ class BasicClient():
             self.epochs = option['num_epochs']
             self.num_steps = self.epochs * math.ceil(len(self.train_data) / self.batch_size)
         self.model = None
+        # the codec of the uploaded model and the reference model that it is encoded with
+        self.codec = codec.get_codec(option['codec'])
+        self._codec_ref = None
+        # the parameters trained together with other clients by the server (see BasicServer.train_in_batch)
+        self._batched_params = None
         self.test_batch_size = option['test_batch_size']
         self.loader_num_workers = option['num_workers']
         self.current_steps = 0
@@ -413,6 +591,7 @@ class BasicClient():
             the unpacked information that can be rewritten
         """
         # unpack the received package
+        if self.codec.active and self.relative_upload: self._codec_ref = copy.deepcopy(received_pkg['model'])
         return received_pkg['model']
 
     def reply(self, svr_pkg):
@@ -429,10 +608,27 @@ class BasicClient():
             client_pkg: the package to be send to the server
         """
         model = self.unpack(svr_pkg)
-        self.train(model)
+        if self._batched_params is not None:
+            model.train()
+            model.load_state_dict(self._batched_params, strict=False)
+            self._batched_params = None
+        else:
+            self.train(model)
         cpkg = self.pack(model)
         return cpkg
 
+    @ss.with_completeness
+    def draw_train_batches(self, model):
+        """
+        Draw the batches of data for the local training in the same way as self.train(model), which
+        is used when the training is done by the server together with other clients.
+        :param
+            model: the model to be trained, which is not changed
+        :return
+            the list of the batches of all the local steps
+        """
+        return [self.get_batch_data() for _ in range(self.num_steps)]
+
     def pack(self, model):
         """
         Packing the package to be send to the server. The operations of compression
@@ -442,6 +638,8 @@ class BasicClient():
         :return
             package: a dict that contains the necessary information for the server
         """
+        if self.codec.active:
+            model, self._codec_ref = self.codec.encode(model, self._codec_ref), None
         return {
             "model" : model,
         }
@@ -517,20 +715,31 @@ class BasicClient():
         """
         return np.inf if self.dropped else self.time_response
 
+    def _new_data_loader(self):
+        data_loader = iter(self.calculator.get_data_loader(self.train_data, batch_size=self.batch_size, num_workers=self.loader_num_workers))
+        # the loaders that prefetch the batches only load those of the remaining steps of the local training
+        if hasattr(data_loader, 'limit'): data_loader.limit(self.num_steps - self.current_steps)
+        return data_loader
+
     def get_batch_data(self):
         """
         Get the batch of data
         :return:
             a batch of data
         """
+        if self.data_loader is None: self.data_loader = self._new_data_loader()
         try:
             batch_data = next(self.data_loader)
-        except:
-            self.data_loader = iter(self.calculator.get_data_loader(self.train_data, batch_size=self.batch_size, num_workers=self.loader_num_workers))
+        except StopIteration:
+            # start the next epoch
+            self.data_loader = self._new_data_loader()
             batch_data = next(self.data_loader)
         # clear local DataLoader when finishing local training
         self.current_steps = (self.current_steps+1) % self.num_steps
-        if self.current_steps == 0:self.data_loader = None
+        if self.current_steps == 0:
+            # the loaders that prefetch the batches (e.g. utils.loader_pool) stop loading the rest of the epoch
+            if hasattr(self.data_loader, 'close'): self.data_loader.close()
+            self.data_loader = None
         return batch_data
 
     def update_device(self, dev):
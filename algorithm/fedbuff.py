@@ -3,6 +3,7 @@ from .fedasync import Server as AsyncServer
 from .fedbase import BasicClient
 import utils.system_simulator as ss
 import utils.fflow as flw
+from utils import fmodule
 import copy
 
 class Server(AsyncServer):
@@ -11,7 +12,8 @@ class Server(AsyncServer):
         self.init_algo_para({'period':1, 'k':0, 'K': 10})
         self.tolerance_for_latency = 1000
         self.updated = True
-        self.accumulate_delta = None
+        # the buffer keeps the running average of the received deltas
+        self.buffer = fmodule.StreamingAggregator(normalize=True).begin()
 
 
     @ss.time_step
@@ -29,20 +31,13 @@ class Server(AsyncServer):
         # if reveive client update
         if len(received_models) > 0:
             flw.logger.info('Receive new models from clients {} at time {}'.format(received_client_ids, ss.clock.current_time))
-            flag = False
-            if self.accumulate_delta == None: flag = True
             for id, model_k in enumerate(received_models):
-                if flag == True:
-                        self.accumulate_delta = model_k
-                        flag = False
-                else:
-                    self.accumulate_delta += model_k
+                self.buffer.add(model_k)
                 self.k += 1
                 if self.k == self.K:
-                    self.accumulate_delta = self.accumulate_delta * pow(self.K, -1)
-                    self.model = self.model - self.lr * self.accumulate_delta
-                    self.accumulate_delta = None
-                    flag = True
+                    # self.model - self.lr * Σdelta_k / K
+                    self.model = self.model.axpy_(-self.lr, self.buffer.finalize())
+                    self.buffer.begin()
                     self.k = 0
             # update aggregation round and the flag `updated`
             self.current_round += 1
@@ -52,6 +47,9 @@ class Server(AsyncServer):
 
 
 class Client(BasicClient):
+    # the client uploads the delta of the model rather than the model
+    relative_upload = False
+
     def __init__(self, option, name='', train_data=None, valid_data=None):
         super(Client, self).__init__(option, name, train_data, valid_data)
 
@@ -59,6 +57,6 @@ class Client(BasicClient):
         model = self.unpack(svr_pkg)
         model_0 = copy.deepcopy(model)
         self.train(model)
-        model_q = model_0 - model
+        model_q = model_0.sub_(model)
         cpkg = self.pack(model_q)
         return cpkg
\ No newline at end of file
@@ -18,19 +18,19 @@ class Server(BasicServer):
         res = self.communicate(self.selected_clients)
         models, train_losses = res['model'], res['loss']
         # plug in the weight updates into the gradient
-        grads = [(self.model- model) / self.lr for model in models]
-        Deltas = [gi*np.float_power(li + 1e-10, self.q) for gi,li in zip(grads,train_losses)]
+        grads = [model.sub_(self.model).mul_(-1.0 / self.lr) for model in models]
         # estimation of the local Lipchitz constant
         hs = [self.q * np.float_power(li + 1e-10, (self.q - 1)) * (gi.norm() ** 2) + 1.0 / self.lr * np.float_power(li + 1e-10, self.q) for gi,li in zip(grads,train_losses)]
+        # the grads are scaled in place since they are no longer used
+        Deltas = [gi.mul_(np.float_power(li + 1e-10, self.q)) for gi,li in zip(grads,train_losses)]
         # aggregate
         self.model = self.aggregate(Deltas, hs)
         return
 
     def aggregate(self, Deltas, hs):
         demominator = np.sum(np.asarray(hs))
-        scaled_deltas = [delta/demominator for delta in Deltas]
-        updates = fmodule._model_sum(scaled_deltas)
-        new_model = self.model - updates
+        # self.model - Σ delta/demominator
+        new_model = fmodule.lincomb([self.model] + Deltas, [1.0] + [-1.0 / demominator for _ in Deltas])
         return new_model
 
 class Client(BasicClient):
@@ -15,7 +15,7 @@ class Server(BasicServer):
 
     def pack(self, client_id):
         return {
-            "model": copy.deepcopy(self.model),
+            "model": self.model_pool.acquire(self.model),
             "cg": self.cg,
         }
 
@@ -27,6 +27,7 @@ class Server(BasicServer):
         dys, dcs = res['dy'], res['dc']
         # aggregate
         self.model, self.cg = self.aggregate(dys, dcs)
+        self.model_pool.release(*dys, *dcs)
         return
 
     def aggregate(self, dys, dcs):
@@ -34,8 +35,8 @@ class Server(BasicServer):
         # c <-- c + |S|/N * dc = c + |S|/N * average(dcs)
         dx = fmodule._model_average(dys)
         dc = fmodule._model_average(dcs)
-        new_model = self.model + self.eta * dx
-        new_c = self.cg + 1.0 * len(dcs) / self.num_clients * dc
+        new_model = dx.mul_(self.eta).add_(self.model)
+        new_c = dc.mul_(1.0 * len(dcs) / self.num_clients).add_(self.cg)
         return new_model, new_c
 
 
@@ -74,9 +75,9 @@ class Client(BasicClient):
             for pm, pcg, pc in zip(model.parameters(), cg.parameters(), self.c.parameters()):
                 pm.grad = pm.grad - pc + pcg
             optimizer.step()
-        dy = model - src_model
-        dc = -1.0 / (self.num_steps * self.learning_rate) * dy - cg
-        self.c = self.c + dc
+        dy = model.sub_(src_model)
+        dc = fmodule.lincomb([dy, cg], [-1.0 / (self.num_steps * self.learning_rate), -1.0])
+        self.c.add_(dc)
         return dy, dc
 
     def reply(self, svr_pkg):
@@ -264,6 +264,7 @@ class Server(BasicServer):
         flw.logger.time_end('Eval Time Cost')
         flw.logger.info("=================End==================")
         flw.logger.time_end('Total Time Cost')
+        self.close_workers()
         # save results as .json file
         flw.logger.save_output_as_json()
         return
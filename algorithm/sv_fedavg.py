@@ -11,6 +11,8 @@ import itertools
 import utils.system_simulator as ss
 import wandb
 import utils.fflow as flw
+import utils.compact_store as cs
+from utils import seeding
 import torch.multiprocessing as mp
 class Server(BasicServer):
     def __init__(
@@ -30,6 +32,9 @@ class Server(BasicServer):
         self.calculate_fl_SV = self.exact or self.const_lambda or self.optimal_lambda
         self.round_calSV = option['round_calSV']
         self.start_round = option['start_round']
+        self.sv_model_precision = option['sv_model_precision']
+        self.save_local_models = option['save_local_models']
+        self.sv_compare_precision = option['sv_compare_precision'] and self.sv_model_precision != 'fp32'
         
         self.sv_const_logs = []
         self.sv_exact_logs = []
@@ -59,7 +64,11 @@ class Server(BasicServer):
         bitset_key = self.rnd_bitset(client_indices_).bits()
         if bitset_key in self.rnd_dict.keys():
             return self.rnd_dict[bitset_key]
-        models = [self.rnd_models_dict[index] for index in client_indices_]
+        if isinstance(self.rnd_models_dict, cs.CompactModelStore):
+            # the compact models are decoded one at a time during aggregation
+            models = self.rnd_models_dict.models(client_indices_)
+        else:
+            models = [self.rnd_models_dict[index] for index in client_indices_]
         self.model = self.aggregate(models=models, client_indices=client_indices_)
         acc = self.test()['accuracy']
         self.rnd_dict[bitset_key] = acc
@@ -120,7 +129,7 @@ class Server(BasicServer):
         all_rnd_subsets = list(itertools.chain.from_iterable(
             itertools.combinations(self.received_clients, _) for _ in range(len(self.received_clients) + 1)
         ))
-        random.shuffle(all_rnd_subsets)
+        seeding.random_state('sv', self.current_round).shuffle(all_rnd_subsets)
         number_of_samples = min(len(all_rnd_subsets), self.optimal_lambda_samples)
         for k in range(number_of_samples):
             subset = all_rnd_subsets[k]
@@ -230,6 +239,7 @@ class Server(BasicServer):
             if flw.logger.early_stop(): break
             # federated train
             self.iterate(round, global_store_path, local_store_path)
+            wandb.log({'{}_bytes'.format(k): v for k, v in self.log_traffic().items()})
             # decay learning rate
             self.global_lr_scheduler(round)
             flw.logger.time_end('Time Cost')
@@ -255,6 +265,7 @@ class Server(BasicServer):
             if self.optimal_lambda:
                 wandb.log({f'BarChart-Optimal{i}': wandb.plot.bar(opt_table, str(self.num_clients + 1), str(i + 1), title='Optimal SV')})
             
+        self.close_workers()
         # save results as .json file
         flw.logger.save_output_as_json()
         return
@@ -389,6 +400,8 @@ class Server(BasicServer):
         
         # sample clients: MD sampling as default but with replacement=False
         self.selected_clients = self.sample()
+        # the global model that the clients start from is the base of the compact client models
+        global_model = self.model
         # training
         clients_reply = self.communicate(self.selected_clients)
         models = clients_reply['model']
@@ -402,12 +415,15 @@ class Server(BasicServer):
         # test_acc = self.test()
         # wandb.log({'Train accuracy': valid_accs.sum() / len(valid_accs), 'Test accuracy': test_acc['accuracy']})
         # calculate Shapley values
-        if self.calculate_fl_SV:
+        if self.calculate_fl_SV or self.save_local_models:
             print('Finish training!')
-            self.rnd_models_dict = dict()
+            self.rnd_models_dict = dict() if self.sv_model_precision == 'fp32' else cs.CompactModelStore(global_model, self.sv_model_precision)
             for model, name in zip(models, names):
                 self.rnd_models_dict[int(name.replace('Client', ''))] = model
-                # torch.save(model.state_dict(), os.path.join(local_store_path, 'client{}_model.pt'.format(int(name.replace('Client', '')))))
+            if self.save_local_models: self.save_round_models(global_model, local_store_path)
+            if self.sv_compare_precision: self.compare_compact_sv(models, names)
+            del models, clients_reply
+        if self.calculate_fl_SV:
             print('Start to calculate FL SV round {}'.format(self.current_round))
             self.init_round()
             self.init_round_MID()
@@ -456,6 +472,39 @@ class Server(BasicServer):
         return
 
 
+    def save_round_models(self, global_model, local_store_path):
+        """Save the client models of the round (and the global model they are encoded with if they are compact)"""
+        if isinstance(self.rnd_models_dict, cs.CompactModelStore):
+            torch.save(global_model.state_dict(), os.path.join(local_store_path, 'base_model.pt'))
+            for cid in self.rnd_models_dict.keys():
+                self.rnd_models_dict.save(cid, os.path.join(local_store_path, 'client{}_model.pt'.format(cid)))
+        else:
+            for cid, model in self.rnd_models_dict.items():
+                torch.save(model.state_dict(), os.path.join(local_store_path, 'client{}_model.pt'.format(cid)))
+        return
+
+    def compare_compact_sv(self, models, names):
+        """Compare the exact SV of the round from the compact client models with those from the fp32 models"""
+        compact_models = self.rnd_models_dict
+        fp32_models = {int(name.replace('Client', '')): model for model, name in zip(models, names)}
+        # the utility function replaces self.model with the aggregated models of the subsets
+        global_model = self.model
+        round_SVs = []
+        for rnd_models in [fp32_models, compact_models]:
+            self.rnd_models_dict = rnd_models
+            self.rnd_bitset = bitset('round_bitset', tuple(range(self.num_clients)))
+            self.rnd_dict = dict()
+            round_SVs.append(self.calculate_round_exact_SV())
+        self.rnd_models_dict = compact_models
+        self.model = global_model
+        fp32_nbytes = sum([sum([v.numel() * v.element_size() for v in m.state_dict().values()]) for m in models])
+        max_abs_err = float(np.abs(round_SVs[1] - round_SVs[0]).max())
+        print('Compact client models ({}): {:.2f}MB -> {:.2f}MB, max absolute error of the round SV {:.2e}'.format(
+            self.sv_model_precision, fp32_nbytes / 2**20, compact_models.nbytes() / 2**20, max_abs_err))
+        wandb.log({'compact_sv_max_abs_err': max_abs_err})
+        return round_SVs
+
+
 class Client(BasicClient):
     def __init__(self, option, name='', train_data=None, valid_data=None):
         super(Client, self).__init__(option, name, train_data, valid_data)
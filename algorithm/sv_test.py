@@ -95,6 +95,7 @@ class Server(BasicServer):
         end = time.time()
         # save time
         flw.logger.add_time(total=(end - start), calculate_SV=self.calculate_SV_time)
+        self.close_workers()
         # save results as .json file
         log_filepath = flw.logger.save_output_as_json()
         wandb.save(log_filepath)
@@ -123,14 +123,11 @@ class TaskCalculator(BasicTaskCalculator):
     def test(self, model, dataset, batch_size=64, num_workers=0):
         model.eval()
         if batch_size==-1:batch_size=len(dataset)
-        data_loader = self.get_data_loader(dataset, batch_size=batch_size, num_workers=num_workers)
-        total_loss = 0.0
-        for batch_id, batch_data in enumerate(data_loader):
-            batch_data = self.data_to_device(batch_data)
+        total_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        for batch_data in self.get_eval_batches(dataset, batch_size=batch_size, num_workers=num_workers):
             outputs = model(batch_data[0], batch_data[1])
-            batch_mean_loss = self.criterion(outputs, batch_data[-1]).item()
-            total_loss += batch_mean_loss * len(batch_data[-1])
-        return {'loss':total_loss/len(dataset)}
+            total_loss += self.criterion(outputs, batch_data[-1]).double() * len(batch_data[-1])
+        return {'loss':total_loss.item()/len(dataset)}
 
     def data_to_device(self, data):
         return data[0].to(self.device), data[1].to(self.device), data[2].to(self.device)
@@ -281,14 +281,11 @@ class TaskCalculator(BasicTaskCalculator):
     @torch.no_grad()
     def test(self, model, dataset, batch_size=64, num_workers=0):
         model.eval()
-        data_loader = self.DataLoader(dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-        ave_loss = 0
-        for batch_idx, batch_data in enumerate(data_loader):
-            tdata = self.data_to_device(batch_data)
+        ave_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        for tdata in self.get_eval_batches(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers):
             outputs = model(tdata, self.batches_seen, training=False)
-            loss = self.criterion(outputs, tdata[self.label_index]).cpu().detach().numpy()
-            ave_loss += loss*len(tdata[self.label_index])
-        ave_loss/=len(dataset)
+            ave_loss += self.criterion(outputs, tdata[self.label_index]).double() * len(tdata[self.label_index])
+        ave_loss = ave_loss.item() / len(dataset)
         return {'loss': ave_loss}
 
     def data_to_device(self, data):
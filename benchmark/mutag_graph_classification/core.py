@@ -317,18 +317,14 @@ class TaskCalculator(BasicTaskCalculator):
         """
         model.eval()
         if batch_size == -1: batch_size = len(dataset)
-        data_loader = self.get_data_loader(dataset, batch_size=batch_size, num_workers=num_workers)
-        total_loss = 0.0
-        num_correct = 0
-        for batch_id, batch_data in enumerate(data_loader):
-            batch_data = self.data_to_device(batch_data)
+        total_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        num_correct = torch.zeros((), dtype=torch.long, device=self.device)
+        for batch_data in self.get_eval_batches(dataset, batch_size=batch_size, num_workers=num_workers):
             outputs = model(batch_data)
-            batch_mean_loss = self.criterion(outputs, batch_data.y).item()
+            total_loss += self.criterion(outputs, batch_data.y).double() * len(batch_data.y)
             y_pred = outputs.argmax(dim=1)
-            correct = int((y_pred == batch_data.y).sum())
-            num_correct += correct
-            total_loss += batch_mean_loss * len(batch_data.y)
-        return {'accuracy': 1.0 * num_correct / len(dataset), 'loss': total_loss / len(dataset)}
+            num_correct += (y_pred == batch_data.y).sum()
+        return {'accuracy': 1.0 * num_correct.item() / len(dataset), 'loss': total_loss.item() / len(dataset)}
 
     def data_to_device(self, data):
         return data.to(self.device)
@@ -40,7 +40,7 @@ The details of this dataset is described as below:
     IID or (alpha, beta) in {(0,0), (0.5, 0.5), (1, 1)}.
 """
 from benchmark.toolkits import BasicTaskGen
-from benchmark.toolkits import XYTaskPipe
+from benchmark.toolkits import XYTaskPipe, BinaryXYTaskPipe
 from benchmark.toolkits import ClassificationCalculator as TaskCalculator
 import numpy as np
 import os.path
@@ -69,6 +69,9 @@ class TaskGen(BasicTaskGen):
         else:
             print("Task Already Exists.")
             return
+        if self.binary:
+            self.save_binary()
+            return
 
         xs, ys, optimals = self.gen_data(self.num_clients)
         x_trains = [di[:int(0.75 * len(di))] for di in xs]
@@ -109,7 +112,39 @@ class TaskGen(BasicTaskGen):
         sum_ex = np.sum(np.exp(x))
         return ex / sum_ex
 
+    def save_binary(self):
+        """Generate the data client by client and write it into the binary format of BinaryXYTaskPipe"""
+        W, b, V, Sigma, samples_per_user = self.gen_params(self.num_clients)
+        self.cnames = self.get_client_names()
+        split_sizes = []
+        for n in samples_per_user:
+            n_train, n_train_valid = int(0.75 * n), int(0.90 * n)
+            split_sizes.append((n_train, n_train_valid - n_train, n - n_train_valid))
+        client_datas = (self.gen_client_data(k, W, b, V, Sigma, samples_per_user) for k in range(self.num_clients))
+        client_info = {self.cnames[k]: {'optimal': np.concatenate((W[k], b[k].reshape(1, b[k].shape[0])), axis=0).tolist()} for k in range(self.num_clients)}
+        BinaryXYTaskPipe.write_stream(self.taskpath, self.cnames, split_sizes, client_datas, (self.dimension,), client_info=client_info)
+
     def gen_data(self, num_clients):
+        W, b, V, Sigma, samples_per_user = self.gen_params(num_clients)
+        X_split = [[] for _ in range(num_clients)]
+        y_split = [[] for _ in range(num_clients)]
+        optimal_local = [np.concatenate((wk,bk.reshape(1, bk.shape[0])), axis=0).tolist() for wk, bk in zip(W, b)]
+        for k in range(num_clients):
+            X_k, Y_k = self.gen_client_data(k, W, b, V, Sigma, samples_per_user)
+            X_split[k] = X_k.tolist()
+            y_split[k] = Y_k.tolist()
+        return X_split, y_split, optimal_local
+
+    def gen_client_data(self, k, W, b, V, Sigma, samples_per_user):
+        """Generate the local data of client k, whose labels are computed by one matrix multiplication"""
+        # X_ki~N(v_k, Sigma)
+        X_k = np.random.multivariate_normal(V[k], Sigma, samples_per_user[k])
+        # Y_ki = argmax(softmax(W_k x_ki + b_k)) = argmax(W_k x_ki + b_k)
+        Y_k = np.argmax(X_k.dot(W[k]) + b[k], axis=1).astype(int)
+        return X_k, Y_k
+
+    def gen_params(self, num_clients):
+        """Generate the local models, the centers of the local features and the local data sizes of the clients"""
         self.dimension = 60
         # global variables
         W_global = np.random.normal(0, 1, (self.dimension, self.num_classes))
@@ -169,26 +204,13 @@ class TaskGen(BasicTaskGen):
             for k in range(num_clients): V[k] = np.random.normal(B[k], 1, self.dimension)
             samples_per_user = np.random.lognormal(4, 2, (num_clients)).astype(int) + self.minvol
 
-        X_split = [[] for _ in range(num_clients)]
-        y_split = [[] for _ in range(num_clients)]
-        optimal_local = [np.concatenate((wk,bk.reshape(1, bk.shape[0])), axis=0).tolist() for wk, bk in zip(W, b)]
-
-        for k in range(num_clients):
-            # X_ki~N(v_k, Sigma)
-            X_k = np.random.multivariate_normal(V[k], Sigma, samples_per_user[k])
-            Y_k = np.zeros(samples_per_user[k], dtype=int)
-            for i in range(samples_per_user[k]):
-                # Y_ki = argmax(softmax(W_k x_ki + b_k))
-                tmp = np.dot(X_k[i], W[k]) + b[k]
-                Y_k[i] = np.argmax(self.softmax(tmp))
-            X_split[k] = X_k.tolist()
-            y_split[k] = Y_k.tolist()
-        return X_split, y_split, optimal_local
+        return W, b, V, Sigma, samples_per_user
 
 
 class TaskPipe(XYTaskPipe):
     @classmethod
-    def load_task(cls, task_path):
+    def load_task(cls, task_path, data_path=None):
+        if BinaryXYTaskPipe.exists(task_path): return cls.load_binary_task(task_path, data_path)
         with open(os.path.join(task_path, 'data.json'), 'r') as inf:
             feddata = ujson.load(inf)
         test_data = cls.TaskDataset(feddata['dtest']['x'], feddata['dtest']['y'])
@@ -24,13 +24,18 @@ import os.path
 import random
 import os
 import ssl
-from torch.utils.data import Dataset, DataLoader, TensorDataset, Subset
+import math
+from torch.utils.data import Dataset, DataLoader, TensorDataset, Subset, ConcatDataset
 import torch
 ssl._create_default_https_context = ssl._create_unverified_context
 import importlib
 import collections
+import functools
+import hashlib
+import weakref
 from torchvision import datasets, transforms
 import utils.fmodule
+import utils.loader_pool
 
 # ========================================Task Generator============================================
 # This part is for generating federated dataset from original dataset. The generation process should be
@@ -78,6 +83,8 @@ class BasicTaskGen:
         self.num_clients = -1
         self.local_holdout_rate = local_hld_rate
         self.seed = seed
+        # whether to store the task in the binary format of BinaryXYTaskPipe, which is supported by the synthetic benchmarks
+        self.binary = False
         self.set_random_seed(self.seed)
 
     def run(self, *args, **kwargs):
@@ -173,6 +180,11 @@ class DefaultTaskGen(BasicTaskGen):
         print('Loading...')
         self.load_data()
         print('Done.')
+        self.generate()
+        return
+
+    def generate(self):
+        """Generate the federated task from the loaded data (i.e. self.train_data and self.test_data)"""
         # partition data and hold-out for each local dataset
         print('-----------------------------------------------------')
         print('Partitioning data...')
@@ -210,17 +222,17 @@ class DefaultTaskGen(BasicTaskGen):
 
         elif self.dist_id == 1:
             """label_skew_quantity"""
-            dpairs = [[did, self.train_data[did][-1]] for did in range(len(self.train_data))]
+            lb_idxs = self.get_label_indices(self.get_labels())
             num = max(int((1-self.skewness)*self.num_classes), 1)
             K = self.num_classes
             local_datas = [[] for _ in range(self.num_clients)]
             if num == K:
                 for k in range(K):
-                    idx_k = [p[0] for p in dpairs if p[1]==k]
+                    idx_k = lb_idxs.get(k, np.zeros(0, dtype=np.int64)).copy()
                     np.random.shuffle(idx_k)
                     split = np.array_split(idx_k, self.num_clients)
                     for cid in range(self.num_clients):
-                        local_datas[cid].extend(split[cid].tolist())
+                        local_datas[cid].append(split[cid])
             else:
                 times = [0 for _ in range(self.num_classes)]
                 contain = []
@@ -236,14 +248,15 @@ class DefaultTaskGen(BasicTaskGen):
                             times[ind] += 1
                     contain.append(current)
                 for k in range(K):
-                    idx_k = [p[0] for p in dpairs if p[1]==k]
+                    idx_k = lb_idxs.get(k, np.zeros(0, dtype=np.int64)).copy()
                     np.random.shuffle(idx_k)
                     split = np.array_split(idx_k, times[k])
                     ids = 0
                     for cid in range(self.num_clients):
                         if k in contain[cid]:
-                            local_datas[cid].extend(split[ids].tolist())
+                            local_datas[cid].append(split[ids])
                             ids += 1
+            local_datas = [np.concatenate(local_data).tolist() if len(local_data) > 0 else [] for local_data in local_datas]
 
         elif self.dist_id == 2:
             """label_skew_dirichlet"""
@@ -251,72 +264,27 @@ class DefaultTaskGen(BasicTaskGen):
             MIN_ALPHA = 0.01
             alpha = (-4*np.log(self.skewness + 10e-8))**4
             alpha = max(alpha, MIN_ALPHA)
-            labels = [self.train_data[did][-1] for did in range(len(self.train_data))]
-            lb_counter = collections.Counter(labels)
-            p = np.array([1.0*v/len(self.train_data) for v in lb_counter.values()])
-            lb_dict = {}
-            labels = np.array(labels)
-            for lb in range(len(lb_counter.keys())):
-                lb_dict[lb] = np.where(labels==lb)[0]
-            proportions = [np.random.dirichlet(alpha*p) for _ in range(self.num_clients)]
-            while np.any(np.isnan(proportions)):
-                proportions = [np.random.dirichlet(alpha * p) for _ in range(self.num_clients)]
-            while True:
-                # generate dirichlet distribution till ||E(proportion) - P(D)||<=1e-5*self.num_classes
-                mean_prop = np.mean(proportions, axis=0)
-                error_norm = ((mean_prop-p)**2).sum()
-                print("Error: {:.8f}".format(error_norm))
-                if error_norm<=1e-2/self.num_classes:
-                    break
-                exclude_norms = []
-                for cid in range(self.num_clients):
-                    mean_excid = (mean_prop*self.num_clients-proportions[cid])/(self.num_clients-1)
-                    error_excid = ((mean_excid-p)**2).sum()
-                    exclude_norms.append(error_excid)
-                excid = np.argmin(exclude_norms)
-                sup_prop = [np.random.dirichlet(alpha*p) for _ in range(self.num_clients)]
-                alter_norms = []
-                for cid in range(self.num_clients):
-                    if np.any(np.isnan(sup_prop[cid])):
-                        continue
-                    mean_alter_cid = mean_prop - proportions[excid]/self.num_clients + sup_prop[cid]/self.num_clients
-                    error_alter = ((mean_alter_cid-p)**2).sum()
-                    alter_norms.append(error_alter)
-                if len(alter_norms)>0:
-                    alcid = np.argmin(alter_norms)
-                    proportions[excid] = sup_prop[alcid]
-            local_datas = [[] for _ in range(self.num_clients)]
-            self.dirichlet_dist = [] # for efficiently visualizing
-            for lb in lb_counter.keys():
-                lb_idxs = lb_dict[lb]
-                lb_proportion = np.array([pi[lb] for pi in proportions])
-                lb_proportion = lb_proportion/lb_proportion.sum()
-                lb_proportion = (np.cumsum(lb_proportion) * len(lb_idxs)).astype(int)[:-1]
-                lb_datas = np.split(lb_idxs, lb_proportion)
-                self.dirichlet_dist.append([len(lb_data) for lb_data in lb_datas])
-                local_datas = [local_data+lb_data.tolist() for local_data,lb_data in zip(local_datas, lb_datas)]
-            self.dirichlet_dist = np.array(self.dirichlet_dist).T
-            for i in range(self.num_clients):
-                np.random.shuffle(local_datas[i])
+            lb_dict = self.get_label_indices(self.get_labels())
+            # each client owns the same number of samples
+            proportions = self.sample_dirichlet_proportions(alpha, lb_dict, np.full(self.num_clients, len(self.train_data) / self.num_clients))
+            local_datas = self.split_labels_by_proportions(lb_dict, proportions)
 
         elif self.dist_id == 3:
             """label_skew_shard"""
-            dpairs = [[did, self.train_data[did][-1]] for did in range(len(self.train_data))]
             self.skewness = min(max(0, self.skewness), 1.0)
             num_shards = max(int((1 - self.skewness) * self.num_classes * 2), 1)
             client_datasize = int(len(self.train_data) / self.num_clients)
-            all_idxs = [i for i in range(len(self.train_data))]
-            z = zip([p[1] for p in dpairs], all_idxs)
-            z = sorted(z)
-            labels, all_idxs = zip(*z)
+            # the indices sorted by the labels, where the indices of the same label are in the ascending order
+            all_idxs = np.argsort(self.get_labels(), kind='stable')
             shardsize = int(client_datasize / num_shards)
             idxs_shard = range(int(self.num_clients * num_shards))
-            local_datas = [[] for i in range(self.num_clients)]
+            local_datas = []
             for i in range(self.num_clients):
                 rand_set = set(np.random.choice(idxs_shard, num_shards, replace=False))
                 idxs_shard = list(set(idxs_shard) - rand_set)
-                for rand in rand_set:
-                    local_datas[i].extend(all_idxs[rand * shardsize:(rand + 1) * shardsize])
+                # the shards are contiguous slices of all_idxs, which are gathered by one indexing
+                shard_ids = np.fromiter(rand_set, dtype=np.int64, count=len(rand_set))
+                local_datas.append(all_idxs[(shard_ids[:, None] * shardsize + np.arange(shardsize)).reshape(-1)].tolist())
 
         elif self.dist_id == 4:
             """label_skew_dirichlet with imbalance data size. The data"""
@@ -358,64 +326,9 @@ class DefaultTaskGen(BasicTaskGen):
                     minid = np.argmin(samples_per_client)
                     samples_per_client[minid] += (total_data_size - crt_data_size)
                 crt_data_size = sum(samples_per_client)
-            # count the label distribution
-            labels = [self.train_data[did][-1] for did in range(len(self.train_data))]
-            lb_counter = collections.Counter(labels)
-            p = np.array([1.0 * v / len(self.train_data) for v in lb_counter.values()])
-            lb_dict = {}
-            labels = np.array(labels)
-            for lb in range(len(lb_counter.keys())):
-                lb_dict[lb] = np.where(labels == lb)[0]
-            proportions = [np.random.dirichlet(alpha * p) for _ in range(self.num_clients)]
-            while np.any(np.isnan(proportions)):
-                proportions = [np.random.dirichlet(alpha * p) for _ in range(self.num_clients)]
-            sorted_cid_map = {k:i for k,i in zip(np.argsort(samples_per_client), [_ for _ in range(self.num_clients)])}
-            error_increase_interval = 5000
-            max_error = 1e-2 / self.num_classes
-            loop_count = 0
-            crt_id = 0
-            while True:
-                if loop_count >= error_increase_interval:
-                    loop_count = 0
-                    max_error = max_error * 10
-                # generate dirichlet distribution till ||E(proportion) - P(D)||<=1e-5*self.num_classes
-                mean_prop = np.sum([pi*di for pi,di in zip(proportions, samples_per_client)], axis=0)
-                mean_prop = mean_prop/mean_prop.sum()
-                error_norm = ((mean_prop - p) ** 2).sum()
-                print("Error: {:.8f}".format(error_norm))
-                if error_norm <= max_error:
-                    break
-                excid = sorted_cid_map[crt_id]
-                crt_id = (crt_id+1)%self.num_clients
-                sup_prop = [np.random.dirichlet(alpha * p) for _ in range(self.num_clients)]
-                del_prop = np.sum([pi * di for pi, di in zip(proportions, samples_per_client)], axis=0)
-                del_prop -= samples_per_client[excid]*proportions[excid]
-                alter_norms = []
-                for cid in range(self.num_clients):
-                    if np.any(np.isnan(sup_prop[cid])):
-                        continue
-                    alter_prop = del_prop + samples_per_client[excid]*sup_prop[cid]
-                    alter_prop = alter_prop/alter_prop.sum()
-                    error_alter = ((alter_prop - p) ** 2).sum()
-                    alter_norms.append(error_alter)
-                if len(alter_norms) > 0:
-                    alcid = np.argmin(alter_norms)
-                    proportions[excid] = sup_prop[alcid]
-                loop_count += 1
-            local_datas = [[] for _ in range(self.num_clients)]
-            self.dirichlet_dist = []  # for efficiently visualizing
-            for lb in lb_counter.keys():
-                lb_idxs = lb_dict[lb]
-                lb_proportion = np.array([pi[lb]*si for pi,si in zip(proportions, samples_per_client)])
-                lb_proportion = lb_proportion / lb_proportion.sum()
-                lb_proportion = (np.cumsum(lb_proportion) * len(lb_idxs)).astype(int)[:-1]
-                lb_datas = np.split(lb_idxs, lb_proportion)
-                self.dirichlet_dist.append([len(lb_data) for lb_data in lb_datas])
-                local_datas = [local_data + lb_data.tolist() for local_data, lb_data in zip(local_datas, lb_datas)]
-            self.dirichlet_dist = np.array(self.dirichlet_dist).T
-            for i in range(self.num_clients):
-                np.random.shuffle(local_datas[i])
-
+            lb_dict = self.get_label_indices(self.get_labels())
+            proportions = self.sample_dirichlet_proportions(alpha, lb_dict, samples_per_client)
+            local_datas = self.split_labels_by_proportions(lb_dict, proportions)
         elif self.dist_id == 5:
             """feature_skew_id"""
             if not isinstance(self.train_data, TupleDataset):
@@ -438,6 +351,98 @@ class DefaultTaskGen(BasicTaskGen):
             local_datas = [local_data.tolist() for local_data in local_datas]
         return local_datas
 
+    def get_labels(self):
+        """
+        Return the labels of self.train_data as an array. The labels are read from the dataset at once
+        (e.g. the targets of torchvision datasets) when possible instead of reading each item, which
+        would load and transform every image only to get its label.
+        """
+        data = self.train_data
+        # the labels of the same dataset are only read once (e.g. when they are shared by the tasks generated in batch)
+        if getattr(self, '_labels', None) is not None and self._labels[0] is data: return self._labels[1]
+        labels = self._read_labels(data)
+        self._labels = (data, labels)
+        return labels
+
+    def _read_labels(self, data):
+        if getattr(data, 'target_transform', None) is None:
+            for attr in ['targets', 'Y']:
+                labels = getattr(data, attr, None)
+                if labels is not None and len(labels) == len(data): return np.asarray(labels)
+        if isinstance(data, TensorDataset): return data.tensors[-1].numpy()
+        return np.array([data[did][-1] for did in range(len(data))])
+
+    def get_label_indices(self, labels):
+        """
+        Group the indices of the data by their labels
+        :param labels: the array of the labels
+        :return: the dict {label: the array of the indices of the label in the ascending order}, whose keys are in the order of their first occurrences in labels
+        """
+        uniques, first_ids, counts = np.unique(labels, return_index=True, return_counts=True)
+        # the indices sorted by the labels are split into groups of the labels
+        groups = np.split(np.argsort(labels, kind='stable'), np.cumsum(counts)[:-1])
+        return {uniques[k].item(): groups[k] for k in np.argsort(first_ids)}
+
+    def sample_dirichlet_proportions(self, alpha, lb_dict, sizes, max_iters=1000, tol=1e-8):
+        """
+        Sample the numbers of the samples of each label owned by each client, where the label distribution of
+        each client follows Dir(alpha * p) and p is the label distribution of the whole dataset. The sampled
+        distributions are rescaled by iterative proportional fitting (i.e. Sinkhorn scaling) such that each
+        client owns sizes[i] samples and each label is fully assigned, so the global label distribution is
+        reached by construction and the running time is bounded.
+        :param alpha: the concentration of the Dirichlet distribution
+        :param lb_dict: the dict {label: the array of the indices of the label}
+        :param sizes: the number of the samples of each client
+        :param max_iters: the maximum number of the iterations of the scaling
+        :param tol: the tolerance of the relative error of the sums of the rows and the columns
+        :return: the array of the shape (num_clients, num_labels), whose [i, label] is the expected number of the samples of the label owned by client i
+        """
+        num_labels = max(lb_dict.keys()) + 1
+        label_sizes = np.zeros(num_labels)
+        for lb, lb_idxs in lb_dict.items(): label_sizes[lb] = len(lb_idxs)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        sizes = sizes * label_sizes.sum() / sizes.sum()
+        p = label_sizes / label_sizes.sum()
+        # the labels that do not exist keep zero concentration and are excluded from the sampling
+        exist = p > 0
+        proportions = np.zeros((self.num_clients, num_labels))
+        proportions[:, exist] = np.random.dirichlet(alpha * p[exist], self.num_clients)
+        nan_rows = np.isnan(proportions).any(axis=1)
+        while nan_rows.any():
+            proportions[np.ix_(nan_rows, exist)] = np.random.dirichlet(alpha * p[exist], int(nan_rows.sum()))
+            nan_rows = np.isnan(proportions).any(axis=1)
+        # a tiny mass keeps the scaling feasible when no client draws a label
+        res = (proportions + 1e-12 * exist) * sizes.reshape(-1, 1)
+        for _ in range(max_iters):
+            res *= (label_sizes / res.sum(axis=0).clip(min=1e-300)).reshape(1, -1)
+            row_sums = res.sum(axis=1)
+            res *= (sizes / row_sums).reshape(-1, 1)
+            if np.abs(row_sums - sizes).max() <= tol * sizes.max() and np.abs(res.sum(axis=0) - label_sizes).max() <= tol * label_sizes.max():
+                break
+        return res
+
+    def split_labels_by_proportions(self, lb_dict, proportions):
+        """
+        Split the indices of each label among the clients in proportion to proportions[:, label] and shuffle each local dataset
+        :param lb_dict: the dict {label: the array of the indices of the label}
+        :param proportions: the array of the shape (num_clients, num_labels)
+        :return: the list of the indices of each client
+        """
+        local_datas = [[] for _ in range(self.num_clients)]
+        self.dirichlet_dist = [] # for efficiently visualizing
+        for lb, lb_idxs in lb_dict.items():
+            lb_proportion = proportions[:, lb]
+            lb_proportion = lb_proportion/lb_proportion.sum()
+            lb_proportion = (np.cumsum(lb_proportion) * len(lb_idxs)).astype(int)[:-1]
+            lb_datas = np.split(lb_idxs, lb_proportion)
+            self.dirichlet_dist.append([len(lb_data) for lb_data in lb_datas])
+            for local_data, lb_data in zip(local_datas, lb_datas): local_data.append(lb_data)
+        self.dirichlet_dist = np.array(self.dirichlet_dist).T
+        local_datas = [np.concatenate(local_data) for local_data in local_datas]
+        for i in range(self.num_clients):
+            np.random.shuffle(local_datas[i])
+        return [local_data.tolist() for local_data in local_datas]
+
     def local_holdout(self, local_datas, shuffle=False):
         """split each local dataset into train data and valid data according the rate."""
         train_cidxs = []
@@ -478,9 +483,9 @@ class DefaultTaskGen(BasicTaskGen):
         else:
             data_columns = [len(cidx) for cidx in train_cidxs]
             row_map = {k:i for k,i in zip(np.argsort(data_columns), [_ for _ in range(self.num_clients)])}
+            all_labels = self.get_labels()
             for cid, cidxs in enumerate(train_cidxs):
-                labels = [int(self.train_data[did][-1]) for did in cidxs]
-                lb_counter = collections.Counter(labels)
+                lb_counter = collections.Counter(all_labels[cidxs].tolist())
                 offset = 0
                 y_bottom = row_map[cid] - client_height/2.0
                 y_top = row_map[cid] + client_height/2.0
@@ -508,6 +513,13 @@ class DefaultTaskGen(BasicTaskGen):
 # The same as TaskGenerator, we provide a default task calculator ClassifyCalculator that is suitable for datasets
 # like MNIST, CIFAR100.
 class BasicTaskCalculator:
+    # whether the evaluation sets are preloaded on the devices once (see get_eval_batches)
+    _preload_eval = False
+    # the LRU cache of the preloaded batches of the evaluation sets, which is shared by the calculators of the server
+    # and the clients and keeps at most _max_eval_datasets datasets (0 means no limit)
+    _eval_batches = collections.OrderedDict()
+    _max_eval_datasets = 0
+
     def __init__(self, device, optimizer_name='sgd'):
         self.device = device
         self.optimizer_name = optimizer_name
@@ -529,6 +541,32 @@ class BasicTaskCalculator:
     def test(self, *args, **kwargs):
         raise NotImplementedError
 
+    def get_eval_batches(self, dataset, batch_size=64, shuffle=True, num_workers=0):
+        """
+        Return the batches on the device to evaluate the model on the dataset. If the evaluation sets are
+        preloaded, the batches are loaded in a fixed order once and kept on the device for all the later
+        evaluations on the same dataset, else they are loaded by a new data loader at each call.
+        :param dataset: the dataset to be evaluated on
+        :param batch_size: the batch size
+        :param shuffle: whether to shuffle the items when the batches are not preloaded
+        :param num_workers: the number of the workers of the data loader
+        :return: an iterable of the batches that have been moved to the device
+        """
+        if not self._preload_eval:
+            return (self.data_to_device(batch_data) for batch_data in self.get_data_loader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers))
+        cache = BasicTaskCalculator._eval_batches
+        key = (id(dataset), batch_size, str(self.device))
+        if key in cache and cache[key][0]() is dataset:
+            cache.move_to_end(key)
+            return cache[key][1]
+        data_loader = self.get_data_loader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        batches = [self.data_to_device(batch_data) for batch_data in data_loader]
+        # the dataset is weakly referenced, so its batches are dropped with it and its id is not reused by another dataset
+        cache[key] = (weakref.ref(dataset, lambda ref: cache.pop(key, None) if key in cache and cache[key][0] is ref else None), batches)
+        while self._max_eval_datasets > 0 and len(cache) > self._max_eval_datasets:
+            cache.popitem(last=False)
+        return batches
+
     def get_optimizer(self, model=None, lr=0.1, weight_decay=0, momentum=0):
         # if self._OPTIM == None:
         #     raise RuntimeError("TaskCalculator._OPTIM Not Initialized.")
@@ -545,6 +583,12 @@ class BasicTaskCalculator:
     def setOP(cls, OP):
         cls._OPTIM = OP
 
+    @classmethod
+    def set_option(cls, preload_eval=False, max_eval_datasets=0):
+        BasicTaskCalculator._preload_eval = preload_eval
+        BasicTaskCalculator._max_eval_datasets = max_eval_datasets
+        BasicTaskCalculator._eval_batches.clear()
+
 class ClassificationCalculator(BasicTaskCalculator):
     def __init__(self, device, optimizer_name='sgd'):
         super(ClassificationCalculator, self).__init__(device, optimizer_name)
@@ -563,28 +607,33 @@ class ClassificationCalculator(BasicTaskCalculator):
         return {'loss': loss}
 
     @torch.no_grad()
-    def test(self, model, dataset, batch_size=64, num_workers=0):
+    def test(self, model, dataset, batch_size=64, num_workers=0, confusion_matrix=False):
         """
         Metric = [mean_accuracy, mean_loss]
         :param model:
         :param dataset:
         :param batch_size:
+        :param confusion_matrix: whether to return the confusion matrix whose rows are the true labels and columns are the predicted labels
         :return: [mean_accuracy, mean_loss]
         """
         model.eval()
         if batch_size==-1:batch_size=len(dataset)
-        data_loader = self.get_data_loader(dataset, batch_size=batch_size, num_workers=num_workers)
-        total_loss = 0.0
-        num_correct = 0
-        for batch_id, batch_data in enumerate(data_loader):
-            batch_data = self.data_to_device(batch_data)
+        # the metrics are accumulated on the device and synchronized once at the end
+        total_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        num_correct = torch.zeros((), dtype=torch.long, device=self.device)
+        matrix = None
+        for batch_data in self.get_eval_batches(dataset, batch_size=batch_size, num_workers=num_workers):
             outputs = model(batch_data[0])
-            batch_mean_loss = self.criterion(outputs, batch_data[-1]).item()
+            total_loss += self.criterion(outputs, batch_data[-1]).double() * len(batch_data[-1])
             y_pred = outputs.data.max(1, keepdim=True)[1]
-            correct = y_pred.eq(batch_data[-1].data.view_as(y_pred)).long().cpu().sum()
-            num_correct += correct.item()
-            total_loss += batch_mean_loss * len(batch_data[-1])
-        return {'accuracy': 1.0*num_correct/len(dataset), 'loss':total_loss/len(dataset)}
+            num_correct += y_pred.eq(batch_data[-1].data.view_as(y_pred)).long().sum()
+            if confusion_matrix:
+                num_classes = outputs.shape[1]
+                if matrix is None: matrix = torch.zeros(num_classes * num_classes, dtype=torch.long, device=self.device)
+                matrix += torch.bincount(batch_data[-1].view(-1).long() * num_classes + y_pred.view(-1), minlength=num_classes * num_classes)
+        res = {'accuracy': 1.0*num_correct.item()/len(dataset), 'loss':total_loss.item()/len(dataset)}
+        if confusion_matrix: res['confusion_matrix'] = matrix.view(num_classes, num_classes).tolist() if matrix is not None else []
+        return res
 
     def data_to_device(self, data):
         return data[0].to(self.device), data[1].to(self.device)
@@ -592,6 +641,13 @@ class ClassificationCalculator(BasicTaskCalculator):
     def get_data_loader(self, dataset, batch_size=64, shuffle=True, num_workers=0):
         if self.DataLoader == None:
             raise NotImplementedError("DataLoader Not Found.")
+        if num_workers == 0:
+            # the in-memory tensor datasets are loaded by gathering each batch at once
+            gather = batch_gather(dataset)
+            if gather is not None: return TensorBatchLoader(gather, len(dataset), batch_size=batch_size, shuffle=shuffle)
+        elif utils.loader_pool.service is not None and utils.loader_pool.service.key_of(dataset) is not None:
+            # the local datasets are loaded by the persistent processes instead of forking new workers at each epoch
+            return utils.loader_pool.service.loader(dataset, batch_size=batch_size, shuffle=shuffle)
         return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
 
 # =====================================TaskPipe======================================================
@@ -622,6 +678,10 @@ class BasicTaskPipe:
     TaskDataset = None
     _cross_validation = False
     _train_on_all = False
+    # the maximum number of the local datasets kept in memory by the pipes that load the local datasets lazily (0 for loading all of them)
+    _max_cached_datasets = 0
+    # the dtype of the pre-transformed tensors of the original datasets cached by IDXTaskPipe ('none' for no cache)
+    _tensor_cache = 'none'
     @classmethod
     def load_task(cls, task_path, data_path=None):
         """
@@ -640,9 +700,75 @@ class BasicTaskPipe:
         raise NotImplementedError
 
     @classmethod
-    def set_option(cls, cross_validation, train_on_all):
+    def set_option(cls, cross_validation, train_on_all, max_cached_datasets=0, tensor_cache='none'):
         cls._cross_validation = cross_validation
         cls._train_on_all = train_on_all
+        cls._max_cached_datasets = max_cached_datasets
+        cls._tensor_cache = tensor_cache
+        dataset_cache.max_size = max_cached_datasets
+
+class DatasetCache:
+    def __init__(self, max_size=0):
+        """
+        The LRU cache of the local datasets that are materialized by LazyDataset
+        :param max_size: the maximum number of the datasets kept in the cache, where 0 means no limit
+        """
+        self.max_size = max_size
+        self.datasets = collections.OrderedDict()
+
+    def get(self, lazy_dataset):
+        """Return the dataset of the LazyDataset, which is built if it is not in the cache and evicts the least recently used datasets"""
+        if lazy_dataset in self.datasets:
+            self.datasets.move_to_end(lazy_dataset)
+            return self.datasets[lazy_dataset]
+        res = lazy_dataset.builder()
+        self.datasets[lazy_dataset] = res
+        while self.max_size > 0 and len(self.datasets) > self.max_size:
+            self.datasets.popitem(last=False)
+        return res
+
+    def clear(self):
+        self.datasets.clear()
+
+    def __len__(self):
+        return len(self.datasets)
+
+# the cache shared by all the LazyDatasets in this process
+dataset_cache = DatasetCache()
+
+class LazyDataset(Dataset):
+    def __init__(self, builder, length):
+        """
+        The local dataset that is only materialized by builder() when it is accessed and is kept in
+        dataset_cache until it is evicted, after which it will be built again at the next access. The
+        length is known in advance, so len() (e.g. the data volume of the client for sampling) never
+        materializes the dataset. The other attributes are those of the materialized dataset.
+        Args:
+            builder: the function that builds the dataset from the disk, which should give the same data at each call
+            length: the length of the dataset
+        """
+        self.builder = builder
+        self.length = length
+
+    @property
+    def dataset(self):
+        return dataset_cache.get(self)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        return self.dataset[item]
+
+    def __getitems__(self, items):
+        dataset = self.dataset
+        if hasattr(dataset, '__getitems__'): return dataset.__getitems__(items)
+        return [dataset[item] for item in items]
+
+    def __getattr__(self, name):
+        # only called for the attributes that are not of the LazyDataset itself
+        if name.startswith('__') or name in ['builder', 'length']: raise AttributeError(name)
+        return getattr(self.dataset, name)
 
 class XYTaskPipe(BasicTaskPipe):
     class XYDataset(Dataset):
@@ -666,7 +792,8 @@ class XYTaskPipe(BasicTaskPipe):
             else:
                 self.X = X
                 self.Y = Y
-            self.all_labels = list(set(self.tolist()[1]))
+            # only the labels are converted into a list, which avoids copying the features
+            self.all_labels = list(set(self.Y.tolist() if isinstance(self.Y, torch.Tensor) else self.Y))
 
         def __len__(self):
             return len(self.Y)
@@ -717,8 +844,15 @@ class XYTaskPipe(BasicTaskPipe):
         with open(os.path.join(generator.taskpath, 'data.json'), 'w') as outf:
             ujson.dump(feddata, outf)
 
+    @classmethod
+    def load_binary_task(cls, task_path, data_path=None):
+        """Load the task stored by BinaryXYTaskPipe under the options of this pipe"""
+        BinaryXYTaskPipe.set_option(cls._cross_validation, cls._train_on_all, cls._max_cached_datasets)
+        return BinaryXYTaskPipe.load_task(task_path, data_path)
+
     @classmethod
     def load_task(cls, task_path, data_path=None):
+        if BinaryXYTaskPipe.exists(task_path): return cls.load_binary_task(task_path, data_path)
         with open(os.path.join(task_path, 'data.json'), 'r') as inf:
             feddata = ujson.load(inf)
         test_data = cls.TaskDataset(feddata['dtest']['x'], feddata['dtest']['y'])
@@ -745,6 +879,172 @@ class XYTaskPipe(BasicTaskPipe):
         # valid_datas = [cls.TaskDataset(feddata[name]['dvalid']['x'], feddata[name]['dvalid']['y']) for name in feddata['client_names']]
         return train_datas, valid_datas, test_data, feddata['client_names']
 
+class BinaryXYTaskPipe(XYTaskPipe):
+    """
+    The binary format of the XY fedtask, where the features and the labels of each split are stored as
+    the arrays train_x.npy, train_y.npy, valid_x.npy, valid_y.npy, test_x.npy and test_y.npy, in which
+    the rows of the clients are contiguous, and the small index file data_bin.json keeps the names of the
+    clients, the offsets of their rows in each split and the other information of the clients (e.g. the
+    optimal models of synthetic tasks). The arrays are memory-mapped when loading and each local dataset
+    is a view of the rows of the client (i.e. torch.from_numpy on the mapped array), so loading the task
+    costs almost nothing no matter how many clients there are, and the pages are only read when used.
+    A task in data.json is converted into this format by BinaryXYTaskPipe.convert (see convert_fedtask.py),
+    and XYTaskPipe.load_task reads the binary format when it exists.
+    """
+    index_file = 'data_bin.json'
+    splits = ['train', 'valid', 'test']
+
+    @classmethod
+    def exists(cls, task_path):
+        return os.path.exists(os.path.join(task_path, cls.index_file))
+
+    @classmethod
+    def save_task(cls, generator):
+        """
+        Store the fedtask in the binary format. The input 'generator' must have the same attributes as that of XYTaskPipe.save_task
+        """
+        train_x, train_y = np.asarray(generator.train_data['x']), np.asarray(generator.train_data['y'])
+        cls.write(generator.taskpath, generator.cnames,
+                  [(train_x[cidxs], train_y[cidxs]) for cidxs in generator.train_cidxs],
+                  [(train_x[cidxs], train_y[cidxs]) for cidxs in generator.valid_cidxs],
+                  (generator.test_data['x'], generator.test_data['y']))
+        return
+
+    @classmethod
+    def write(cls, task_path, client_names, train_datas, valid_datas, test_data, client_info=None):
+        """
+        Write the arrays and the index of the fedtask
+        :param task_path: the path of the fedtask
+        :param client_names: the names of the clients
+        :param train_datas: the list of (x, y) of the local training data of each client
+        :param valid_datas: the list of (x, y) of the local validation data of each client
+        :param test_data: (x, y) of the testing data of the server
+        :param client_info: the dict {client_name: {key: value}} of the other information of the clients that can be dumped into .json
+        """
+        index = {'store': 'BinaryXY', 'client_names': client_names, 'client_info': client_info or {}}
+        for split, datas in zip(cls.splits, [train_datas, valid_datas, [test_data]]):
+            xs, ys = [cls._to_array(d[0]) for d in datas], [cls._to_array(d[1]) for d in datas]
+            index[split + '_offsets'] = np.cumsum([0] + [len(y) for y in ys]).tolist()
+            for name, arrays in zip(['x', 'y'], [xs, ys]):
+                non_empty = [a for a in arrays if len(a) > 0]
+                res = np.concatenate(non_empty) if len(non_empty) > 0 else np.zeros(0, dtype=arrays[0].dtype)
+                np.save(os.path.join(task_path, '{}_{}.npy'.format(split, name)), res)
+        with open(os.path.join(task_path, cls.index_file), 'w') as outf:
+            ujson.dump(index, outf)
+        return
+
+    @classmethod
+    def write_stream(cls, task_path, client_names, split_sizes, client_datas, x_shape, x_dtype=np.float32, y_dtype=np.int64, client_info=None):
+        """
+        Write the fedtask client by client into the preallocated arrays, so the data of all the clients is never kept in memory at once
+        :param task_path: the path of the fedtask
+        :param client_names: the names of the clients
+        :param split_sizes: the list of (the number of the training rows, that of the validation rows, that of the testing rows) of each client
+        :param client_datas: the iterable of (x, y) of each client, whose rows are the training, the validation and the testing rows in order
+        :param x_shape: the shape of one row of x
+        :param x_dtype: the dtype of x
+        :param y_dtype: the dtype of y
+        :param client_info: the dict {client_name: {key: value}} of the other information of the clients that can be dumped into .json
+        """
+        split_sizes = np.array(split_sizes, dtype=np.int64).reshape(-1, 3)
+        index = {'store': 'BinaryXY', 'client_names': client_names, 'client_info': client_info or {}}
+        for j, split in enumerate(['train', 'valid']):
+            index[split + '_offsets'] = np.cumsum([0] + split_sizes[:, j].tolist()).tolist()
+        # the testing rows of all the clients make up the testing data of the server
+        test_offsets = np.cumsum([0] + split_sizes[:, 2].tolist()).tolist()
+        index['test_offsets'] = [0, test_offsets[-1]]
+        offsets = {'train': index['train_offsets'], 'valid': index['valid_offsets'], 'test': test_offsets}
+        arrays = {}
+        for split in cls.splits:
+            arrays[split + '_x'] = np.lib.format.open_memmap(os.path.join(task_path, split + '_x.npy'), mode='w+', dtype=x_dtype, shape=(offsets[split][-1],) + tuple(x_shape))
+            arrays[split + '_y'] = np.lib.format.open_memmap(os.path.join(task_path, split + '_y.npy'), mode='w+', dtype=y_dtype, shape=(offsets[split][-1],))
+        for k, (x, y) in enumerate(client_datas):
+            start = 0
+            for j, split in enumerate(cls.splits):
+                end = start + split_sizes[k, j]
+                arrays[split + '_x'][offsets[split][k]:offsets[split][k + 1]] = x[start:end]
+                arrays[split + '_y'][offsets[split][k]:offsets[split][k + 1]] = y[start:end]
+                start = end
+        for a in arrays.values(): a.flush()
+        del arrays
+        with open(os.path.join(task_path, cls.index_file), 'w') as outf:
+            ujson.dump(index, outf)
+        return
+
+    @classmethod
+    def convert(cls, task_path):
+        """Convert the fedtask stored in data.json by XYTaskPipe into the binary format, where the keys of each client other than 'dtrain' and 'dvalid' are kept as its information"""
+        with open(os.path.join(task_path, 'data.json'), 'r') as inf:
+            feddata = ujson.load(inf)
+        names = feddata['client_names']
+        cls.write(task_path, names,
+                  [(feddata[name]['dtrain']['x'], feddata[name]['dtrain']['y']) for name in names],
+                  [(feddata[name]['dvalid']['x'], feddata[name]['dvalid']['y']) for name in names],
+                  (feddata['dtest']['x'], feddata['dtest']['y']),
+                  {name: {k: v for k, v in feddata[name].items() if k not in ['dtrain', 'dvalid']} for name in names})
+        return
+
+    @classmethod
+    def read_index(cls, task_path):
+        with open(os.path.join(task_path, cls.index_file), 'r') as inf:
+            return ujson.load(inf)
+
+    @classmethod
+    def load_task(cls, task_path, data_path=None):
+        index = cls.read_index(task_path)
+        # copy-on-write mapping gives writable arrays for torch.from_numpy without reading the files
+        arrays = {'{}_{}'.format(split, name): torch.from_numpy(np.load(os.path.join(task_path, '{}_{}.npy'.format(split, name)), mmap_mode='c')) for split in cls.splits for name in ['x', 'y']}
+        def rows(split, k):
+            start, end = index[split + '_offsets'][k], index[split + '_offsets'][k + 1]
+            return arrays[split + '_x'][start:end], arrays[split + '_y'][start:end]
+        lazy = cls._max_cached_datasets > 0
+        def build(k, part, perm=None):
+            train_x, train_y = rows('train', k)
+            valid_x, valid_y = rows('valid', k)
+            if perm is not None:
+                n = len(train_y)
+                all_x, all_y = torch.cat([train_x, valid_x])[perm], torch.cat([train_y, valid_y])[perm]
+                train_x, train_y = all_x[:n], all_y[:n]
+                valid_x, valid_y = all_x[n:], all_y[n:]
+            if cls._train_on_all:
+                train_x, train_y = torch.cat([train_x, valid_x]), torch.cat([train_y, valid_y])
+            x, y = (train_x, train_y) if part == 'train' else (valid_x, valid_y)
+            # the lazily built dataset is copied into memory so that evicting it releases the memory
+            if lazy: x, y = x.clone(), y.clone()
+            return cls.TaskDataset(x, y, totensor=False)
+        test_data = cls.TaskDataset(*rows('test', 0), totensor=False)
+        train_datas = []
+        valid_datas = []
+        for k in range(len(index['client_names'])):
+            train_vol = index['train_offsets'][k + 1] - index['train_offsets'][k]
+            valid_vol = index['valid_offsets'][k + 1] - index['valid_offsets'][k]
+            perm = None
+            if cls._cross_validation:
+                perm = list(range(train_vol + valid_vol))
+                random.shuffle(perm)
+                perm = torch.tensor(perm, dtype=torch.long)
+            if not lazy:
+                train_datas.append(build(k, 'train', perm))
+                valid_datas.append(build(k, 'valid', perm))
+                continue
+            if cls._train_on_all: train_vol += valid_vol
+            train_datas.append(LazyDataset(functools.partial(build, k, 'train', perm), train_vol))
+            valid_datas.append(LazyDataset(functools.partial(build, k, 'valid', perm), valid_vol))
+        # the optimal models of the clients (e.g. of the synthetic tasks) are attached to their datasets
+        client_info = index.get('client_info', {})
+        for train_data, valid_data, name in zip(train_datas, valid_datas, index['client_names']):
+            if 'optimal' in client_info.get(name, {}):
+                train_data.optimal_model = valid_data.optimal_model = client_info[name]['optimal']
+        return train_datas, valid_datas, test_data, index['client_names']
+
+    @classmethod
+    def _to_array(cls, data):
+        # keep the dtypes of torch.tensor on the lists loaded from .json (i.e. float32 and int64)
+        res = np.asarray(data)
+        if np.issubdtype(res.dtype, np.floating): return res.astype(np.float32)
+        if np.issubdtype(res.dtype, np.integer): return res.astype(np.int64)
+        return res
+
 class IDXTaskPipe(BasicTaskPipe):
     TaskDataset = Subset
     @classmethod
@@ -789,8 +1089,14 @@ class IDXTaskPipe(BasicTaskPipe):
         class_path = feddata['datasrc']['class_path']
         class_name = feddata['datasrc']['class_name']
         origin_class = getattr(importlib.import_module(class_path), class_name)
-        origin_train_data = cls.args_to_dataset(origin_class, feddata['datasrc']['train_args'], data_path)
-        origin_test_data = cls.args_to_dataset(origin_class, feddata['datasrc']['test_args'], data_path)
+        if cls._tensor_cache != 'none' and cls.is_deterministic(feddata['datasrc']):
+            # the original datasets are only built when their caches do not exist
+            cache_path = os.path.join(os.path.dirname(os.path.abspath(task_path)), '.tensor_cache')
+            origin_train_data = cls.load_tensor_cache(feddata['datasrc'], 'train', cache_path, data_path, lambda: cls.args_to_dataset(origin_class, feddata['datasrc']['train_args'], data_path))
+            origin_test_data = cls.load_tensor_cache(feddata['datasrc'], 'test', cache_path, data_path, lambda: cls.args_to_dataset(origin_class, feddata['datasrc']['test_args'], data_path))
+        else:
+            origin_train_data = cls.args_to_dataset(origin_class, feddata['datasrc']['train_args'], data_path)
+            origin_test_data = cls.args_to_dataset(origin_class, feddata['datasrc']['test_args'], data_path)
         test_data = cls.TaskDataset(origin_test_data, [_ for _ in range(len(origin_test_data))])
         train_datas = []
         valid_datas = []
@@ -819,6 +1125,69 @@ class IDXTaskPipe(BasicTaskPipe):
         args_str = '(' + ','.join([key + '=' + value for key, value in args.items()]) + ')'
         return eval("original_class" + args_str)
 
+    @classmethod
+    def is_deterministic(cls, datasrc):
+        """Whether the transforms of the original datasets give the same tensor for an item at each time (i.e. no random augmentation), which is required by the tensor cache"""
+        return not any('Random' in args.get('transform', '') + args.get('target_transform', '') for args in [datasrc['train_args'], datasrc['test_args']])
+
+    @classmethod
+    def load_tensor_cache(cls, datasrc, split, cache_path, data_path, build_dataset):
+        """
+        Load the original dataset as the tensors of the transformed items, which are computed once and
+        stored as .npy files named by the hash of the source of the dataset (i.e. datasrc with the root
+        that the dataset is actually loaded from) and the dtype
+        :param datasrc: the source dict of the original dataset stored in the fedtask
+        :param split: 'train' or 'test'
+        :param cache_path: the directory of the cache files
+        :param data_path: the root of the raw data that replaces the one in datasrc (see args_to_dataset)
+        :param build_dataset: the function that builds the original dataset, which is called only if the cache does not exist
+        :return: the TensorCacheDataset of the transformed items
+        """
+        args = dict(datasrc[split + '_args'])
+        if data_path: args['root'] = '"' + os.path.abspath(data_path) + '"'
+        src = ujson.dumps({'class_path': datasrc['class_path'], 'class_name': datasrc['class_name'], 'args': args}, sort_keys=True)
+        name = '{}_{}'.format(hashlib.sha1(src.encode()).hexdigest()[:16], cls._tensor_cache)
+        x_path, y_path = os.path.join(cache_path, name + '_x.npy'), os.path.join(cache_path, name + '_y.npy')
+        if not (os.path.exists(x_path) and os.path.exists(y_path)):
+            os.makedirs(cache_path, exist_ok=True)
+            xs, ys = [], []
+            for x, y in DataLoader(build_dataset(), batch_size=1024, shuffle=False):
+                xs.append(x.to(getattr(torch, cls._tensor_cache)).numpy())
+                ys.append(torch.as_tensor(y).numpy())
+            # write to temporary files first so that an interrupted run never leaves a broken cache
+            for path, arrays in [(x_path, xs), (y_path, ys)]:
+                with open(path + '.tmp', 'wb') as outf:
+                    np.save(outf, np.concatenate(arrays))
+                os.replace(path + '.tmp', path)
+        return TensorCacheDataset(torch.from_numpy(np.load(x_path, mmap_mode='c')), torch.from_numpy(np.load(y_path, mmap_mode='c')))
+
+class TensorCacheDataset(Dataset):
+    def __init__(self, X, Y):
+        """
+        The original dataset whose items have been transformed and stacked into the tensors X and Y (see
+        IDXTaskPipe.load_tensor_cache), where X may be stored in a lower precision and is converted into
+        float32 when read. The local datasets are Subsets of it, and a batch of them is gathered by one
+        indexing (i.e. __getitems__) instead of reading and transforming the items one by one.
+        """
+        self.X = X
+        self.Y = Y
+        self.targets = Y
+
+    def __len__(self):
+        return len(self.Y)
+
+    def __getitem__(self, item):
+        return self.X[item].float(), self.Y[item]
+
+    def __getitems__(self, items):
+        x, y = self.gather(items)
+        return list(zip(x, y))
+
+    def gather(self, items):
+        """Return the batch (X, Y) at `items` by one indexing"""
+        items = torch.as_tensor(items, dtype=torch.long)
+        return self.X[items].float(), self.Y[items]
+
 class XTaskPipe(BasicTaskPipe):
     class XDataset(Dataset):
         def __init__(self, X=[], totensor=True):
@@ -916,3 +1285,144 @@ class TupleDataset(Dataset):
             return self.X1, self.X2, self.Y
         return self.X1.tolist(), self.X2.tolist(), self.Y.tolist()
 
+
+class UnionDataset(Dataset):
+    def __init__(self, datasets=[]):
+        """
+        A flat view of the union of several datasets (e.g. the local datasets of a subset of clients), which
+        replaces the nested ConcatDataset built by `d1 + d2 + ...`. The nested Subset and ConcatDataset in the
+        inputs are resolved into one contiguous array of indices in advance, so that an item is fetched in O(1):
+            1) if all the data is in-memory tensors (i.e. XYDataset, XDataset, TupleDataset), the selected rows
+               are concatenated into one tensor for each field and a batch is gathered by one indexing,
+            2) else if all the data comes from the same original dataset (e.g. IDXTaskPipe), the item is read
+               from the original dataset at the resolved index,
+            3) else the item is read from the resolved dataset at the resolved index.
+        Args:
+            datasets: a list of datasets
+        """
+        leaves = []
+        for dataset in datasets:
+            leaves.extend(self._flatten(dataset))
+        self.fields = self._tensor_fields(leaves)
+        self.indices = torch.cat([idx for _, idx in leaves]) if len(leaves) > 0 else torch.zeros(0, dtype=torch.long)
+        if self.fields is not None:
+            self.tensors = [torch.cat([getattr(base, fd)[idx] for base, idx in leaves]) for fd in self.fields]
+            self.datasets = []
+        else:
+            self.tensors = None
+            self.datasets = [base for base, _ in leaves]
+            if all(base is self.datasets[0] for base in self.datasets):
+                self.datasets = self.datasets[:1]
+            self.dataset_ids = torch.cat([torch.full((len(idx),), did, dtype=torch.long) for did, (_, idx) in enumerate(leaves)]) if len(self.datasets) > 1 else None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if self.tensors is not None:
+            res = tuple(t[item] for t in self.tensors)
+            return res[0] if len(res) == 1 else res
+        dataset = self.datasets[0] if self.dataset_ids is None else self.datasets[self.dataset_ids[item]]
+        return dataset[int(self.indices[item])]
+
+    def __getitems__(self, items):
+        # fetch a batch of items at once (used by DataLoader of torch>=2.0)
+        if self.tensors is None:
+            if self.dataset_ids is None and callable(getattr(self.datasets[0], '__getitems__', None)):
+                return self.datasets[0].__getitems__(self.indices[torch.as_tensor(items, dtype=torch.long)].tolist())
+            return [self[item] for item in items]
+        batch = self.gather(items)
+        return list(zip(*batch)) if isinstance(batch, tuple) else list(batch)
+
+    def gather(self, items):
+        """Return the batch of the in-memory tensors at `items` as a tuple of tensors (or one tensor) by one indexing"""
+        if self.tensors is None:
+            raise RuntimeError("UnionDataset.gather is only supported for in-memory tensor datasets.")
+        items = torch.as_tensor(items, dtype=torch.long)
+        res = tuple(t[items] for t in self.tensors)
+        return res[0] if len(res) == 1 else res
+
+    @classmethod
+    def _flatten(cls, dataset, indices=None):
+        """Resolve the dataset into a list of (dataset, indices) where dataset is neither Subset nor ConcatDataset"""
+        if isinstance(dataset, LazyDataset):
+            return cls._flatten(dataset.dataset, indices)
+        if isinstance(dataset, Subset):
+            sub_indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+            return cls._flatten(dataset.dataset, sub_indices if indices is None else sub_indices[indices])
+        if isinstance(dataset, ConcatDataset) and indices is None:
+            res = []
+            for d in dataset.datasets: res.extend(cls._flatten(d))
+            return res
+        return [(dataset, torch.arange(len(dataset)) if indices is None else indices)]
+
+    @classmethod
+    def _tensor_fields(cls, leaves):
+        """Return the names of the tensor fields shared by all the datasets if all of them are in-memory tensors"""
+        fields = None
+        for base, _ in leaves:
+            if isinstance(base, XYTaskPipe.XYDataset): crt = ('X', 'Y')
+            elif isinstance(base, TupleDataset): crt = ('X1', 'X2', 'Y')
+            elif isinstance(base, XTaskPipe.XDataset): crt = ('X',)
+            else: return None
+            if fields is not None and crt != fields: return None
+            if not all(isinstance(getattr(base, fd), torch.Tensor) for fd in crt): return None
+            fields = crt
+        return fields
+
+def batch_gather(dataset):
+    """
+    Return the function that gathers the batch of the dataset at a tensor of indices by one indexing if all
+    the data of the dataset is in-memory tensors (e.g. XYDataset, TupleDataset, UnionDataset of them and
+    Subsets of TensorCacheDataset), else None
+    """
+    if isinstance(dataset, LazyDataset):
+        return batch_gather(dataset.dataset)
+    if isinstance(dataset, Subset):
+        gather = batch_gather(dataset.dataset)
+        if gather is None: return None
+        indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+        return lambda items: gather(indices[items])
+    if isinstance(dataset, (UnionDataset, TensorCacheDataset)):
+        return dataset.gather if isinstance(dataset, TensorCacheDataset) or dataset.tensors is not None else None
+    for cls, fields in [(XYTaskPipe.XYDataset, ('X', 'Y')), (TupleDataset, ('X1', 'X2', 'Y')), (XTaskPipe.XDataset, ('X',))]:
+        if type(dataset) is cls:
+            tensors = [getattr(dataset, fd) for fd in fields]
+            if not all(isinstance(t, torch.Tensor) for t in tensors): return None
+            if len(tensors) == 1: return lambda items: tensors[0][items]
+            return lambda items: tuple(t[items] for t in tensors)
+    return None
+
+class TensorBatchLoader:
+    def __init__(self, gather, length, batch_size=64, shuffle=True):
+        """
+        The data loader of the in-memory tensor datasets, where each batch is gathered by one indexing
+        instead of reading the items one by one and collating them. The order of the items is drawn from
+        the global RNG of torch in the same way as DataLoader(shuffle=shuffle, num_workers=0), so both give
+        the same batches under the same seed (e.g. utils.seeding.fixed_seed of the client).
+        Args:
+            gather: the function that returns the batch at a tensor of indices (see batch_gather)
+            length: the number of the items
+            batch_size: the batch size
+            shuffle: whether to shuffle the items at each epoch
+        """
+        self.gather = gather
+        self.length = length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return math.ceil(self.length / self.batch_size)
+
+    def __iter__(self):
+        # DataLoader draws the base seed of its workers when it starts an epoch
+        torch.empty((), dtype=torch.int64).random_()
+        if self.shuffle:
+            # RandomSampler draws its seed at the first batch
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            order = torch.randperm(self.length, generator=generator)
+        else:
+            order = torch.arange(self.length)
+        for start in range(0, self.length, self.batch_size):
+            yield self.gather(order[start:start + self.batch_size])
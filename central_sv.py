@@ -5,7 +5,7 @@ import importlib
 import utils.fmodule
 from itertools import combinations
 from copy import deepcopy
-from torch.utils.data import ConcatDataset
+from benchmark.toolkits import UnionDataset
 from bitsets import bitset
 
 def main():
@@ -51,8 +51,8 @@ def main():
             #     continue
             print('Subset:', list(subset_clients_indices))
             print('Save filename: {}'.format(save_filename))
-            client.train_data = ConcatDataset([train_datas[index] for index in subset_clients_indices])
-            client.valid_data = ConcatDataset([valid_datas[index] for index in subset_clients_indices])
+            client.train_data = UnionDataset([train_datas[index] for index in subset_clients_indices])
+            client.valid_data = UnionDataset([valid_datas[index] for index in subset_clients_indices])
             print('Number of train samples: {}; Number of validate samples: {}'.format(client.train_data.__len__(), client.valid_data.__len__()))
             torch.manual_seed(option['seed'])
             model = utils.fmodule.Model()
@@ -6,9 +6,10 @@ from sv_centralbase import CentralizedShapleyValue
 def main():
     # read options
     option = flw.read_option()
-    option['num_gpus'] = len(option['gpu'])
+    option['num_gpus'] = len(option['gpu'] or [])
     print(option)
-    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(gpu_id) for gpu_id in option['gpu']])
+    # running on CPU when no GPU is given
+    if option['num_gpus'] > 0: os.environ['CUDA_VISIBLE_DEVICES'] = ','.join([str(gpu_id) for gpu_id in option['gpu']])
     print('=' * 100)
     os.environ['MASTER_ADDR'] = "localhost"
     os.environ['MASTER_PORT'] = '8888'
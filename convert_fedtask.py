@@ -0,0 +1,19 @@
+import argparse
+import os
+from benchmark.toolkits import BinaryXYTaskPipe
+
+def read_option():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', help='name of the fedtask stored in data.json by XYTaskPipe;', type=str, nargs='+', default=[])
+    parser.add_argument('--fedtask_path', help='path of the fedtasks;', type=str, default='./fedtask')
+    try: option = vars(parser.parse_args())
+    except IOError as msg: parser.error(str(msg))
+    return option
+
+if __name__ == '__main__':
+    # convert the XY fedtasks into the binary format of BinaryXYTaskPipe, which is loaded instead of data.json afterwards
+    option = read_option()
+    for task in option['task']:
+        task_path = os.path.join(option['fedtask_path'], task)
+        BinaryXYTaskPipe.convert(task_path)
+        print('Converted {} into the binary format.'.format(task_path))
@@ -2,68 +2,76 @@ import numpy as np
 import torch
 import pickle
 import os
-import itertools
 import argparse
 
+def load_exact(fedtask, exact_dir, num_rounds=-1):
+    """Load the per-round SV as a (num_rounds, num_clients) matrix. All the saved rounds are loaded if num_rounds is -1"""
+    exact = list()
+    i = 1
+    while num_rounds == -1 or i <= num_rounds:
+        path = os.path.join('SV_result', fedtask, exact_dir, 'Round{}.npy'.format(i))
+        if num_rounds == -1 and not os.path.exists(path): break
+        with open(path, 'rb') as f:
+            round_exact = pickle.load(f)
+            exact.append(np.asarray(round_exact, dtype=np.float64).tolist())
+        i += 1
+    return np.array(exact)
+
+def fill_exact(exact, num_steps=100, learning_rate=0.5, optimizer='SGD', tol=1e-8, device='cpu', verbose=True):
+    """
+    Fill the missing (zero) SV entries by minimizing the mean over all pairs of rounds i < j of
+        max(1 - cos(SV_i, SV_j), 1 - exp(-|i - j| / 1000))
+    where only the missing entries are trainable. The cosine terms of all the pairs are computed at
+    once from the Gram matrix of the row-normalized SV matrix.
+    :param exact: (num_rounds, num_clients) array of SV where 0.0 marks the missing entries
+    :param num_steps: the maximum number of optimization steps
+    :param learning_rate: the learning rate of the optimizer
+    :param optimizer: the name of the optimizer in torch.optim
+    :param tol: stop early once the change of the loss is no larger than tol
+    :return: the filled array of SV
+    """
+    known = torch.tensor(exact, dtype=torch.float64, device=device)
+    unknown = known == 0.0
+    num_rounds = known.shape[0]
+    values = torch.zeros_like(known, requires_grad=True)
+    # the lower bound of each pair only depends on the distance between the two rounds
+    idx = torch.arange(num_rounds, device=device, dtype=torch.float64)
+    bound = 1.0 - torch.exp(-torch.abs(idx[:, None] - idx[None, :]) / 1000)
+    pairs = torch.triu(torch.ones(num_rounds, num_rounds, dtype=torch.bool, device=device), diagonal=1)
+    bound = bound[pairs]
+    optim = getattr(torch.optim, optimizer)([values], lr=learning_rate)
+    prev_loss = None
+    for step in range(0, num_steps):
+        optim.zero_grad()
+        sv = torch.where(unknown, values, known)
+        normalized = torch.nn.functional.normalize(sv, dim=1, eps=1e-12)
+        cos = (normalized @ normalized.T)[pairs]
+        loss = torch.maximum(1.0 - cos, bound).mean()
+        loss.backward()
+        optim.step()
+        loss = loss.item()
+        if verbose: print('Step {}, loss: {}'.format(step + 1, loss))
+        if prev_loss is not None and abs(prev_loss - loss) <= tol: break
+        prev_loss = loss
+    with torch.no_grad():
+        return torch.where(unknown, values, known).cpu().numpy()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--fedtask', help='fedtask', type=str)
     parser.add_argument('--exact_dir', help='exact dir', type=str)
+    parser.add_argument('--num_rounds', help='number of rounds to be loaded (-1 for all the saved rounds)', type=int, default=-1)
+    parser.add_argument('--num_steps', help='maximum number of optimization steps', type=int, default=100)
+    parser.add_argument('--learning_rate', help='learning rate of the optimizer', type=float, default=0.5)
+    parser.add_argument('--optimizer', help='optimizer in torch.optim', type=str, choices=['SGD', 'Adam'], default='SGD')
+    parser.add_argument('--tol', help='stop once the change of the loss is no larger than tol', type=float, default=1e-8)
+    parser.add_argument('--device', help='device to run the solver', type=str, default='cpu')
     args = parser.parse_args()
     fedtask = args.fedtask
     exact_dir = args.exact_dir
-    
-    exact = list()
-    for i in range(1, 101):
-        with open(os.path.join('SV_result', fedtask, exact_dir, 'Round{}.npy'.format(i)), 'rb') as f:
-            round_exact = pickle.load(f)
-            exact.append(round_exact.tolist())
-    exact = np.array(exact)
-    
-    exact_var = list()
-    for i in range(0, 100):
-        tmp = list()
-        for e in exact[i]:
-            if e != 0.0:
-                tmp.append(torch.scalar_tensor(e.item(), requires_grad=False))
-            else:
-                tmp.append(torch.scalar_tensor(0.0, requires_grad=True))
-        exact_var.append(tmp)
-                
-    num_steps = 100
-    learning_rate = 0.5
-    for step in range(0, num_steps):
-        loss = torch.scalar_tensor(0.0, requires_grad=False)
-        count = 0
-        for i, j in itertools.combinations(range(0, 100), 2):
-            n = len(exact_var[i])
-            X = torch.scalar_tensor(0.0, requires_grad=False)
-            Y = torch.scalar_tensor(0.0, requires_grad=False)
-            Z = torch.scalar_tensor(0.0, requires_grad=False)
-            for k in range(0, n):
-                X += exact_var[i][k] ** 2
-                Y += exact_var[j][k] ** 2
-                Z += exact_var[i][k] * exact_var[j][k]
-            loss += max(1.0 - Z / torch.sqrt(X * Y),
-                        torch.scalar_tensor(1.0 - np.exp(- np.abs(i - j) / 1000).item(), requires_grad=False))
-            count += 1
-        loss = loss / count
-        print('Step {}, loss: {}'.format(step + 1, loss.item()))
-        loss.backward()
-        for var in exact_var:
-            for x in var:
-                if x.requires_grad:
-                    x.data = x.data - learning_rate * x.grad
-                    x.grad = None
 
-    new_exact = list()
-    for var in exact_var:
-        tmp = list()
-        for x in var:
-            tmp.append(x.data.item())
-        new_exact.append(tmp)
-    new_exact = np.array(new_exact)
+    exact = load_exact(fedtask, exact_dir, args.num_rounds)
+    new_exact = fill_exact(exact, args.num_steps, args.learning_rate, args.optimizer, args.tol, args.device)
 
     with open(os.path.join('SV_result', fedtask, exact_dir, 'fill_exact2.npy'), 'wb') as f:
         pickle.dump(new_exact, f)
-        
\ No newline at end of file
@@ -1,20 +1,86 @@
 import argparse
+import collections
 import importlib
+import itertools
+import multiprocessing
+import random
+import numpy as np
+from benchmark.toolkits import DefaultTaskGen
 
 def read_option():
     parser = argparse.ArgumentParser()
     parser.add_argument('--benchmark', help='name of the benchmark;', type=str, default='mnist_classification')
-    parser.add_argument('--dist', help='type of distribution;', type=int, default=0)
-    parser.add_argument('--skew', help='the degree of niid;', type=float, default=0)
-    parser.add_argument('--num_clients', help='the number of clients;', type=int, default=5)
-    parser.add_argument('--seed', help='random seed;', type=int, default=0)
+    # a grid of tasks is generated when more than one value is given to --dist, --skew, --num_clients or --seed
+    parser.add_argument('--dist', help='type of distribution;', type=int, nargs='+', default=[0])
+    parser.add_argument('--skew', help='the degree of niid;', type=float, nargs='+', default=[0])
+    parser.add_argument('--num_clients', help='the number of clients;', type=int, nargs='+', default=[5])
+    parser.add_argument('--seed', help='random seed;', type=int, nargs='+', default=[0])
     parser.add_argument('--min_vol', help='min size of local datasets;', type=int, default=50)
+    parser.add_argument('--binary', help='store the tasks in the binary format of BinaryXYTaskPipe (only for the synthetic benchmarks);', action="store_true", default=False)
+    parser.add_argument('--num_processes', help='the number of processes that generate the tasks of the grid in parallel;', type=int, default=1)
     try: option = vars(parser.parse_args())
     except IOError as msg: parser.error(str(msg))
     return option
 
+# the raw data loaded once and shared by the generators of all the tasks, which is inherited by the forked workers
+_shared_data = None
+
+def create_generator(TaskGen, config, binary=False):
+    dist, skew, num_clients, seed = config
+    generator = TaskGen(dist_id=dist, skewness=skew, num_clients=num_clients, seed=seed)
+    generator.binary = binary
+    return generator
+
+def load_shared_data(TaskGen, config):
+    """
+    Load the raw data once for all the tasks, which is only possible if the loading of DefaultTaskGen
+    does not draw random numbers (e.g. torchvision datasets). Otherwise the loaded data depends on the
+    seed and each task loads its own data, so the tasks are the same as those generated one by one.
+    """
+    generator = create_generator(TaskGen, config)
+    if not isinstance(generator, DefaultTaskGen): return None
+    py_state, np_state = random.getstate(), np.random.get_state()
+    generator.load_data()
+    new_np_state = np.random.get_state()
+    if random.getstate() != py_state or any(not np.array_equal(a, b) for a, b in zip(np_state, new_np_state)): return None
+    return {'train_data': generator.train_data, 'test_data': generator.test_data, 'labels': generator.get_labels()}
+
+def generate(TaskGen, config, binary=False):
+    generator = create_generator(TaskGen, config, binary)
+    if _shared_data is None:
+        generator.run()
+        return generator.get_taskname()
+    if generator._check_task_exist():
+        print("Task Already Exists.")
+        return generator.get_taskname()
+    generator.train_data, generator.test_data = _shared_data['train_data'], _shared_data['test_data']
+    generator._labels = (generator.train_data, _shared_data['labels'])
+    generator.generate()
+    return generator.get_taskname()
+
+def _generate_in_worker(args):
+    benchmark, config, binary = args
+    return generate(getattr(importlib.import_module('.'.join(['benchmark', benchmark, 'core'])), 'TaskGen'), config, binary)
+
 if __name__ == '__main__':
     option = read_option()
     TaskGen = getattr(importlib.import_module('.'.join(['benchmark', option['benchmark'], 'core'])), 'TaskGen')
-    generator = TaskGen(dist_id = option['dist'], skewness = option['skew'], num_clients=option['num_clients'], seed = option['seed'])
-    generator.run()
+    configs = list(itertools.product(option['dist'], option['skew'], option['num_clients'], option['seed']))
+    # the configurations of the same task (e.g. dist 0 ignores the skewness) are only generated once
+    tasks = collections.OrderedDict()
+    for c in configs: tasks.setdefault(create_generator(TaskGen, c).get_taskname(), c)
+    configs = list(tasks.values())
+    # skip the tasks that already exist before loading the raw data
+    exist = [create_generator(TaskGen, c)._check_task_exist() for c in configs]
+    if any(exist): print("{} Task(s) Already Exist.".format(sum(exist)))
+    configs = [c for c, e in zip(configs, exist) if not e]
+    if len(configs) > 1: _shared_data = load_shared_data(TaskGen, configs[0])
+    # the tasks are generated one by one on the platforms without fork (e.g. Windows)
+    if option['num_processes'] > 1 and len(configs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # the forked workers share the loaded raw data without copying it
+        with multiprocessing.get_context('fork').Pool(option['num_processes']) as pool:
+            for taskname in pool.imap_unordered(_generate_in_worker, [(option['benchmark'], c, option['binary']) for c in configs]):
+                print('Generated {}'.format(taskname))
+    else:
+        for c in configs:
+            generate(TaskGen, c, option['binary'])
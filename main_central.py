@@ -4,7 +4,7 @@ import wandb
 from bitsets import bitset
 import itertools
 import copy
-from torch.utils.data import ConcatDataset
+from benchmark.toolkits import UnionDataset
 
 def main():
     # read options
@@ -21,8 +21,8 @@ def main():
         # set random seed
         flw.setup_seed(option['seed'])
         server = flw.initialize(option)
-        used_client.train_data = ConcatDataset([client.train_data for client in subset])
-        used_client.valid_data = ConcatDataset([client.valid_data for client in subset])
+        used_client.train_data = UnionDataset([client.train_data for client in subset])
+        used_client.valid_data = UnionDataset([client.valid_data for client in subset])
         used_client.datavol = len(used_client.train_data)
         server.clients = [used_client]
         server.num_clients = 1
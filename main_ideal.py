@@ -1,21 +1,49 @@
 import utils.fflow as flw
+import utils.ideal_sv as isv
 import torch
 import wandb
-from bitsets import bitset
-import itertools
-import copy
+import os
+import pickle
 
 def main():
     # read options
     option = flw.read_option()
     # initialize server, clients and fedtask
     server = flw.initialize(option)
-    all_clients = copy.deepcopy(server.clients)
-    CLIENTS_BITSET = bitset('clients_bitset', tuple(client.name for client in all_clients))
+    num_clients = len(server.clients)
+    store = isv.SubsetResultStore(isv.get_record_path(option), flw.logger.get_output_name(suffix=''), num_clients)
+    if option['sv_previous_task'] is not None:
+        # reuse the subsets trained in the previous study under its client naming
+        num_imported = store.import_study(
+            isv.get_record_path(option, option['sv_previous_task']),
+            isv.get_client_names(option['sv_previous_task']),
+            [c.name for c in server.clients]
+        )
+        print('Imported {} subsets from {}'.format(num_imported, option['sv_previous_task']))
+    save_dir = os.path.join('./SV_result', option['task'])
+    os.makedirs(save_dir, exist_ok=True)
+    if option['sv_sampling'] is not None:
+        wandb.init(
+            project='SV_FL',
+            name="IdealSV_{}_{}".format(option['sv_sampling'], option['task']),
+            group=f"{option['task'].split('_')[0]}_new",
+            entity="aiotlab",
+            tags=["ideal", option['sv_sampling'], option['task'].split('_')[2], option['task'].split('_')[3], option['task'].split('_')[4]],
+            config=option
+        )
+        def log_step(values, half_widths, num_trained):
+            print('Trained subsets: {}; SV: {}; CI: {}'.format(num_trained, values, half_widths))
+            wandb.log({'num_trained_subsets': num_trained, 'max_half_width': float(half_widths.max())})
+        values, half_widths = isv.sampling_ideal_shapley(option, store, num_clients, callback=log_step)
+        print('Ideal SV:', values)
+        print('Half widths of {:.0%} CI:'.format(option['sv_confidence']), half_widths)
+        with open(os.path.join(save_dir, 'ideal_{}.npy'.format(option['sv_sampling'])), 'wb') as f:
+            pickle.dump({'sv': values, 'half_width': half_widths}, f)
+        return
     start = max(1, option['start'])
-    end = pow(2, len(all_clients)) if option['end'] == -1 else min(pow(2, len(all_clients)), option['end'])
+    end = pow(2, num_clients) if option['end'] == -1 else min(pow(2, num_clients), option['end'])
     if start >= end or \
-        start >= pow(2, len(all_clients)) or \
+        start >= pow(2, num_clients) or \
         end <= 0:
         print("No selected subset!")
         return
@@ -27,26 +55,18 @@ def main():
         tags=["ideal", option['task'].split('_')[2], option['task'].split('_')[3], option['task'].split('_')[4]],
         config=option
     )
-    for subset_index in range(start, end):
-        subset = [client for client in all_clients if client.name in CLIENTS_BITSET.fromint(subset_index).members()]
-        print(subset_index, subset)
-        # set random seed
-        flw.setup_seed(option['seed'])
-        server = flw.initialize(option)
-        server.clients = list(subset)
-        server.num_clients = len(subset)
-        server.local_data_vols = [c.datavol for c in server.clients]
-        server.total_data_vol = sum(server.local_data_vols)
-        for client in server.clients:
-            print(client.name, len(client.train_data), len(client.valid_data))
-        print(server.local_data_vols, server.total_data_vol)
+    # only the subsets that are not trained yet are scheduled
+    for bits in isv.missing_subsets(store, start, end):
+        print(isv.bits_to_int(bits), bits)
         # start federated optimization
-        try:
-            server.run(suffix_log_filename=CLIENTS_BITSET([client.name for client in subset]).bits())
-        except:
-            # log the exception that happens during training-time
-            flw.logger.exception("Exception Logged")
-            raise RuntimeError
+        isv.train_subset(option, bits)
+    # calculate ideal SV once all the subsets are trained
+    store.refresh()
+    if len(store) == pow(2, num_clients) - 1:
+        values = isv.shapley_from_table(store.to_table(), num_clients)
+        print('Ideal SV:', values)
+        with open(os.path.join(save_dir, 'ideal_exact.npy'), 'wb') as f:
+            pickle.dump({'sv': values}, f)
 
 if __name__ == '__main__':
     torch.multiprocessing.set_start_method('spawn')
@@ -0,0 +1,159 @@
+"""
+Centralized SV of clients, where the utility of a subset of clients is the test accuracy of the model
+centrally trained on the union of their local training data.
+
+The subsets are trained by a group of processes connected by torch.distributed (gloo backend):
+    rank 0:   hands out the subsets to be trained, collects their utilities and finally computes SV,
+    rank > 0: repeatedly ask rank 0 for a subset, train it on CPU and report its utility.
+The group is configured by the environment variables MASTER_ADDR, MASTER_PORT and WORLD_SIZE
+(see central_sv_main.py). If RANK is also set (e.g. the script is launched on each host by torchrun),
+the current process joins the group with this rank. Otherwise, all the WORLD_SIZE processes are
+spawned on the local machine. The utility of each subset is saved as `central_acc/<task>/<bits>.txt`
+and the subsets that are already saved will not be trained again.
+"""
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import utils.fflow as flw
+import utils.fmodule
+import utils.ideal_sv as isv
+from benchmark.toolkits import UnionDataset
+
+# the message from a worker is [mask of the trained subset, utility] and mask=-1 means no result
+# the message from the master is [mask of the subset to be trained] and mask=-1 means stop
+_NO_SUBSET = -1
+
+class CentralizedShapleyValue:
+    def __init__(self, server):
+        self.server = server
+        self.option = server.option
+        self.task = self.option['task']
+        self.num_clients = server.num_clients
+        self.save_dir = os.path.join('./central_acc', self.task)
+        os.makedirs(self.save_dir, exist_ok=True)
+
+    def calculate_central_SV(self):
+        """
+        Train all the nonempty subsets of clients in the process group and compute the SV of clients.
+        :return: the array of SV of clients (only on rank 0, and None on other ranks)
+        """
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', '8888')
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+        if 'RANK' in os.environ:
+            return self._run(int(os.environ['RANK']), world_size)
+        if world_size <= 1:
+            return self._run(0, 1)
+        ctx = mp.get_context('spawn')
+        result_queue = ctx.SimpleQueue()
+        mp.spawn(_run_rank, args=(world_size, self.option, result_queue), nprocs=world_size, join=True)
+        return result_queue.get()
+
+    def _run(self, rank, world_size):
+        if world_size <= 1:
+            for bits in self.missing_subsets():
+                self.save_utility(bits, self.train_subset(bits))
+            return self.compute_SV()
+        dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+        try:
+            if rank == 0:
+                self.serve(world_size)
+                return self.compute_SV()
+            self.work()
+            return None
+        finally:
+            dist.destroy_process_group()
+
+    def serve(self, world_size):
+        """Hand out the missing subsets to the workers until all of them are trained"""
+        pending = self.missing_subsets()
+        flw.logger.info('{} subsets to be trained by {} workers'.format(len(pending), world_size - 1))
+        num_working = world_size - 1
+        msg = torch.zeros(2, dtype=torch.float64)
+        while num_working > 0:
+            src = dist.recv(msg)
+            mask, utility = int(msg[0].item()), msg[1].item()
+            if mask != _NO_SUBSET:
+                bits = isv.int_to_bits(mask, self.num_clients)
+                self.save_utility(bits, utility)
+                flw.logger.info('Subset {} from rank {}: {:.4f}'.format(bits, src, utility))
+            if len(pending) > 0:
+                task = isv.bits_to_int(pending.pop(0))
+            else:
+                task = _NO_SUBSET
+                num_working -= 1
+            dist.send(torch.tensor([task], dtype=torch.int64), dst=src)
+        return
+
+    def work(self):
+        """Ask rank 0 for subsets and train them until rank 0 replies to stop"""
+        msg = torch.tensor([_NO_SUBSET, 0.0], dtype=torch.float64)
+        task = torch.zeros(1, dtype=torch.int64)
+        while True:
+            dist.send(msg, dst=0)
+            dist.recv(task, src=0)
+            mask = int(task.item())
+            if mask == _NO_SUBSET: break
+            utility = self.train_subset(isv.int_to_bits(mask, self.num_clients))
+            msg = torch.tensor([mask, utility], dtype=torch.float64)
+        return
+
+    def train_subset(self, bits):
+        """Train the model on CPU with the union of the training data of the clients in the subset and return the test accuracy"""
+        clients = [self.server.clients[cid] for cid in isv.bits_to_members(bits)]
+        train_data = UnionDataset([c.train_data for c in clients])
+        device = torch.device('cpu')
+        calculator = utils.fmodule.TaskCalculator(device, self.option['optimizer'])
+        torch.manual_seed(self.option['seed'])
+        model = utils.fmodule.Model().to(device)
+        model.train()
+        optimizer = calculator.get_optimizer(model, lr=self.option['learning_rate'], weight_decay=self.option['weight_decay'], momentum=self.option['momentum'])
+        batch_size = len(train_data) if self.option['batch_size'] <= 0 else int(self.option['batch_size'])
+        for epoch in range(self.option['num_epochs']):
+            for batch_data in calculator.get_data_loader(train_data, batch_size=batch_size):
+                model.zero_grad()
+                loss = calculator.train_one_step(model, batch_data)['loss']
+                loss.backward()
+                optimizer.step()
+        return calculator.test(model, self.server.test_data, batch_size=self.option['test_batch_size'])['accuracy']
+
+    def missing_subsets(self):
+        start = max(1, self.option['start'])
+        end = pow(2, self.num_clients) if self.option['end'] == -1 else min(pow(2, self.num_clients), self.option['end'])
+        return [isv.int_to_bits(mask, self.num_clients) for mask in range(start, end) if not os.path.exists(self.utility_path(isv.int_to_bits(mask, self.num_clients)))]
+
+    def utility_path(self, bits):
+        return os.path.join(self.save_dir, '{}.txt'.format(bits))
+
+    def save_utility(self, bits, utility):
+        with open(self.utility_path(bits), 'w') as f:
+            f.write(str(utility))
+
+    def load_table(self):
+        table = np.full(pow(2, self.num_clients), np.nan)
+        table[0] = 0.0
+        for mask in range(1, pow(2, self.num_clients)):
+            path = self.utility_path(isv.int_to_bits(mask, self.num_clients))
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    table[mask] = float(f.read())
+        return table
+
+    def compute_SV(self):
+        """Compute SV from the saved utilities or return None if some subsets are still missing"""
+        table = self.load_table()
+        if np.any(np.isnan(table)):
+            flw.logger.info('SV is not computed since some subsets are not trained yet.')
+            return None
+        return isv.shapley_from_table(table, self.num_clients)
+
+def _run_rank(rank, world_size, option, result_queue):
+    # each spawned process builds its own clients from the fedtask and only uses CPU
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    option = dict(option, gpu=None)
+    flw.setup_seed(option['seed'])
+    server = flw.initialize(option)
+    res = CentralizedShapleyValue(server)._run(rank, world_size)
+    if rank == 0: result_queue.put(res)
@@ -0,0 +1,109 @@
+"""
+Local training of many clients at once for small models. The parameters of all the clients are
+stacked along a new leading dimension and one local SGD step of every client is taken by a single
+call of torch.func.vmap(torch.func.grad(loss)), where the loss is computed by the task calculator on
+the model called with the parameters of each client (torch.func.functional_call). The clients whose
+batches have the same shape at a step are trained together, so the updates are the same as those of
+training the clients one by one up to float tolerance. Only the models without buffers that are
+trained by SGD are supported, and the others should be trained serially.
+"""
+import torch
+from torch.func import functional_call, grad, vmap
+
+# the results of supports() for each model class
+_supported = {}
+
+class _FunctionalModel:
+    """The model that is called with the given parameters, which lets the task calculator compute the loss"""
+    def __init__(self, model, params):
+        self.model = model
+        self.params = params
+
+    def __call__(self, *args, **kwargs):
+        return functional_call(self.model, self.params, args, kwargs)
+
+def _loss_fn(model, calculator, frozen):
+    def loss(params, x, y):
+        return calculator.train_one_step(_FunctionalModel(model, dict(frozen, **params)), (x, y))['loss']
+    return loss
+
+def _split_params(model):
+    trainable = {name: p.detach() for name, p in model.named_parameters() if p.requires_grad}
+    frozen = {name: p.detach() for name, p in model.named_parameters() if not p.requires_grad}
+    return trainable, frozen
+
+def supports(model, calculator, sample):
+    """
+    Check whether the clients can be trained in batch with the model and the calculator
+    :param model: the model to be trained
+    :param calculator: the task calculator of the clients
+    :param sample: one item of the training data, which is used to check the loss under vmap
+    :return: True if batched training is supported
+    """
+    if calculator.optimizer_name.lower() != 'sgd' or len([b for b in model.buffers() if b is not None]) > 0: return False
+    if type(model) not in _supported:
+        try:
+            trainable, frozen = _split_params(model)
+            params = {name: torch.stack([p, p]) for name, p in trainable.items()}
+            batch = torch.utils.data.default_collate([sample, sample])
+            x, y = (torch.stack([t, t]) for t in calculator.data_to_device(batch))
+            vmap(grad(_loss_fn(model, calculator, frozen)))(params, x, y)
+            _supported[type(model)] = True
+        except Exception:
+            _supported[type(model)] = False
+    return _supported[type(model)]
+
+def train(model, calculator, batches, lrs, weight_decays, momentums):
+    """
+    Train the copies of the model on the batches of each client by SGD
+    :param model: the model that all the clients start from
+    :param calculator: the task calculator of the clients
+    :param batches: batches[k] is the list of the batches of the k-th client for its local steps
+    :param lrs: the learning rate of each client
+    :param weight_decays: the weight decay of each client
+    :param momentums: the momentum of each client
+    :return: the list of the trained parameters of each client, i.e. {name: tensor}
+    """
+    num_clients = len(batches)
+    trainable, frozen = _split_params(model)
+    params = {name: p.unsqueeze(0).repeat(num_clients, *([1] * p.dim())) for name, p in trainable.items()}
+    device = next(iter(trainable.values())).device
+    use_momentum = [m != 0 for m in momentums]
+    bufs = {name: torch.zeros_like(p) for name, p in params.items()} if any(use_momentum) else None
+    lrs, weight_decays, momentums = (torch.tensor(v, dtype=torch.float32, device=device) for v in (lrs, weight_decays, momentums))
+    use_momentum = torch.tensor(use_momentum, device=device)
+    batched_grad = vmap(grad(_loss_fn(model, calculator, frozen)))
+    for step in range(max([len(b) for b in batches])):
+        # the clients whose batches have the same shapes at this step are trained together
+        groups = {}
+        for k in range(num_clients):
+            if step >= len(batches[k]): continue
+            key = tuple([(tuple(t.shape), t.dtype) for t in batches[k][step]])
+            groups.setdefault(key, []).append(k)
+        for ks in groups.values():
+            x, y = (torch.stack(ts) for ts in zip(*[calculator.data_to_device(batches[k][step]) for k in ks]))
+            if len(ks) == num_clients:
+                _sgd_step(params, bufs, batched_grad(params, x, y), lrs, weight_decays, momentums, use_momentum, step)
+                continue
+            # the parameters of a part of the clients are gathered and then written back
+            idx = torch.tensor(ks, device=device)
+            ps = {name: p.index_select(0, idx) for name, p in params.items()}
+            bs = None if bufs is None else {name: b.index_select(0, idx) for name, b in bufs.items()}
+            _sgd_step(ps, bs, batched_grad(ps, x, y), lrs[idx], weight_decays[idx], momentums[idx], use_momentum[idx], step)
+            for name in params:
+                params[name].index_copy_(0, idx, ps[name])
+                if bufs is not None: bufs[name].index_copy_(0, idx, bs[name])
+    return [{name: p[k] for name, p in params.items()} for k in range(num_clients)]
+
+def _sgd_step(params, bufs, grads, lrs, weight_decays, momentums, use_momentum, step):
+    """One step of torch.optim.SGD (dampening=0 and nesterov=False) of each client, which is done in place"""
+    with torch.no_grad():
+        for name, p in params.items():
+            shape = (-1,) + (1,) * (p.dim() - 1)
+            d = grads[name].addcmul_(p, weight_decays.view(shape))
+            if bufs is not None:
+                # the momentum buffer is initialized with the gradient at the first step
+                buf = bufs[name].copy_(d) if step == 0 else bufs[name].mul_(momentums.view(shape)).add_(d)
+                d = buf if bool(use_momentum.all()) else torch.where(use_momentum.view(shape), buf, d)
+            p.addcmul_(d, lrs.view(shape), value=-1)
+    return
@@ -0,0 +1,161 @@
+"""
+Codecs of the models uploaded by the clients. A model is encoded with respect to a reference model
+that both the client and the server hold (i.e. the global model that the client received), where the
+float layers are encoded as one flat delta from the reference and the other layers (e.g.
+num_batches_tracked) are sent as they are. A codec is specified by the string 'NAME-p1-p2...':
+    none:     the model itself is sent
+    delta:    the lossless fp32 delta
+    topk-r:   the ratio r of the entries of the delta with the largest magnitudes, where the dropped
+              entries are kept by the client and added to its next update (i.e. error feedback)
+    int8:     the delta stochastically rounded to 8-bit integers with one scale for each layer
+    int4:     the delta stochastically rounded to 4-bit integers with one scale for each layer, where
+              two entries are packed into one byte
+"""
+import math
+import torch
+from utils import fmodule
+from utils.compact_store import float_layers
+
+codec_list = ['none', 'delta', 'topk', 'int8', 'int4']
+
+class EncodedModel:
+    """The encoded model that is sent in place of the model and decoded by the server"""
+    def __init__(self, codec, data, extra, relative=True):
+        # the name of the codec
+        self.codec = codec
+        # the tensors of the encoded flat delta
+        self.data = data
+        # the layers that are not encoded
+        self.extra = extra
+        # whether the delta is from the reference model or from zero (i.e. the model is an update itself)
+        self.relative = relative
+
+    def nbytes(self):
+        """The number of bytes of the tensors"""
+        return sum([v.numel() * v.element_size() for v in list(self.data.values()) + list(self.extra.values())])
+
+class IdentityCodec:
+    name = 'none'
+    active = False
+
+    def encode(self, model, ref=None):
+        return model
+
+    def decode(self, encoded, ref=None):
+        return encoded
+
+class DeltaCodec:
+    name = 'delta'
+    active = True
+
+    def encode(self, model, ref=None):
+        """
+        Encode the model with respect to the reference model
+        :param model: the model to be sent
+        :param ref: the reference model held by both sides, or None if the model is an update itself
+        :return: the encoded model
+        """
+        state = model.state_dict()
+        ref_state = None if ref is None else ref.state_dict()
+        layers = float_layers(state)
+        with torch.no_grad():
+            delta = torch.cat([(state[k] if ref_state is None else state[k] - ref_state[k]).reshape(-1).float() for k in layers])
+            extra = {k: v.detach().clone() for k, v in state.items() if k not in layers}
+            data = self.compress(delta, [state[k].numel() for k in layers])
+        return EncodedModel(self.name, data, extra, relative=ref is not None)
+
+    def decode(self, encoded, ref):
+        """
+        Decode the encoded model into a new model
+        :param encoded: the encoded model
+        :param ref: the reference model that the model was encoded with, which also gives the structure of the model
+        :return: the decoded model
+        """
+        res = fmodule.empty_like(ref)
+        ref_state, out_state = ref.state_dict(), res.state_dict()
+        layers = float_layers(ref_state)
+        delta = self.decompress(encoded.data, [ref_state[k].numel() for k in layers])
+        offset = 0
+        with torch.no_grad():
+            for k in layers:
+                numel = ref_state[k].numel()
+                d = delta[offset:offset + numel].to(device=ref_state[k].device, dtype=ref_state[k].dtype).view(ref_state[k].shape)
+                if encoded.relative: torch.add(ref_state[k], d, out=out_state[k])
+                else: out_state[k].copy_(d)
+                offset += numel
+            for k, v in encoded.extra.items():
+                out_state[k].copy_(v)
+        return res
+
+    def compress(self, delta, sizes):
+        """Compress the flat fp32 delta whose layers have the numbers of entries in sizes into a dict of tensors"""
+        return {'delta': delta}
+
+    def decompress(self, data, sizes):
+        """Recover the flat fp32 delta from the dict of tensors"""
+        return data['delta']
+
+class TopKCodec(DeltaCodec):
+    name = 'topk'
+
+    def __init__(self, ratio=0.01):
+        self.ratio = ratio
+        # the error feedback, i.e. the entries that have not been sent yet
+        self.residual = None
+
+    def compress(self, delta, sizes):
+        if self.residual is not None and self.residual.shape == delta.shape:
+            delta = delta + self.residual.to(delta.device)
+        k = min(delta.numel(), max(1, math.ceil(self.ratio * delta.numel())))
+        indices = delta.abs().topk(k, sorted=False).indices
+        values = delta[indices]
+        self.residual = delta.index_fill_(0, indices, 0.0)
+        return {'indices': indices.to(torch.int32), 'values': values}
+
+    def decompress(self, data, sizes):
+        values = data['values']
+        return values.new_zeros(sum(sizes)).index_put_((data['indices'].long(),), values)
+
+class QuantizationCodec(DeltaCodec):
+    def __init__(self, bits=8):
+        self.bits = bits
+        self.name = 'int{}'.format(bits)
+        self.qmax = 2 ** (bits - 1) - 1
+
+    def compress(self, delta, sizes):
+        # one scale for each layer such that the largest magnitude of the layer is mapped to qmax
+        scales = torch.stack([d.abs().max() if d.numel() > 0 else d.new_zeros(()) for d in delta.split(sizes)]) / self.qmax
+        scales[scales == 0] = 1.0
+        x = delta / torch.repeat_interleave(scales, torch.tensor(sizes, device=delta.device))
+        # stochastic rounding keeps the decoded delta unbiased
+        q = torch.floor(x + torch.rand_like(x)).clamp_(-self.qmax, self.qmax).to(torch.int8)
+        if self.bits == 4:
+            # store q + 8 in [1, 15] as the low and the high halves of one byte
+            q = (q + 8).to(torch.uint8)
+            if q.numel() % 2 == 1: q = torch.cat([q, q.new_zeros(1)])
+            q = q[0::2] | (q[1::2] << 4)
+        return {'q': q, 'scales': scales}
+
+    def decompress(self, data, sizes):
+        q, scales = data['q'], data['scales']
+        if self.bits == 4:
+            q = torch.stack([q & 15, q >> 4], dim=1).reshape(-1)[:sum(sizes)].to(torch.int8) - 8
+        return q.float() * torch.repeat_interleave(scales, torch.tensor(sizes, device=q.device))
+
+def get_codec(spec='none'):
+    """
+    Create the codec from its string, e.g. 'topk-0.01' or 'int8'
+    :param spec: the string of the codec
+    :return: the codec
+    """
+    spec = spec.split('-')
+    name, para = spec[0].lower(), [float(p) for p in spec[1:]]
+    if name == 'none':
+        return IdentityCodec()
+    elif name == 'delta':
+        return DeltaCodec()
+    elif name == 'topk':
+        return TopKCodec(*para)
+    elif name in ['int8', 'int4']:
+        return QuantizationCodec(int(name[3:]))
+    raise ValueError('Unknown codec {}, which should be one of {}'.format(name, codec_list))
@@ -0,0 +1,126 @@
+"""
+Compact storage of client models as reduced-precision deltas from a shared base model (e.g. the
+global model of the round that the clients start from). The float layers of a model are stored as
+one flat delta in bf16/fp16 or in int8 with one scale per layer, and the other layers (e.g.
+num_batches_tracked) are stored as they are. A record of a model is a dict
+    {'precision': str, 'delta': 1D tensor, 'scales': 1D float32 tensor or None, 'extra': {layer: tensor}}
+which is also the format of the compact checkpoints saved by torch.save.
+"""
+import torch
+from utils import fmodule
+
+precision_list = ['fp32', 'bf16', 'fp16', 'int8']
+_dtypes = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def float_layers(state_dict):
+    """The names of the float layers that are stored as deltas"""
+    return [k for k, v in state_dict.items() if v is not None and v.is_floating_point()]
+
+def encode(model_state, base_state, precision='bf16'):
+    """
+    Encode the state dict of a model as the reduced-precision delta from the base state dict
+    :param model_state: the state dict of the model
+    :param base_state: the state dict of the base model
+    :param precision: one of precision_list
+    :return: the record of the model
+    """
+    layers = float_layers(base_state)
+    deltas = [(model_state[k] - base_state[k]).detach().reshape(-1) for k in layers]
+    scales = None
+    if precision == 'int8':
+        # symmetric quantization with one scale for each layer
+        scales = torch.stack([d.abs().max() if d.numel() > 0 else d.new_zeros(()) for d in deltas]).float() / 127.0
+        scales[scales == 0] = 1.0
+        delta = torch.cat([torch.round(d / s).clamp_(-127, 127) for d, s in zip(deltas, scales)]).to(torch.int8)
+    else:
+        delta = torch.cat(deltas).to(_dtypes[precision])
+    extra = {k: v.detach().clone() for k, v in model_state.items() if k not in layers}
+    return {'precision': precision, 'delta': delta.cpu(), 'scales': None if scales is None else scales.cpu(), 'extra': extra}
+
+def decode_into(record, base_state, out_state):
+    """Write base + delta of the record into the tensors of out_state (e.g. the state dict of an allocated model)"""
+    offset = 0
+    with torch.no_grad():
+        for i, k in enumerate(float_layers(base_state)):
+            numel = base_state[k].numel()
+            d = record['delta'][offset:offset + numel].to(device=base_state[k].device, dtype=base_state[k].dtype)
+            if record['scales'] is not None: d = d * record['scales'][i].item()
+            out_state[k].copy_(base_state[k] + d.view(base_state[k].shape))
+            offset += numel
+        for k, v in record['extra'].items():
+            if out_state[k] is not None: out_state[k].copy_(v)
+    return out_state
+
+def record_nbytes(record):
+    """The number of bytes of the tensors in the record"""
+    res = record['delta'].numel() * record['delta'].element_size()
+    if record['scales'] is not None: res += record['scales'].numel() * record['scales'].element_size()
+    return res + sum([v.numel() * v.element_size() for v in record['extra'].values() if v is not None])
+
+class CompactModelStore:
+    """
+    A dict-like store of models that keeps each model as a compact record with respect to the base model.
+    The models are decoded lazily, i.e. only when they are accessed, into newly allocated models.
+    """
+    def __init__(self, base, precision='bf16'):
+        self.base = base
+        self.base_state = base.state_dict()
+        self.precision = precision
+        self.records = {}
+
+    def __setitem__(self, key, model):
+        self.records[key] = encode(model.state_dict(), self.base_state, self.precision)
+
+    def __getitem__(self, key):
+        res = fmodule.empty_like(self.base)
+        decode_into(self.records[key], self.base_state, res.state_dict())
+        return res
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        return self.records.keys()
+
+    def models(self, keys):
+        """A sequence of the models of keys that are decoded one at a time while being iterated"""
+        return _LazyModels(self, list(keys))
+
+    def nbytes(self):
+        return sum([record_nbytes(r) for r in self.records.values()])
+
+    def save(self, key, path):
+        torch.save(self.records[key], path)
+
+def load_checkpoint(path, base):
+    """
+    Load a model saved by CompactModelStore.save or a plain state dict saved by torch.save
+    :param path: the path of the checkpoint
+    :param base: the base model that the record was encoded with, which also gives the model class
+    :return: the loaded model
+    """
+    ckpt = torch.load(path, map_location=base.get_device())
+    res = fmodule.empty_like(base)
+    if isinstance(ckpt, dict) and 'precision' in ckpt and 'delta' in ckpt:
+        decode_into(ckpt, base.state_dict(), res.state_dict())
+    else:
+        res.load_state_dict(ckpt)
+    return res
+
+class _LazyModels:
+    def __init__(self, store, keys):
+        self.store = store
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        return self.store[self.keys[i]]
+
+    def __iter__(self):
+        for key in self.keys:
+            yield self.store[key]
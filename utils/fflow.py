@@ -6,6 +6,9 @@ import os.path
 import importlib
 import os
 import utils.fmodule
+import utils.seeding
+import utils.loader_pool
+import utils.worker_pool
 import ujson
 import time
 import collections
@@ -49,13 +52,19 @@ def read_option():
     parser.add_argument('--cross_validation', help='shuffle each local train_data and valid_data', action="store_true", default=False)
     parser.add_argument('--train_on_all', help='use both train_data and valid_data to train the model;', action="store_true", default=False)
     parser.add_argument('--num_threads', help="the number of threads in the clients computing session", type=int, default=1)
-    parser.add_argument('--num_workers', help='the number of workers of DataLoader', type=int, default=0)
+    parser.add_argument('--num_workers', help='the number of the persistent processes that load the local training data of all the clients', type=int, default=0)
+    parser.add_argument('--max_cached_datasets', help='load the local datasets lazily when they are used and keep at most this number of them in memory, which is only supported by the binary XY fedtasks of BinaryXYTaskPipe (e.g. the XY fedtasks converted by convert_fedtask.py) and is ignored with a warning by the other TaskPipes (0 for loading all of them at the beginning)', type=int, default=0)
+    parser.add_argument('--preload_eval', help='load the batches of the testing and validating datasets on the devices once and reuse them in all the evaluations, where at most --max_cached_datasets datasets are kept if it is positive', action="store_true", default=False)
+    parser.add_argument('--tensor_cache', help='cache the transformed items of the original datasets of IDXTaskPipe as tensors of this dtype, which is only used for the transforms without random augmentation', type=str, choices=['none', 'float32', 'float16'], default='none')
     parser.add_argument('--test_batch_size', help='the batch_size used in testing phase;', type=int, default=512)
+    parser.add_argument('--vmap_clients', help='train the selected clients together by torch.func.vmap when the model and the clients support it (only for num_threads<=1)', action="store_true", default=False)
+    parser.add_argument('--flat_model', help='keep all the parameters and buffers of each model in one contiguous flat tensor to speed up the model arithmetic', action="store_true", default=False)
     # the simulating systemic configuration of clients and the server that helps constructing the heterogeity in the network condition & computing power
     parser.add_argument('--availability', help="client availability mode", type=str, default = 'IDL')
     parser.add_argument('--connectivity', help="client connectivity mode", type=str, default = 'IDL')
     parser.add_argument('--completeness', help="client completeness mode", type=str, default = 'IDL')
     parser.add_argument('--timeliness', help="client response timeliness mode", type=str, default='IDL')
+    parser.add_argument('--codec', help="codec of the models uploaded by clients (none, delta, topk-ratio, int8 or int4)", type=str, default='none')
     # algorithm-dependent hyper-parameters
     parser.add_argument('--algo_para', help='algorithm-dependent hyper-parameters', nargs='*', type=float)
     # logger setting
@@ -72,11 +81,21 @@ def read_option():
     parser.add_argument('--optimal_lambda_samples', help="FL optimal_lambda SV number of samples", type=int, default=300)
     parser.add_argument('--start_round', help="Round when starting calculate FL SV", type=int, default=1)
     parser.add_argument('--round_calSV', help="Round when calculate FL SV in every 10 rounds, otw skip", type=int, default=-1)
+    parser.add_argument('--sv_model_precision', help="Keep the client models for FL SV as deltas from the global model in this precision", type=str, choices=['fp32', 'bf16', 'fp16', 'int8'], default='fp32')
+    parser.add_argument('--sv_compare_precision', help="Compare the exact SV of each round from the client models in --sv_model_precision with those from the fp32 models, which evaluates all the subsets of the selected clients twice per round", action='store_true')
+    parser.add_argument('--save_local_models', help="Save the client models of each round under checkpoint/<task>/local in the format of --sv_model_precision", action='store_true')
     # Ideal/Central SV
     parser.add_argument('--log_folder', help='Store experiment files', type=str, default=None)
     parser.add_argument('--start', help='Id of start subset', type=int, default=1)
     parser.add_argument('--end', help='Id of end subset', type=int, default=-1)
     parser.add_argument('--method', help='How to calculate SV', type=str)
+    parser.add_argument('--sv_sampling', help='Sample the subsets to be trained for ideal SV instead of training all the subsets', type=str, choices=['permutation', 'stratified'], default=None)
+    parser.add_argument('--sv_budget', help='The maximum number of subsets to be trained when sampling ideal SV', type=int, default=-1)
+    parser.add_argument('--sv_precision', help='Stop sampling ideal SV when the half widths of all the confidence intervals are no larger than it', type=float, default=0.005)
+    parser.add_argument('--sv_confidence', help='The confidence level of the intervals of sampled ideal SV', type=float, default=0.95)
+    parser.add_argument('--sv_batch', help='The number of samples drawn in each step of sampling ideal SV', type=int, default=4)
+    parser.add_argument('--sv_workers', help='The number of processes that train subsets in parallel', type=int, default=1)
+    parser.add_argument('--sv_previous_task', help='Reuse the trained subsets of the ideal SV study on this fedtask whose clients are a part of the current ones', type=str, default=None)
     # remote run
     parser.add_argument('--fedtask_path', help='the path of fedtask', type=str, default='fedtask')
     parser.add_argument('--data_path', help='the path of data', type=str)
@@ -114,11 +133,18 @@ def initialize(option):
     # read federated task by TaskPipe
     # init partitioned dataset
     TaskPipe = getattr(importlib.import_module(bmk_core_path), 'TaskPipe')
-    TaskPipe.set_option(option['cross_validation'], option['train_on_all'])
+    TaskPipe.set_option(option['cross_validation'], option['train_on_all'], option['max_cached_datasets'], option['tensor_cache'])
     train_datas, valid_datas, test_data, client_names = TaskPipe.load_task(
         task_path=os.path.join(option['fedtask_path'], option['task']),
         data_path=option['data_path']
     )
+    # only the binary fedtasks load the local datasets lazily (see benchmark.toolkits.BinaryXYTaskPipe)
+    if option['max_cached_datasets'] > 0 and not any(isinstance(d, importlib.import_module('benchmark.toolkits').LazyDataset) for d in train_datas):
+        logger.warning("--max_cached_datasets is ignored since the local datasets of {} are all loaded into memory, where only the binary XY fedtasks of BinaryXYTaskPipe are loaded lazily (the XY fedtasks can be converted by convert_fedtask.py)".format(option['task']))
+    # a worker of utils.worker_pool only keeps the local data of its own clients and does not test the model
+    if option.get('worker_clients', None) is not None:
+        train_datas, valid_datas = utils.worker_pool.keep_own_data(option['worker_clients'], train_datas, valid_datas)
+        test_data = None
     # init model
     try:
         utils.fmodule.Model = getattr(importlib.import_module(bmk_model_path), 'Model')
@@ -151,9 +177,13 @@ def initialize(option):
             logger.info('No client-specific model is used.')
     # init devices
     gpus = option['gpu']
-    utils.fmodule.dev_list = [torch.device('cpu')] if gpus is None else [torch.device('cuda:{}'.format(gpu_id)) for gpu_id in gpus]
+    utils.fmodule.dev_list = [torch.device('cpu')] if not gpus else [torch.device('cuda:{}'.format(gpu_id)) for gpu_id in gpus]
     utils.fmodule.dev_manager = utils.fmodule.get_device()
     utils.fmodule.TaskCalculator = getattr(importlib.import_module(bmk_core_path), 'TaskCalculator')
+    # the preloaded evaluation sets are bounded like the lazily loaded local datasets
+    utils.fmodule.TaskCalculator.set_option(option['preload_eval'], option['max_cached_datasets'])
+    utils.fmodule.flat_storage = option['flat_model']
+    utils.seeding.base_seed = option['seed']
     logger.info('Initializing devices: '+','.join([str(dev) for dev in utils.fmodule.dev_list])+' will be used for this running.')
     # The Model is defined in bmk_model_path as default, whose filename is option['model'] and the classname is 'Model'
     # If an algorithm change the backbone for a task, a modified model should be defined in the path 'algorithm/method_name.py', whose classname is option['model']
@@ -182,6 +212,8 @@ def initialize(option):
     logger.info('Initializing Server: '+'1 server of `{}` being created.'.format(server_path + '.Server'))
     server_module = importlib.import_module(server_path)
     server = getattr(server_module, 'Server')(option, model, clients, test_data = test_data)
+    # fork the processes that load the local training data once for all the clients
+    if option['num_workers'] > 0: utils.loader_pool.start([c.train_data for c in clients], option['num_workers'])
 
     # init virtual systemic configuration including network state and the distribution of computing power
     logger.info('Initializing Systemic Heterogeneity: '+'Availability {}'.format(option['availability']))
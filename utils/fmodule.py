@@ -1,6 +1,18 @@
+import copy
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from torch import nn
 
+# whether to keep all the parameters and buffers of each newly created FModule in contiguous flat tensors
+flat_storage = False
+# the aggregation of models whose float layers have no less than agg_parallel_numel elements is split into
+# shards of agg_shard_numel elements that are reduced by agg_num_threads threads
+agg_num_threads = min(4, os.cpu_count() or 1)
+agg_parallel_numel = 1 << 22
+agg_shard_numel = 1 << 20
+_agg_pool = None
 dev_list = []
 dev_manager = None
 TaskCalculator = None
@@ -13,6 +25,17 @@ class FModule(nn.Module):
     def __init__(self):
         super().__init__()
         self.ingraph = False
+        self._flat_groups = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        init = cls.__init__
+        @functools.wraps(init)
+        def flat_init(self, *args, **kwargs):
+            init(self, *args, **kwargs)
+            # flatten once the outermost __init__ has created all the layers
+            if flat_storage and type(self) is cls: self.flatten()
+        cls.__init__ = flat_init
 
     def __add__(self, other):
         if isinstance(other, int) and other == 0 : return self
@@ -48,6 +71,29 @@ class FModule(nn.Module):
     def zeros_like(self):
         return self*0
 
+    def empty_like(self):
+        return empty_like(self)
+
+    def add_(self, other, alpha=1.0):
+        """In-place self <-- self + alpha * other"""
+        return _model_axpy_(self, alpha, other)
+
+    def sub_(self, other, alpha=1.0):
+        """In-place self <-- self - alpha * other"""
+        return _model_axpy_(self, -alpha, other)
+
+    def axpy_(self, alpha, other):
+        """In-place self <-- alpha * other + self"""
+        return _model_axpy_(self, alpha, other)
+
+    def mul_(self, s):
+        """In-place self <-- s * self"""
+        return _model_scale_(self, s)
+
+    def lerp_(self, other, weight):
+        """In-place self <-- self + weight * (other - self)"""
+        return _model_lerp_(self, other, weight)
+
     def dot(self, other):
         return _model_dot(self, other)
 
@@ -65,6 +111,82 @@ class FModule(nn.Module):
         self.load_state_dict(other.state_dict())
         return
 
+    def clone_into(self, dst):
+        """
+        Copy the parameters and buffers of the model into the allocated model dst with the same
+        structure (one copy for each flat tensor if both are flattened), which is used instead of
+        copy.deepcopy(self) to reuse dst.
+        :return: dst
+        """
+        return _model_copy_(dst, self)
+
+    def flatten(self):
+        """
+        Move all the parameters and buffers into contiguous flat tensors (one for each dtype) and
+        make each of them a view of the flat tensor, so that the model arithmetic in this module
+        runs one kernel on each flat tensor instead of looping over layers. The parameters are placed
+        before the buffers in each flat tensor. Models with shared parameters are left unchanged.
+        """
+        named_tensors = [(name, '_parameters', p) for name, p in self.named_parameters()]
+        named_tensors += [(name, '_buffers', b) for name, b in self.named_buffers() if b is not None]
+        if len(named_tensors) == 0 or len(named_tensors) != len(self.state_dict()):
+            self._flat_groups = None
+            return self
+        groups = {}
+        for name, kind, t in named_tensors:
+            # num_batches_tracked is averaged with weight 1, so it never shares a flat tensor with other layers
+            key = (t.dtype, t.device, 'num_batches_tracked' in name)
+            groups.setdefault(key, []).append((name, kind, t))
+        self._flat_groups = []
+        with torch.no_grad():
+            for (dtype, device, tracked), entries in groups.items():
+                data = torch.empty(sum([t.numel() for _, _, t in entries]), dtype=dtype, device=device)
+                offset = 0
+                num_params = 0
+                for name, kind, t in entries:
+                    view = data[offset:offset + t.numel()].view(t.shape)
+                    view.copy_(t)
+                    module_name, _, attr = name.rpartition('.')
+                    module = self.get_submodule(module_name)
+                    if kind == '_parameters':
+                        module._parameters[attr].data = view
+                        num_params += t.numel()
+                    else:
+                        module._buffers[attr] = view
+                    offset += t.numel()
+                self._flat_groups.append({'data': data, 'tracked': tracked, 'num_params': num_params})
+        return self
+
+    def flat_tensors(self):
+        """Return the flat tensors of the model or None if the model is not flattened"""
+        if self._flat_groups is None: return None
+        return [g['data'] for g in self._flat_groups]
+
+    def _apply(self, fn, *args, **kwargs):
+        res = super()._apply(fn, *args, **kwargs)
+        # moving or casting the model replaces the data of the views, so they are packed again
+        if self._flat_groups is not None and not self._is_flat():
+            self.flatten()
+        return res
+
+    def _is_flat(self):
+        storages = set([g['data'].untyped_storage().data_ptr() for g in self._flat_groups])
+        for t in list(self.parameters()) + [b for b in self.buffers() if b is not None]:
+            if t.untyped_storage().data_ptr() not in storages: return False
+        return True
+
+    def __deepcopy__(self, memo):
+        # deepcopy turns the views into independent tensors unless they are given by memo, and then the copy is flattened again
+        res = self.__class__.__new__(self.__class__)
+        memo[id(self)] = res
+        res.__setstate__(copy.deepcopy({k: v for k, v in self.__dict__.items() if k != '_flat_groups'}, memo))
+        res._flat_groups = None
+        if self._flat_groups is None: return res
+        if all([id(g['data']) in memo for g in self._flat_groups]):
+            res._flat_groups = [dict(g, data=memo[id(g['data'])]) for g in self._flat_groups]
+        if res._flat_groups is None or not res._is_flat(): res.flatten()
+        return res
+
     def freeze_grad(self):
         for p in self.parameters():
             p.requires_grad = False
@@ -108,6 +230,43 @@ class FModule(nn.Module):
 def normalize(m):
     return m/(m**2)
 
+def empty_like(m):
+    """
+    Allocate a model with the same structure, dtypes and device as m without calling __init__,
+    so the weights are not randomly initialized and their values are undefined.
+    """
+    # the parameters and buffers are replaced with uninitialized ones through the memo of deepcopy
+    memo = {}
+    if m._flat_groups is not None:
+        flats = {}
+        for g in m._flat_groups:
+            data = torch.empty_like(g['data'])
+            memo[id(g['data'])] = data
+            flats[g['data'].untyped_storage().data_ptr()] = data
+        new_tensor = lambda t: flats[t.untyped_storage().data_ptr()][t.storage_offset():t.storage_offset() + t.numel()].view(t.shape)
+    else:
+        new_tensor = lambda t: torch.empty_like(t)
+    for p in m.parameters(): memo[id(p)] = nn.Parameter(new_tensor(p.data), requires_grad=p.requires_grad)
+    for b in m.buffers():
+        if b is not None: memo[id(b)] = new_tensor(b)
+    return copy.deepcopy(m, memo)
+
+def lincomb(ms, weights):
+    """
+    Fused linear combination Σ weights[i] * ms[i] that only allocates the result model, which is
+    equal to fmodule._model_sum([mi * wi for mi, wi in zip(ms, weights)]) without the intermediate models.
+    """
+    if len(ms) == 0: return None
+    if sum([mi.ingraph for mi in ms]) > 0: return _model_sum([mi * wi for mi, wi in zip(ms, weights)])
+    res = empty_like(ms[0])
+    flat = _flat_compatible(res, *ms)
+    tms = [_model_tensors(mi, flat) for mi in ms]
+    with torch.no_grad():
+        for k, t in enumerate(_model_tensors(res, flat)):
+            t.zero_()
+            for tm, wi in zip(tms, weights): _tensor_axpy_(t, wi, tm[k])
+    return res
+
 def dot(m1, m2):
     return m1.dot(m2)
 
@@ -124,7 +283,7 @@ def log(m):
 
 def element_wise_func(m, func):
     if m is None: return None
-    res = m.__class__().to(m.get_device())
+    res = m.__class__().to(m.get_device()) if m.ingraph else empty_like(m)
     if m.ingraph:
         res.op_with_graph()
         ml = get_module_from_model(m)
@@ -132,16 +291,208 @@ def element_wise_func(m, func):
             rd = _modeldict_element_wise(md._parameters, func)
             for l in md._parameters.keys():
                 md._parameters[l] = rd[l]
+    elif _flat_compatible(m, res):
+        with torch.no_grad():
+            for gr, g in zip(res.flat_tensors(), m.flat_tensors()): gr.copy_(func(g))
     else:
         _modeldict_cp(res.state_dict(), _modeldict_element_wise(m.state_dict(), func))
     return res
 
+def _flat_compatible(*ms):
+    """Whether the models are all flattened with the same layout and no operation is done with graph"""
+    for m in ms:
+        if m.ingraph or m._flat_groups is None: return False
+    for m in ms[1:]:
+        if len(m._flat_groups) != len(ms[0]._flat_groups): return False
+        for g, g0 in zip(m._flat_groups, ms[0]._flat_groups):
+            if g['data'].shape != g0['data'].shape or g['data'].dtype != g0['data'].dtype or g['num_params'] != g0['num_params']: return False
+    return True
+
+def _flat_param_group(m):
+    """Return the flat tensor that holds all the parameters of the model or None if there is no such one"""
+    if m._flat_groups is None: return None
+    groups = [g for g in m._flat_groups if g['num_params'] > 0]
+    if len(groups) != 1: return None
+    return groups[0]
+
+class StreamingAggregator:
+    """
+    Aggregate the models one by one as they arrive by keeping a single running weighted sum, so that
+    only one model is kept in memory no matter how many models are aggregated. The result is
+        Σ wk * mk                           (default)
+        Σ wk * mk / Σ wk                    (normalize=True)
+        (1 - Σ wk) * base + Σ wk * mk       (begin(base))
+    If unit_tracked is True, num_batches_tracked is summed with weight 1 and never normalized, which is
+    the same as fmodule._model_average. Otherwise, the non-float buffers are truncated once per model
+    like `Σ mk * (wk / Σ wk)` of FModules when normalize=True, so they are kept until finalize.
+    """
+    def __init__(self, normalize=False, unit_tracked=False):
+        self.normalize = normalize
+        self.unit_tracked = unit_tracked
+        self.active = False
+        self.sum = None
+        self.base = None
+        self.total_weight = 0.0
+        self.num_models = 0
+        # (weight, the non-float buffers) of each added model, which are normalized per model by finalize
+        self.deferred = []
+
+    def begin(self, base=None):
+        """
+        Start a new aggregation
+        :param base: the model that takes the remaining weight 1 - Σ wk in the result
+        :return: the aggregator itself
+        """
+        self.active = True
+        self.sum = None
+        self.base = base
+        self.total_weight = 0.0
+        self.num_models = 0
+        self.deferred = []
+        return self
+
+    def add(self, model, weight=1.0):
+        """Add weight * model (or a delta of models) into the running sum"""
+        _check_inplace(model)
+        with torch.no_grad():
+            if self.sum is None:
+                self.sum = empty_like(model)
+                for t in _model_tensors(self.sum): t.zero_()
+            flat = _flat_compatible(self.sum, model)
+            for t, tracked, x in zip(_model_tensors(self.sum, flat), _model_tracked(self.sum, flat), _model_tensors(model, flat)):
+                _tensor_axpy_(t, 1 if tracked and self.unit_tracked else weight, x)
+            if self.normalize:
+                self.deferred.append((float(weight), [x.clone() for x, tracked in zip(_model_tensors(model), _model_tracked(model)) if not x.is_floating_point() and not (tracked and self.unit_tracked)]))
+        self.total_weight += float(weight)
+        self.num_models += 1
+        return self
+
+    def finalize(self):
+        """
+        Finish the aggregation
+        :return: the aggregated model or None if no model was added
+        """
+        self.active = False
+        res, self.sum = self.sum, None
+        deferred, self.deferred = self.deferred, []
+        if res is None: return None
+        flat = _flat_compatible(res)
+        with torch.no_grad():
+            for t, tracked in zip(_model_tensors(res, flat), _model_tracked(res, flat)):
+                if self.normalize and self.total_weight != 0 and not (tracked and self.unit_tracked) and t.is_floating_point():
+                    t.div_(self.total_weight)
+            if self.normalize and self.total_weight != 0:
+                ts = [t for t, tracked in zip(_model_tensors(res), _model_tracked(res)) if not t.is_floating_point() and not (tracked and self.unit_tracked)]
+                for k, t in enumerate(ts):
+                    t.zero_()
+                    for wk, xs in deferred: _tensor_axpy_(t, wk / self.total_weight, xs[k])
+            if self.base is not None:
+                _model_axpy_(res, 1.0 - self.total_weight, self.base)
+        self.base = None
+        return res
+
+class ModelPool:
+    """
+    A pool of allocated models keyed by the model class and the device. acquire(m) loads the
+    weights of m into a free model of the pool by clone_into (or into a newly allocated one if there
+    is no free model), and release(m) takes a model back once it will never be used anywhere else.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.free = {}
+
+    def acquire(self, m):
+        """Return a copy of m that is a free model of the pool if possible"""
+        free = self.free.get((type(m), m.get_device()), [])
+        dst = free.pop() if len(free) > 0 else empty_like(m)
+        return m.clone_into(dst)
+
+    def release(self, *ms):
+        """Put the models back into the pool"""
+        for m in ms:
+            if m is None or not isinstance(m, FModule): continue
+            free = self.free.setdefault((type(m), m.get_device()), [])
+            if len(free) < self.max_size and all([mi is not m for mi in free]): free.append(m)
+        return
+
+    def clear(self):
+        self.free = {}
+
+    def __len__(self):
+        return sum([len(v) for v in self.free.values()])
+
+def _model_copy_(m, x):
+    """In-place m <-- x, where the state (i.e. gradients, training mode and requires_grad) of m is also reset to that of x"""
+    with torch.no_grad():
+        if _flat_compatible(m, x):
+            torch._foreach_copy_(m.flat_tensors(), x.flat_tensors())
+        else:
+            tms, txs = _model_tensors(m), _model_tensors(x)
+            if len(tms) != len(txs) or any([tm.shape != tx.shape for tm, tx in zip(tms, txs)]):
+                raise RuntimeError('Cannot copy the model into a model with different structure.')
+            torch._foreach_copy_(tms, txs)
+    for pm, px in zip(m.parameters(), x.parameters()):
+        pm.grad = None
+        pm.requires_grad_(px.requires_grad)
+    m.train(x.training)
+    m.ingraph = x.ingraph
+    return m
+
+def _model_tracked(m, flat=False):
+    """Whether each tensor of _model_tensors(m, flat) is num_batches_tracked"""
+    if flat: return [g['tracked'] for g in m._flat_groups]
+    return ["num_batches_tracked" in name for name, _ in m.named_parameters()] + ["num_batches_tracked" in name for name, b in m.named_buffers() if b is not None]
+
+def _model_tensors(m, flat=False):
+    """The tensors that hold all the parameters and buffers of the model, which can be modified in place"""
+    if flat: return m.flat_tensors()
+    return [p.data for p in m.parameters()] + [b for b in m.buffers() if b is not None]
+
+def _tensor_axpy_(y, a, x):
+    if y.is_floating_point(): y.add_(x, alpha=float(a))
+    # the non-float buffers (e.g. num_batches_tracked) are truncated like `y + x * a` of FModules
+    else: y.add_(torch.trunc(x * a).to(y.dtype))
+
+def _check_inplace(*ms):
+    for m in ms:
+        if m.ingraph: raise RuntimeError('In-place operations are not supported for the models that are operated with graph.')
+
+def _model_axpy_(m, a, x):
+    _check_inplace(m, x)
+    with torch.no_grad():
+        flat = _flat_compatible(m, x)
+        for tm, tx in zip(_model_tensors(m, flat), _model_tensors(x, flat)): _tensor_axpy_(tm, a, tx)
+    return m
+
+def _model_scale_(m, s):
+    _check_inplace(m)
+    with torch.no_grad():
+        for t in _model_tensors(m, _flat_compatible(m)):
+            if t.is_floating_point(): t.mul_(float(s))
+            else: t.copy_(t * s)
+    return m
+
+def _model_lerp_(m, x, w):
+    _check_inplace(m, x)
+    with torch.no_grad():
+        flat = _flat_compatible(m, x)
+        for tm, tx in zip(_model_tensors(m, flat), _model_tensors(x, flat)):
+            if tm.is_floating_point(): tm.lerp_(tx, float(w))
+            else: tm.copy_(torch.trunc(tm * (1 - w)) + torch.trunc(tx * w))
+    return m
+
 def _model_to_tensor(m):
+    g = _flat_param_group(m)
+    if g is not None: return g['data'][:g['num_params']].detach().clone()
     return torch.cat([mi.data.view(-1) for mi in m.parameters()])
 
 def _model_from_tensor(mt, model_class=None):
     if model_class is None: model_class = Model
     res = model_class().to(mt.device)
+    g = _flat_param_group(res)
+    if g is not None and g['num_params'] == mt.numel():
+        with torch.no_grad(): g['data'][:g['num_params']].copy_(mt)
+        return res
     cnt = 0
     end = 0
     with torch.no_grad():
@@ -155,7 +506,7 @@ def _model_from_tensor(mt, model_class=None):
 def _model_sum(ms):
     if len(ms)==0: return None
     op_with_graph = sum([mi.ingraph for mi in ms]) > 0
-    res = ms[0].__class__().to(ms[0].get_device())
+    res = ms[0].__class__().to(ms[0].get_device()) if op_with_graph else empty_like(ms[0])
     if op_with_graph:
         mlks = [get_module_from_model(mi) for mi in ms]
         mlr = get_module_from_model(res)
@@ -166,6 +517,11 @@ def _model_sum(ms):
                 if mlr[n]._parameters[l] is None: continue
                 mlr[n]._parameters[l] = rd[l]
         res.op_with_graph()
+    elif _flat_compatible(res, *ms):
+        with torch.no_grad():
+            for k, gr in enumerate(res.flat_tensors()):
+                gr.zero_()
+                for mi in ms: gr.add_(mi.flat_tensors()[k])
     else:
         _modeldict_cp(res.state_dict(), _modeldict_sum([mi.state_dict() for mi in ms]))
     return res
@@ -174,7 +530,7 @@ def _model_average(ms = [], p = []):
     if len(ms)==0: return None
     if len(p)==0: p = [1.0 / len(ms) for _ in range(len(ms))]
     op_with_graph = sum([w.ingraph for w in ms]) > 0
-    res = ms[0].__class__().to(ms[0].get_device())
+    res = ms[0].__class__().to(ms[0].get_device()) if op_with_graph else empty_like(ms[0])
     if op_with_graph:
         mlks = [get_module_from_model(mi) for mi in ms]
         mlr = get_module_from_model(res)
@@ -185,13 +541,19 @@ def _model_average(ms = [], p = []):
                 if mlr[n]._parameters[l] is None: continue
                 mlr[n]._parameters[l] = rd[l]
         res.op_with_graph()
+    elif _flat_compatible(res, *ms):
+        with torch.no_grad():
+            for k, g in enumerate(res._flat_groups):
+                acc = torch.zeros_like(g['data'])
+                for mi, pi in zip(ms, p): acc = acc + mi.flat_tensors()[k] * (1 if g['tracked'] else pi)
+                g['data'].copy_(acc)
     else:
         _modeldict_cp(res.state_dict(), _modeldict_weighted_average([mi.state_dict() for mi in ms], p))
     return res
 
 def _model_add(m1, m2):
     op_with_graph = m1.ingraph or m2.ingraph
-    res = m1.__class__().to(m1.get_device())
+    res = m1.__class__().to(m1.get_device()) if op_with_graph else empty_like(m1)
     if op_with_graph:
         res.op_with_graph()
         ml1 = get_module_from_model(m1)
@@ -202,13 +564,16 @@ def _model_add(m1, m2):
             for l in nr._parameters.keys():
                 if nr._parameters[l] is None: continue
                 nr._parameters[l] = rd[l]
+    elif _flat_compatible(res, m1, m2):
+        with torch.no_grad():
+            for gr, g1, g2 in zip(res.flat_tensors(), m1.flat_tensors(), m2.flat_tensors()): gr.copy_(g1 + g2)
     else:
         _modeldict_cp(res.state_dict(), _modeldict_add(m1.state_dict(), m2.state_dict()))
     return res
 
 def _model_sub(m1, m2):
     op_with_graph = m1.ingraph or m2.ingraph
-    res = m1.__class__().to(m1.get_device())
+    res = m1.__class__().to(m1.get_device()) if op_with_graph else empty_like(m1)
     if op_with_graph:
         res.op_with_graph()
         ml1 = get_module_from_model(m1)
@@ -219,13 +584,16 @@ def _model_sub(m1, m2):
             for l in nr._parameters.keys():
                 if nr._parameters[l] is None: continue
                 nr._parameters[l] = rd[l]
+    elif _flat_compatible(res, m1, m2):
+        with torch.no_grad():
+            for gr, g1, g2 in zip(res.flat_tensors(), m1.flat_tensors(), m2.flat_tensors()): gr.copy_(g1 - g2)
     else:
         _modeldict_cp(res.state_dict(), _modeldict_sub(m1.state_dict(), m2.state_dict()))
     return res
 
 def _model_scale(m, s):
     op_with_graph = m.ingraph
-    res = m.__class__().to(m.get_device())
+    res = m.__class__().to(m.get_device()) if op_with_graph else empty_like(m)
     if op_with_graph:
         ml = get_module_from_model(m)
         mlr = get_module_from_model(res)
@@ -235,6 +603,9 @@ def _model_scale(m, s):
             for l in nr._parameters.keys():
                 if nr._parameters[l] is None: continue
                 nr._parameters[l] = rd[l]
+    elif _flat_compatible(res, m):
+        with torch.no_grad():
+            for gr, g in zip(res.flat_tensors(), m.flat_tensors()): gr.copy_(g * s)
     else:
         _modeldict_cp(res.state_dict(), _modeldict_scale(m.state_dict(), s))
     return res
@@ -250,6 +621,12 @@ def _model_norm(m, power=2):
                 if n._parameters[l].dtype not in [torch.float, torch.float32, torch.float64]: continue
                 res += torch.sum(torch.pow(n._parameters[l], power))
         return torch.pow(res, 1.0 / power)
+    elif _flat_compatible(m):
+        with torch.no_grad():
+            for g in m.flat_tensors():
+                if g.dtype not in [torch.float, torch.float32, torch.float64]: continue
+                res += torch.sum(torch.pow(g, power))
+        return torch.pow(res, 1.0 / power)
     else:
         return _modeldict_norm(m.state_dict(), power)
 
@@ -262,6 +639,11 @@ def _model_dot(m1, m2):
         for n1, n2 in zip(ml1, ml2):
             res += _modeldict_dot(n1._parameters, n2._parameters)
         return res
+    elif _flat_compatible(m1, m2):
+        res = torch.tensor(0.).to(m1.get_device())
+        with torch.no_grad():
+            for g1, g2 in zip(m1.flat_tensors(), m2.flat_tensors()): res += g1.dot(g2)
+        return res
     else:
         return _modeldict_dot(m1.state_dict(), m2.state_dict())
 
@@ -300,31 +682,66 @@ def _modeldict_cp(md1, md2):
 
 def _modeldict_sum(mds):
     if len(mds)==0: return None
-    md_sum = {}
-    for layer in mds[0].keys():
-        md_sum[layer] = torch.zeros_like(mds[0][layer])
-    for wid in range(len(mds)):
-        for layer in md_sum.keys():
-            if mds[0][layer] is None:
-                md_sum[layer] = None
-                continue
-            md_sum[layer] = md_sum[layer] + mds[wid][layer]
-    return md_sum
+    return _modeldict_fused_sum(mds)
 
 def _modeldict_weighted_average(mds, weights=[]):
     if len(mds)==0:
         return None
-    md_avg = {}
-    for layer in mds[0].keys(): md_avg[layer] = torch.zeros_like(mds[0][layer])
     if len(weights) == 0: weights = [1.0 / len(mds) for _ in range(len(mds))]
-    for wid in range(len(mds)):
-        for layer in md_avg.keys():
-            if mds[0][layer] is None:
-                md_avg[layer] = None
-                continue
-            weight = weights[wid] if "num_batches_tracked" not in layer else 1
-            md_avg[layer] = md_avg[layer] + mds[wid][layer] * weight
-    return md_avg
+    return _modeldict_fused_sum(mds, weights)
+
+def _modeldict_fused_sum(mds, weights=None):
+    """
+    Σ weights[i] * mds[i] (or Σ mds[i] if weights is None) where num_batches_tracked is weighted by 1.
+    The float layers without graph are accumulated by one multi-tensor kernel per model, and the
+    other layers (i.e. the non-float ones and the ones that require grad) are accumulated layer by layer.
+    """
+    res = {}
+    fused_layers = []
+    for layer in mds[0].keys():
+        if mds[0][layer] is None:
+            res[layer] = None
+            continue
+        tracked = "num_batches_tracked" in layer
+        if (weights is not None and tracked) or not mds[0][layer].is_floating_point() or any([md[layer].requires_grad for md in mds]):
+            res[layer] = torch.zeros_like(mds[0][layer])
+            for wid in range(len(mds)):
+                if weights is None: res[layer] = res[layer] + mds[wid][layer]
+                else: res[layer] = res[layer] + mds[wid][layer] * (weights[wid] if not tracked else 1)
+        else:
+            res[layer] = torch.zeros_like(mds[0][layer])
+            fused_layers.append(layer)
+    if len(fused_layers) == 0: return res
+    # split the layers into pieces of flat views so that a large layer can be reduced by several threads
+    pieces = []
+    for layer in fused_layers:
+        numel = res[layer].numel()
+        if numel <= agg_shard_numel or not (res[layer].is_contiguous() and all([md[layer].is_contiguous() for md in mds])):
+            pieces.append((layer, None, None))
+        else:
+            pieces.extend([(layer, beg, min(beg + agg_shard_numel, numel)) for beg in range(0, numel, agg_shard_numel)])
+    view = lambda t, beg, end: t if beg is None else t.view(-1)[beg:end]
+    def reduce(shard):
+        accs = [view(res[layer], beg, end) for layer, beg, end in shard]
+        for wid in range(len(mds)):
+            tensors = [view(mds[wid][layer], beg, end) for layer, beg, end in shard]
+            alpha = 1.0 if weights is None else float(weights[wid])
+            torch._foreach_add_(accs, tensors, alpha=alpha)
+    total_numel = sum([res[layer].numel() for layer in fused_layers])
+    if agg_num_threads <= 1 or total_numel < agg_parallel_numel or len(pieces) <= 1:
+        reduce(pieces)
+        return res
+    # shards with balanced numbers of elements
+    shards = [[] for _ in range(agg_num_threads)]
+    loads = [0 for _ in range(agg_num_threads)]
+    for piece in sorted(pieces, key=lambda x: -(res[x[0]].numel() if x[1] is None else x[2] - x[1])):
+        k = loads.index(min(loads))
+        shards[k].append(piece)
+        loads[k] += res[piece[0]].numel() if piece[1] is None else piece[2] - piece[1]
+    global _agg_pool
+    if _agg_pool is None: _agg_pool = ThreadPoolExecutor(max_workers=agg_num_threads)
+    list(_agg_pool.map(reduce, [shard for shard in shards if len(shard) > 0]))
+    return res
 
 def _modeldict_to_device(md):
     device = md[list(md)[0]].device
@@ -390,12 +807,9 @@ def _modeldict_norm(md, p=2):
     return torch.pow(res, 1.0/p)
 
 def _modeldict_to_tensor1D(md):
-    res = torch.Tensor().type_as(md[list(md)[0]]).to(md[list(md)[0]].device)
-    for layer in md.keys():
-        if md[layer] is None:
-            continue
-        res = torch.cat((res, md[layer].view(-1)))
-    return res
+    res = [md[layer].view(-1) for layer in md.keys() if md[layer] is not None]
+    if len(res) == 0: return torch.Tensor().type_as(md[list(md)[0]]).to(md[list(md)[0]].device)
+    return torch.cat(res)
 
 def _modeldict_dot(md1, md2):
     res = torch.tensor(0.).to(md1[list(md1)[0]].device)
@@ -0,0 +1,371 @@
+"""
+Ideal Shapley value (SV) of clients in FL, where the utility of a subset of clients
+is the test accuracy reached by the model federatedly trained on that subset only.
+
+The exhaustive way (see main_ideal.py) trains every nonempty subset, which costs 2^n
+trainings and limits the study to about 12 clients. This module provides the pieces
+to estimate the ideal SV from a budgeted set of subsets instead:
+    1) SubsetResultStore: the utilities of the trained subsets, which are read from the
+       records saved by the logger as `<output_name>_<bits>.json`,
+    2) SubsetScheduler: draws permutation or stratified samples and tells which subsets
+       have to be trained for them,
+    3) PermutationEstimator / StratifiedEstimator: accumulate the marginal contributions
+       of the samples and provide SV with confidence intervals.
+The subset of clients is keyed by the string of bits used across this project (i.e.
+bitsets' `bits()`), where the i-th char is '1' iff the i-th client is a member.
+"""
+import os
+import math
+import itertools
+import statistics
+import numpy as np
+import torch.multiprocessing as mp
+import utils.fflow as flw
+from utils import seeding
+
+try:
+    import ujson as json
+except:
+    import json
+
+def members_to_bits(members, num_clients):
+    """Convert the indices of the member clients into the string of bits"""
+    bits = ['0' for _ in range(num_clients)]
+    for cid in members: bits[cid] = '1'
+    return ''.join(bits)
+
+def bits_to_members(bits):
+    """Convert the string of bits into the indices of the member clients"""
+    return [cid for cid, b in enumerate(bits) if b == '1']
+
+def bits_to_int(bits):
+    """Convert the string of bits into the integer whose i-th bit indicates the i-th client"""
+    return int(bits[::-1], 2)
+
+def int_to_bits(mask, num_clients):
+    """Convert the integer mask into the string of bits"""
+    return format(mask, '0{}b'.format(num_clients))[::-1]
+
+def get_record_path(option, task=None):
+    """The directory where the logger saves the records of the task (see basic_logger.Logger.save_output_as_json)"""
+    if task is None: task = option['task']
+    if option['log_folder']:
+        return os.path.join(option['log_folder'], task)
+    return os.path.join('fedtask', task, 'record')
+
+def get_client_names(task):
+    """The names of the clients of the task, which are created by BasicTaskGen.get_client_names()"""
+    num_clients = int(task[task.find('cnum') + 4:].split('_')[0])
+    k = str(len(str(num_clients)))
+    return [('Client{:0>' + k + 'd}').format(i) for i in range(num_clients)]
+
+def map_client_names(old_names, new_names):
+    """
+    Map each client of a previous study to its index in the current study. Clients are matched by
+    their names or else by the numbers in their names (e.g. 'Client9' and 'Client09').
+    :return: a list where the i-th item is the new index of the i-th old client or None if it is missing
+    """
+    def number(name):
+        digits = ''.join(ch for ch in name if ch.isdigit())
+        return int(digits) if digits else None
+    res = []
+    for name in old_names:
+        if name in new_names:
+            res.append(new_names.index(name))
+            continue
+        matched = [nid for nid, new_name in enumerate(new_names) if number(new_name) is not None and number(new_name) == number(name)]
+        res.append(matched[0] if len(matched) == 1 else None)
+    return res
+
+class SubsetResultStore:
+    def __init__(self, record_path, prefix, num_clients, metric='test_accuracy', reduce='max'):
+        """
+        The utilities of the subsets of clients that have already been trained.
+        :param record_path: the directory of the records
+        :param prefix: the output name of the records without the suffix of bits (e.g. 'fedavg_Mcnn_R50_..._TIDL')
+        :param num_clients: the number of clients
+        :param metric: the key of the recorded metric used as the utility
+        :param reduce: 'max' or 'last', the way to reduce the recorded curve of the metric into the utility
+        """
+        self.record_path = record_path
+        self.prefix = prefix
+        self.num_clients = num_clients
+        self.metric = metric
+        self.reduce = reduce
+        self.utilities = {}
+        self.refresh()
+
+    def refresh(self):
+        """Scan self.record_path and load the utilities of the newly saved subsets"""
+        if not os.path.exists(self.record_path): return
+        for filename in os.listdir(self.record_path):
+            bits = self.parse_filename(filename)
+            if bits is None or bits in self.utilities: continue
+            utility = self.read_record(os.path.join(self.record_path, filename))
+            if utility is not None: self.utilities[bits] = utility
+        return
+
+    def parse_filename(self, filename):
+        """Return the bits of the record `filename` or None if it is not a record of this study"""
+        head = self.prefix + '_'
+        if not filename.startswith(head) or not filename.endswith('.json'): return None
+        bits = filename[len(head):-len('.json')]
+        if len(bits) != self.num_clients or set(bits) - {'0', '1'}: return None
+        return bits
+
+    def read_record(self, filepath):
+        try:
+            with open(filepath, 'r') as inf:
+                curve = json.load(inf)[self.metric]
+        except:
+            return None
+        if len(curve) == 0: return None
+        return float(max(curve)) if self.reduce == 'max' else float(curve[-1])
+
+    def import_study(self, record_path, old_client_names, new_client_names, prefix=None):
+        """
+        Load the utilities of a previous study on a part of the current clients (e.g. the study before a
+        client is added) and map their subsets into the bits of the current clients. The local data of the
+        matched clients should be the same in the two studies. The subsets that contain the clients missing
+        in the current study are skipped.
+        :param record_path: the directory of the records of the previous study
+        :param old_client_names: the names of the clients in the previous study
+        :param new_client_names: the names of the clients in the current study
+        :param prefix: the output name of the previous records (the same as self.prefix as default)
+        :return: the number of the imported subsets
+        """
+        old_store = SubsetResultStore(record_path, self.prefix if prefix is None else prefix, len(old_client_names), self.metric, self.reduce)
+        new_ids = map_client_names(old_client_names, new_client_names)
+        count = 0
+        for old_bits, utility in old_store.utilities.items():
+            members = bits_to_members(old_bits)
+            if any(new_ids[cid] is None for cid in members): continue
+            bits = members_to_bits([new_ids[cid] for cid in members], self.num_clients)
+            if bits in self.utilities: continue
+            self.utilities[bits] = utility
+            count += 1
+        return count
+
+    def put(self, bits, utility):
+        self.utilities[bits] = utility
+
+    def utility(self, bits):
+        """The utility of the empty subset is 0"""
+        if '1' not in bits: return 0.0
+        return self.utilities[bits]
+
+    def __contains__(self, bits):
+        return ('1' not in bits) or (bits in self.utilities)
+
+    def __len__(self):
+        return len(self.utilities)
+
+    def to_table(self):
+        """
+        Return the utilities as an array indexed by the integer mask of the subset
+        (np.nan for the subsets that are not trained yet).
+        """
+        table = np.full(pow(2, self.num_clients), np.nan)
+        table[0] = 0.0
+        for bits, utility in self.utilities.items():
+            table[bits_to_int(bits)] = utility
+        return table
+
+def missing_subsets(store, start=1, end=-1):
+    """The bits of the subsets with integer masks in [start, end) that are not in the store"""
+    if end == -1: end = pow(2, store.num_clients)
+    return [bits for bits in (int_to_bits(mask, store.num_clients) for mask in range(max(1, start), end)) if bits not in store]
+
+def shapley_from_table(table, num_clients):
+    """
+    Compute the exact SV from the complete table of utilities, where
+    SV_i = Σ_{S⊆N\{i}} |S|!(n-|S|-1)!/n! * (v(S∪{i})-v(S)).
+    :param table: the array of utilities indexed by the integer mask of the subset
+    :param num_clients: the number of clients
+    :return: the array of SV of clients
+    """
+    if np.any(np.isnan(table)): raise RuntimeError("The utilities of some subsets are missing.")
+    masks = np.arange(len(table))
+    sizes = np.array([bin(m).count('1') for m in masks])
+    weights = np.array([math.factorial(s) * math.factorial(num_clients - s - 1) / math.factorial(num_clients) if s < num_clients else 0.0 for s in range(num_clients + 1)])
+    sv = np.zeros(num_clients)
+    for cid in range(num_clients):
+        without_i = masks[(masks >> cid) & 1 == 0]
+        sv[cid] = (weights[sizes[without_i]] * (table[without_i | (1 << cid)] - table[without_i])).sum()
+    return sv
+
+class SubsetScheduler:
+    def __init__(self, num_clients, sampling='permutation', seed=0):
+        """
+        Draw the samples of the SV estimator and schedule the subsets to be trained.
+        :param num_clients: the number of clients
+        :param sampling: 'permutation' draws random orders of all the clients, and
+                         'stratified' draws for each (client i, size k) a random subset S of the
+                         other clients with |S|=k in a round-robin way
+        :param seed: random seed
+        """
+        if sampling not in ['permutation', 'stratified']: raise RuntimeError("Unknown sampling method {}.".format(sampling))
+        self.num_clients = num_clients
+        self.sampling = sampling
+        self.random_module = np.random.RandomState(seed)
+        self._strata = itertools.cycle([(cid, k) for k in range(num_clients) for cid in range(num_clients)])
+
+    def draw(self, num_samples):
+        """
+        :param num_samples: the number of samples
+        :return: a list of samples, where a sample is a permutation (list of client ids) or a tuple (client id, list of client ids)
+        """
+        if self.sampling == 'permutation':
+            return [self.random_module.permutation(self.num_clients).tolist() for _ in range(num_samples)]
+        samples = []
+        for _ in range(num_samples):
+            cid, k = next(self._strata)
+            others = [c for c in range(self.num_clients) if c != cid]
+            samples.append((cid, sorted(self.random_module.choice(others, k, replace=False).tolist())))
+        return samples
+
+    def required_subsets(self, samples):
+        """The bits of the subsets whose utilities are needed by the samples (without duplicates and in a stable order)"""
+        res = []
+        for sample in samples:
+            if self.sampling == 'permutation':
+                subsets = [sample[:k] for k in range(1, self.num_clients + 1)]
+            else:
+                cid, subset = sample
+                subsets = [subset, subset + [cid]]
+            for members in subsets:
+                bits = members_to_bits(members, self.num_clients)
+                if '1' in bits and bits not in res: res.append(bits)
+        return res
+
+    def schedule(self, samples, store):
+        """The bits of the subsets that are required by the samples but not trained yet"""
+        return [bits for bits in self.required_subsets(samples) if bits not in store]
+
+class PermutationEstimator:
+    def __init__(self, num_clients):
+        """Monte-Carlo estimator of SV by the marginal contributions along random permutations"""
+        self.num_clients = num_clients
+        self.contributions = [[] for _ in range(num_clients)]
+
+    def add(self, sample, store):
+        prev = members_to_bits([], self.num_clients)
+        for k in range(1, self.num_clients + 1):
+            crt = members_to_bits(sample[:k], self.num_clients)
+            self.contributions[sample[k - 1]].append(store.utility(crt) - store.utility(prev))
+            prev = crt
+
+    @property
+    def num_samples(self):
+        return min(len(c) for c in self.contributions)
+
+    def values(self):
+        return np.array([np.mean(c) if len(c) > 0 else np.nan for c in self.contributions])
+
+    def variances(self):
+        """The variances of the estimated SV (i.e. the sample variance over the number of samples)"""
+        return np.array([np.var(c, ddof=1) / len(c) if len(c) > 1 else np.inf for c in self.contributions])
+
+class StratifiedEstimator:
+    def __init__(self, num_clients):
+        """
+        Stratified estimator of SV where SV_i = 1/n Σ_k E_{|S|=k}[v(S∪{i})-v(S)]. The strata
+        with only one subset (i.e. k=0 and k=n-1) are exact once they are sampled.
+        """
+        self.num_clients = num_clients
+        self.contributions = [[[] for _ in range(num_clients)] for _ in range(num_clients)]
+
+    def add(self, sample, store):
+        cid, subset = sample
+        without_i = members_to_bits(subset, self.num_clients)
+        with_i = members_to_bits(subset + [cid], self.num_clients)
+        self.contributions[cid][len(subset)].append(store.utility(with_i) - store.utility(without_i))
+
+    @property
+    def num_samples(self):
+        return min(len(s) for c in self.contributions for s in c)
+
+    def values(self):
+        return np.array([np.mean([np.mean(s) if len(s) > 0 else np.nan for s in c]) for c in self.contributions])
+
+    def variances(self):
+        res = np.zeros(self.num_clients)
+        for cid, c in enumerate(self.contributions):
+            for k, s in enumerate(c):
+                if math.comb(self.num_clients - 1, k) == 1 and len(s) > 0: continue
+                res[cid] += np.var(s, ddof=1) / len(s) if len(s) > 1 else np.inf
+        return res / self.num_clients ** 2
+
+def confidence_intervals(estimator, confidence=0.95):
+    """Return the half widths of the normal confidence intervals of the estimated SV"""
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    return z * np.sqrt(estimator.variances())
+
+def train_subset(option, bits):
+    """
+    Federatedly train the model on the subset of clients `bits` in the same way as main_ideal.py,
+    where the result is saved by the logger as `<output_name>_<bits>.json`.
+    """
+    flw.setup_seed(option['seed'])
+    server = flw.initialize(option)
+    server.clients = [server.clients[cid] for cid in bits_to_members(bits)]
+    server.num_clients = len(server.clients)
+    server.local_data_vols = [c.datavol for c in server.clients]
+    server.total_data_vol = sum(server.local_data_vols)
+    try:
+        server.run(suffix_log_filename=bits)
+    except:
+        # log the exception that happens during training-time
+        flw.logger.exception("Exception Logged")
+        raise RuntimeError
+    return bits
+
+def _init_worker():
+    # the spawned workers do not log to wandb, but the algorithms save their records by wandb.save after training
+    import wandb
+    wandb.init(mode='disabled')
+
+def train_subsets(option, subsets, num_workers=1):
+    """Train the subsets iteratively or in parallel with `num_workers` processes"""
+    if len(subsets) == 0: return
+    if num_workers <= 1:
+        for bits in subsets: train_subset(option, bits)
+        return
+    with mp.get_context('spawn').Pool(num_workers, initializer=_init_worker) as pool:
+        pool.starmap(train_subset, [(option, bits) for bits in subsets])
+    return
+
+def sampling_ideal_shapley(option, store, num_clients, callback=None):
+    """
+    Estimate the ideal SV by training only the sampled subsets until the half widths of the
+    confidence intervals of all the clients are no larger than option['sv_precision'] or the
+    number of trained subsets reaches option['sv_budget'].
+    :param option: the running option
+    :param store: an instance of SubsetResultStore
+    :param num_clients: the number of clients
+    :param callback: called as callback(values, half_widths, num_trained) after each step
+    :return: the estimated SV and the half widths of their confidence intervals
+    """
+    scheduler = SubsetScheduler(num_clients, option['sv_sampling'], seeding.seed_of('sv'))
+    estimator = PermutationEstimator(num_clients) if option['sv_sampling'] == 'permutation' else StratifiedEstimator(num_clients)
+    budget = option['sv_budget'] if option['sv_budget'] > 0 else np.inf
+    num_trained = 0
+    while True:
+        samples = scheduler.draw(option['sv_batch'])
+        subsets = scheduler.schedule(samples, store)
+        # the last step trains the subsets within the budget and only uses the samples whose subsets are all trained
+        out_of_budget = num_trained + len(subsets) > budget
+        if out_of_budget: subsets = subsets[:int(budget - num_trained)]
+        train_subsets(option, subsets, option['sv_workers'])
+        num_trained += len(subsets)
+        store.refresh()
+        for sample in samples:
+            if all(bits in store for bits in scheduler.required_subsets([sample])): estimator.add(sample, store)
+        half_widths = confidence_intervals(estimator, option['sv_confidence'])
+        if callback is not None: callback(estimator.values(), half_widths, num_trained)
+        if out_of_budget:
+            flw.logger.info('The budget of {} trained subsets is reached.'.format(option['sv_budget']))
+            if np.any(np.isnan(estimator.values())): flw.logger.warn('The budget is too small to sample the contributions of all the clients, whose SV are nan.')
+            break
+        if np.all(half_widths <= option['sv_precision']): break
+    return estimator.values(), confidence_intervals(estimator, option['sv_confidence'])
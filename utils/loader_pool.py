@@ -0,0 +1,136 @@
+"""
+A persistent pool of processes that load the batches of the local datasets when num_workers > 0.
+The pool is forked once after the clients are built (utils.fflow.initialize), so the workers inherit
+the datasets without copying them, and it serves the batches of any (dataset, epoch) for all the
+clients instead of the worker processes that each DataLoader iterator forks at every epoch. The
+order of the items is drawn by the process of the client from the global RNG of torch in the same
+way as DataLoader(shuffle=True), and each batch is loaded under a seed derived from the epoch and
+the index of the batch, so the batches do not depend on which worker loads them.
+"""
+import random
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data._utils.collate import default_collate
+
+# the service of the running, which is started by utils.fflow.initialize
+service = None
+# the datasets that are served, which are inherited by the forked workers
+_datasets = []
+
+def start(datasets, num_workers, prefetch_factor=2):
+    """
+    Start the service of the datasets unless this process cannot have children (e.g. the workers of utils.worker_pool)
+    :param datasets: the datasets to be served (e.g. the local training datasets of the clients)
+    :param num_workers: the number of the loading processes
+    :param prefetch_factor: the number of the batches loaded in advance by each process
+    """
+    global service
+    close()
+    if num_workers <= 0 or mp.current_process().daemon: return None
+    service = LoaderService(datasets, num_workers, prefetch_factor)
+    return service
+
+def close():
+    global service
+    if service is not None: service.close()
+    service = None
+
+class LoaderService:
+    def __init__(self, datasets, num_workers, prefetch_factor=2):
+        global _datasets
+        _datasets = [d for d in datasets if d is not None]
+        self.keys = {id(d): k for k, d in enumerate(_datasets)}
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.pool = mp.get_context('fork').Pool(num_workers, initializer=_init_worker)
+
+    def key_of(self, dataset):
+        """The key of the dataset if it is served, else None"""
+        return self.keys.get(id(dataset), None)
+
+    def loader(self, dataset, batch_size=64, shuffle=True):
+        """Return the handle of the served dataset, which is iterated like DataLoader for each epoch"""
+        return ServedLoader(self, self.keys[id(dataset)], len(dataset), batch_size, shuffle)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class ServedLoader:
+    def __init__(self, service, key, length, batch_size=64, shuffle=True):
+        self.service = service
+        self.key = key
+        self.length = length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (self.length + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        # the same random numbers as DataLoader are drawn when an epoch starts
+        base_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            order = torch.randperm(self.length, generator=generator).tolist()
+        else:
+            order = list(range(self.length))
+        batches = [order[i:i + self.batch_size] for i in range(0, self.length, self.batch_size)]
+        return ServedIterator(self.service, self.key, batches, base_seed)
+
+class ServedIterator:
+    def __init__(self, service, key, batches, base_seed):
+        """
+        The iterator of the batches of an epoch, which keeps at most num_workers * prefetch_factor batches
+        being loaded in advance, where the batches are only submitted when the iterator is taken from
+        :param service: the LoaderService
+        :param key: the key of the dataset
+        :param batches: the lists of the indices of the items of the batches
+        :param base_seed: the seed of the epoch, where the i-th batch is loaded under base_seed + i
+        """
+        self.service = service
+        self.key = key
+        self.batches = batches
+        self.base_seed = base_seed
+        # the number of the batches that will be taken, which may be less than the epoch (see limit)
+        self.num_batches = len(batches)
+        self.num_submitted = 0
+        self.pending = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._submit()
+        if len(self.pending) == 0: raise StopIteration
+        return self.pending.pop(0).get()
+
+    def limit(self, num_batches):
+        """Only load the first num_batches batches (e.g. the remaining steps of the local training)"""
+        self.num_batches = min(len(self.batches), max(num_batches, self.num_submitted))
+
+    def close(self):
+        """Stop loading the batches, where the submitted batches are discarded"""
+        self.num_batches = self.num_submitted
+        self.pending = []
+
+    def _submit(self):
+        num_prefetch = self.service.num_workers * self.service.prefetch_factor
+        while len(self.pending) < num_prefetch and self.num_submitted < self.num_batches:
+            bid = self.num_submitted
+            self.pending.append(self.service.pool.apply_async(_load, (self.key, self.batches[bid], (self.base_seed + bid) % 2 ** 63)))
+            self.num_submitted += 1
+
+def _init_worker():
+    # the cores are shared by the workers and the training
+    torch.set_num_threads(1)
+
+def _load(key, items, seed):
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+    dataset = _datasets[key]
+    if callable(getattr(dataset, '__getitems__', None)): return default_collate(dataset.__getitems__(items))
+    return default_collate([dataset[i] for i in items])
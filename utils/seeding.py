@@ -0,0 +1,49 @@
+"""
+Deterministic random streams. Each stream is derived from the seed of the running, a purpose and
+some integer keys (e.g. the time and the client id), so the random numbers that a part of the
+system draws do not depend on what else has been drawn before, and the results are the same no
+matter in which order or in which process the parts run. The purposes are
+    sample:     the sampling of clients by the server (keys: time)
+    train:      the local computation of a client, e.g. data shuffling, dropout and codecs (keys: time, client id)
+    system:     the simulator of the system heterogeneity (keys: time, client id for the client-side states)
+    sv:         the sampling of subsets or permutations for SV
+"""
+import contextlib
+import random
+import numpy as np
+import torch
+
+purposes = ['sample', 'train', 'system', 'sv']
+# the seed of the running, which is set by utils.fflow.initialize
+base_seed = 0
+
+def seed_of(purpose, *keys):
+    """The 32-bit seed of the stream of (base_seed, purpose, *keys)"""
+    return int(np.random.SeedSequence([base_seed, purposes.index(purpose)] + [int(k) for k in keys]).generate_state(1)[0])
+
+def random_state(purpose, *keys):
+    """A numpy RandomState of the stream"""
+    return np.random.RandomState(seed_of(purpose, *keys))
+
+def generator(purpose, *keys, device='cpu'):
+    """A torch.Generator of the stream"""
+    return torch.Generator(device=device).manual_seed(seed_of(purpose, *keys))
+
+@contextlib.contextmanager
+def fixed_seed(purpose, *keys):
+    """
+    Run the block with the global RNGs of random, numpy and torch seeded by the stream and restore
+    the states of the RNGs afterwards, which wires the code that draws from the global RNGs (e.g.
+    DataLoader and dropout) to the stream.
+    """
+    seed = seed_of(purpose, *keys)
+    py_state, np_state = random.getstate(), np.random.get_state()
+    with torch.random.fork_rng(devices=list(range(torch.cuda.device_count()))):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            yield
+        finally:
+            random.setstate(py_state)
+            np.random.set_state(np_state)
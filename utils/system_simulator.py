@@ -2,12 +2,54 @@ import collections
 import numpy as np
 import queue
 import math
+import torch
+from utils import seeding
 
 clock = None
 random_seed_gen = None
 random_module = None
 state_updater = None
 
+class _ByteCounter:
+    """A write-only file that only counts the number of the written bytes"""
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, b):
+        self.nbytes += len(b)
+        return len(b)
+
+    def flush(self):
+        return
+
+def package_size(package):
+    """
+    The number of bytes of the package, where the variables of the simulator (i.e. the keys starting
+    with '__') are not counted. The size is computed from the tensors in the package (e.g. the models
+    are counted by their state dicts and the encoded models by EncodedModel.nbytes) without serializing
+    it, and only the objects of unknown types are measured by torch.save.
+    :param package: the dict to be sent
+    :return: the number of bytes
+    """
+    if package is None: return 0
+    return _nbytes({k: v for k, v in package.items() if not k.startswith('__')})
+
+def _nbytes(x):
+    if x is None: return 0
+    if isinstance(x, torch.Tensor): return x.numel() * x.element_size()
+    if isinstance(x, torch.nn.Module): return sum([v.numel() * v.element_size() for v in x.state_dict().values()])
+    if isinstance(x, dict): return sum([_nbytes(k) + _nbytes(v) for k, v in x.items()])
+    if isinstance(x, (list, tuple, set)): return sum([_nbytes(v) for v in x])
+    if isinstance(x, (bool, int, float, np.number)): return 8
+    if isinstance(x, (str, bytes)): return len(x)
+    if hasattr(x, 'nbytes'): return x.nbytes() if callable(x.nbytes) else x.nbytes
+    writer = _ByteCounter()
+    try:
+        torch.save(x, writer)
+    except Exception:
+        return 0
+    return writer.nbytes
+
 def seed_generator(seed=0):
     while True:
         yield seed+1
@@ -108,6 +150,8 @@ class BasicStateUpdater:
             'prob_drop': 0.,
             'working_amount': c.num_steps,
             'latency': 0,
+            '__package_size': 0,
+            '__download_size': 0,
         } for c in self.clients]
         self.state_counter = [{'dropped_counter': 0, 'latency_counter': 0, } for _ in self.clients]
 
@@ -333,14 +377,17 @@ def with_latency(communicate_with):
         global clock
         global state_updater
         res = communicate_with(self, client_id)
-        # Record the size of the package that may influence the value of the latency
-        state_updater.set_variable([client_id], '__package_size', [res.__sizeof__()])
+        # Record the serialized size of the package that may influence the value of the latency
+        state_updater.set_variable([client_id], '__package_size', [package_size(res)])
         # Update the real-time latency of the client response
         state_updater.update_client_timeliness([client_id])
         # Get the updated latency
         latency = state_updater.get_variable(client_id, 'latency')[0]
         self.clients[client_id]._latency = latency
         res['__cid'] = client_id
+        # Record the traffic of the communication
+        res['__upload_size'] = state_updater.get_variable(client_id, '__package_size')[0]
+        res['__download_size'] = state_updater.get_variable(client_id, '__download_size')[0]
         # Compute the arrival time
         res['__t'] = clock.current_time + latency
         return res
@@ -351,8 +398,14 @@ def with_completeness(train):
     def train_with_incomplete_update(self, model, *args, **kwargs):
         global state_updater
         old_num_steps = self.num_steps
-        # Update the completeness (i.e. state_updater.variable[cid]['working_amount']) of local computing
-        state_updater.update_client_completeness([self.id])
+        # Update the completeness (i.e. state_updater.variable[cid]['working_amount']) of local computing,
+        # which draws from the stream of the client at this time since the training may run in a worker
+        old_random_module = state_updater.random_module
+        state_updater.random_module = seeding.random_state('system', clock.current_time, self.id)
+        try:
+            state_updater.update_client_completeness([self.id])
+        finally:
+            state_updater.random_module = old_random_module
         res = train(self, model, *args, **kwargs)
         self._working_amount = self.num_steps
         self.num_steps = old_num_steps
@@ -606,6 +659,25 @@ def uniform_client_timeliness(server, min_latency=0, max_latency=1):
     for c,lt in zip(server.clients, latency): c._latency = lt
     state_updater.set_variable(state_updater.all_clients, 'latency', latency)
 
+def bandwidth_client_timeliness(server, bandwidth=1e6, base_latency=0):
+    """
+    The latency of each response is determined by the serialized sizes of the packages, i.e.
+        latency = base_latency + ceil((download_size + upload_size) / bandwidth)
+    where bandwidth is the number of bytes transferred in one unit of time. The string mode should
+    be like 'BW-x-y' where x is the bandwidth and y is the base latency.
+    """
+    global state_updater
+    state_updater._bandwidth = bandwidth
+    state_updater._base_latency = int(base_latency)
+    latency = [int(base_latency) for _ in server.clients]
+    for c, lt in zip(server.clients, latency): c._latency = lt
+    state_updater.set_variable(state_updater.all_clients, 'latency', latency)
+    def f(self, client_ids = []):
+        sizes = [self.variables[cid]['__download_size'] + self.variables[cid]['__package_size'] for cid in client_ids]
+        self.set_variable(client_ids, 'latency', [self._base_latency + int(math.ceil(size / self._bandwidth)) for size in sizes])
+        return
+    BasicStateUpdater.update_client_timeliness = f
+
 #************************************************************************************************
 availability_modes = {
     'IDL': ideal_client_availability,
@@ -636,6 +708,7 @@ timeliness_modes = {
     'IDL': ideal_client_timeliness,
     'LN': lognormal_client_timeliness,
     'UNI': uniform_client_timeliness,
+    'BW': bandwidth_client_timeliness,
 }
 
 def get_mode(mode_string):
@@ -0,0 +1,163 @@
+"""
+A persistent pool of processes that run the local training of clients. Each worker builds its own
+copy of the server and the clients from the fedtask once when it starts (utils.fflow.initialize), and
+the clients are assigned to the workers by their ids (i.e. client cid always runs on the worker
+cid % num_workers), so the states kept by the clients stay in one process. Each worker only keeps the
+local data of its own clients (see keep_own_data). For each reply, only the client id, the round
+configuration of the client (e.g. the learning rate) and the package from the server are sent to the
+worker, where the models in the packages are sent as their state dicts. The attributes of plain
+values (e.g. numbers) that the reply changes on the client (e.g. _working_amount) are sent back with
+the package and set on the client of the server, while the models and tensors kept by the clients
+stay in the workers. The local computation of each reply draws from the random stream of (time,
+client id) just like serial execution (see BasicServer.communicate_with), so both give the same results.
+"""
+import os
+import queue
+import traceback
+import torch
+from torch.utils.data import Dataset
+import torch.multiprocessing as mp
+from utils import fmodule
+from utils import seeding
+import utils.system_simulator as ss
+
+# the attributes of the clients that may be changed by the server during training and are sent with each package
+round_config = ['learning_rate', 'batch_size', 'epochs', 'num_steps']
+# the types of the attributes of the clients that are sent back to the server when they are changed by the reply
+plain_types = (bool, int, float, str, type(None))
+
+class _DataOfOtherWorker(Dataset):
+    """The placeholder of the local dataset of a client that is trained by another worker, which only keeps the length"""
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        raise RuntimeError("The data of the client is kept by another worker.")
+
+def keep_own_data(worker, train_datas, valid_datas):
+    """
+    Replace the local datasets of the clients that are not trained by the worker with placeholders of the same lengths
+    :param worker: (the index of the worker, the number of the workers)
+    :param train_datas: the local training datasets of all the clients
+    :param valid_datas: the local validating datasets of all the clients
+    :return: the local training datasets and the local validating datasets
+    """
+    wid, num_workers = worker
+    keep = lambda cid, data: data if cid % num_workers == wid or data is None else _DataOfOtherWorker(len(data))
+    return [keep(cid, d) for cid, d in enumerate(train_datas)], [keep(cid, d) for cid, d in enumerate(valid_datas)]
+
+def plain_state(client):
+    """The attributes of the client whose values are of plain_types"""
+    return {k: v for k, v in vars(client).items() if isinstance(v, plain_types)}
+
+def to_wire(obj):
+    """Replace the models in the package with their classes and state dicts"""
+    if isinstance(obj, fmodule.FModule): return _WireModel(obj)
+    if isinstance(obj, dict): return {k: to_wire(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)([to_wire(v) for v in obj])
+    return obj
+
+def from_wire(obj, like=None):
+    """Rebuild the models in the package that is converted by to_wire, where the models of the same class as `like` are allocated by empty_like"""
+    if isinstance(obj, _WireModel): return obj.build(like)
+    if isinstance(obj, dict): return {k: from_wire(v, like) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)): return type(obj)([from_wire(v, like) for v in obj])
+    return obj
+
+class _WireModel:
+    def __init__(self, model):
+        self.model_class = type(model)
+        self.state = {k: v.detach() for k, v in model.state_dict().items()}
+        self.training = model.training
+
+    def build(self, like=None):
+        res = fmodule.empty_like(like) if like is not None and type(like) is self.model_class else self.model_class()
+        device = res.get_device()
+        res.load_state_dict({k: v.to(device) for k, v in self.state.items()})
+        res.train(self.training)
+        return res
+
+class ClientWorkerPool:
+    def __init__(self, option, num_workers, poll_interval=5):
+        """
+        Start the workers
+        :param option: the option of the running, which is used by the workers to build the clients
+        :param num_workers: the number of the worker processes
+        :param poll_interval: the seconds between the checks of whether the workers are alive while waiting for the replies
+        """
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        ctx = mp.get_context('spawn')
+        self.result_queue = ctx.Queue()
+        self.task_queues = [ctx.Queue() for _ in range(num_workers)]
+        # the cores are evenly shared by the workers
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        # the workers load their data by themselves since they cannot fork the processes of utils.loader_pool
+        worker_option = dict(option, num_threads=1, num_workers=0, no_log_console=True, log_file=False)
+        self.workers = [ctx.Process(target=_work, args=(dict(worker_option, worker_clients=(wid, num_workers)), num_threads, q, self.result_queue), daemon=True) for wid, q in enumerate(self.task_queues)]
+        for w in self.workers: w.start()
+        self.received = {}
+
+    def submit(self, client, svr_pkg, time):
+        """
+        Send the package from the server to the worker of the client
+        :param client: the client to reply
+        :param svr_pkg: the package from the server
+        :param time: the time of the round, which is a key of the seed of the local computation
+        """
+        config = {k: getattr(client, k) for k in round_config}
+        self.task_queues[client.id % self.num_workers].put((client.id, time, config, to_wire(svr_pkg)))
+
+    def receive(self, client, like=None):
+        """
+        Wait for the reply of the client, where the replies of other clients that arrive earlier are kept until they are received
+        :param client: the client, on which the attributes changed by the reply in the worker are set
+        :param like: the model that the models of the same class in the reply are allocated like
+        :return: the package from the client
+        """
+        while client.id not in self.received:
+            try:
+                cid, cpkg, state, error = self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead = [wid for wid, w in enumerate(self.workers) if not w.is_alive()]
+                if len(dead) > 0:
+                    raise RuntimeError('Worker {} exited with code {} while client {} is waiting for the reply.'.format(dead[0], self.workers[dead[0]].exitcode, client.id))
+                continue
+            if error is not None:
+                raise RuntimeError('Client {} failed in the worker:\n{}'.format(cid, error))
+            self.received[cid] = (cpkg, state)
+        cpkg, state = self.received.pop(client.id)
+        for k, v in state.items(): setattr(client, k, v)
+        return from_wire(cpkg, like)
+
+    def close(self):
+        for q in self.task_queues: q.put(None)
+        for w in self.workers: w.join()
+        self.workers = []
+
+def _work(option, num_threads, task_queue, result_queue):
+    import utils.fflow as flw
+    torch.set_num_threads(num_threads)
+    flw.setup_seed(option['seed'])
+    server = flw.initialize(option)
+    while True:
+        task = task_queue.get()
+        if task is None: break
+        cid, time, config, svr_pkg = task
+        try:
+            client = server.clients[cid]
+            for k, v in config.items(): setattr(client, k, v)
+            svr_pkg = from_wire(svr_pkg, server.model)
+            # the simulator of the worker follows the time of the server
+            if time > ss.clock.current_time: ss.clock.set_time(time)
+            old_state = plain_state(client)
+            with seeding.fixed_seed('train', time, cid):
+                cpkg = client.reply(svr_pkg)
+            state = {k: v for k, v in plain_state(client).items() if k not in old_state or old_state[k] != v}
+            result_queue.put((cid, to_wire(cpkg), state, None))
+        except Exception:
+            result_queue.put((cid, None, None, traceback.format_exc()))
+    return